@@ -0,0 +1,264 @@
+# analytics.py
+"""
+Аналитика привычек пользователя: серии, динамика неделя к неделе и связи
+между привычками (команда /insights).
+
+История пользователя читается одним запросом и раскладывается в матрицы
+«день × привычка» на сплошной шкале дат (дни без записи — пропуски). Все
+метрики считаются векторно по всем привычкам сразу, без цикла по записям:
+
+  * серии — длины подряд идущих дней с «да» по булевым привычкам;
+  * динамика — доля «да» / среднее за последние 7 дней против предыдущих 7;
+  * связи — корреляция Пирсона для каждой пары привычек по дням, где
+    отвечены обе (попарно-полные наблюдения, одним матричным проходом).
+
+Результат кэшируется по пользователю и версии его истории (log_versions):
+пока пользователь ничего не записал, /insights стоит один короткий запрос.
+"""
+import datetime
+import os
+from dataclasses import dataclass
+
+import numpy as np
+from sqlalchemy import select
+
+from cache import LRUCache
+from database import get_async_session, DailyLog, LogVersion
+from habits import BOOL_SLOTS, NUMBER_SLOTS, bits, number_matrix
+
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "5000"))
+# Связь показывается, если у пары привычек есть хотя бы столько общих дней
+ANALYTICS_MIN_DAYS = int(os.getenv("ANALYTICS_MIN_DAYS", "14"))
+# ... и модуль корреляции не меньше порога
+ANALYTICS_MIN_CORRELATION = float(os.getenv("ANALYTICS_MIN_CORRELATION", "0.3"))
+ANALYTICS_MAX_CORRELATIONS = 3
+TREND_DAYS = 7
+
+
+@dataclass
+class History:
+    """
+    История на сплошной шкале дат start .. start + days - 1.
+    """
+    start: datetime.date
+    days: int
+    entries: int
+    yes: np.ndarray  # days × BOOL_SLOTS, 0/1
+    answered: np.ndarray  # days × BOOL_SLOTS, 0/1
+    numbers: np.ndarray  # days × NUMBER_SLOTS, NaN — нет ответа
+
+
+@dataclass
+class Insights:
+    entries: int
+    streaks: list  # (привычка, текущая серия, лучшая серия)
+    trends: list  # (привычка, значение за 7 дней, за предыдущие 7 дней)
+    correlations: list  # (привычка, привычка, r, общих дней)
+
+
+# -------------------------------------------------------------------
+# Загрузка истории
+# -------------------------------------------------------------------
+async def get_log_version(session, user_id):
+    result = await session.execute(select(LogVersion.version).where(LogVersion.user_id == user_id))
+    return result.scalar_one_or_none() or 0
+
+
+async def load_history(session, user_id, today):
+    """
+    История пользователя до `today` включительно или None, если записей нет.
+    """
+    result = await session.execute(
+        select(DailyLog.date_of_entry, DailyLog.habit_mask, DailyLog.answered_mask, DailyLog.numbers)
+        .where(DailyLog.user_id == user_id, DailyLog.date_of_entry <= today)
+        .order_by(DailyLog.date_of_entry)
+    )
+    rows = result.all()
+    if not rows:
+        return None
+    start = rows[0].date_of_entry
+    days = (today - start).days + 1
+    index = np.array([(row.date_of_entry - start).days for row in rows])
+
+    yes = np.zeros((days, BOOL_SLOTS), dtype=np.int32)
+    answered = np.zeros((days, BOOL_SLOTS), dtype=np.int32)
+    numbers = np.full((days, NUMBER_SLOTS), np.nan)
+    row_answered = bits([row.answered_mask for row in rows])
+    answered[index] = row_answered
+    yes[index] = bits([row.habit_mask for row in rows]) & row_answered
+    numbers[index] = number_matrix([row.numbers for row in rows])
+    return History(start, days, len(rows), yes, answered, numbers)
+
+
+# -------------------------------------------------------------------
+# Метрики
+# -------------------------------------------------------------------
+def run_lengths(success):
+    """
+    Длина серии «успехов», заканчивающейся в каждом дне (по каждой колонке).
+    """
+    days = np.arange(len(success)).reshape(-1, 1)
+    last_failure = np.maximum.accumulate(np.where(success, -1, days), axis=0)
+    return days - last_failure
+
+
+def streaks(history, habits):
+    """
+    Текущая и лучшая серии по булевым привычкам. Текущая серия заканчивается
+    сегодня или, если за сегодня ещё нет ответа, вчера.
+    """
+    bools = [h for h in habits if h.kind == "bool"]
+    if not bools:
+        return []
+    slots = [h.slot for h in bools]
+    runs = run_lengths(history.yes[:, slots].astype(bool))
+    last = history.days - 1
+    # Сегодняшний день ещё можно отметить — без ответа он серию не прерывает
+    end = np.where(history.answered[last, slots] > 0, last, max(last - 1, 0))
+    current = runs[end, np.arange(len(slots))]
+    return list(zip(bools, current.tolist(), runs.max(axis=0).tolist()))
+
+
+def _window_rates(history, slots_bool, slots_num, stop):
+    start = max(stop - TREND_DAYS, 0)
+    yes = history.yes[start:stop, slots_bool].sum(axis=0)
+    seen = history.answered[start:stop, slots_bool].sum(axis=0)
+    rates = np.divide(yes, seen, out=np.full(len(slots_bool), np.nan), where=seen > 0)
+    window = history.numbers[start:stop, slots_num]
+    counts = (~np.isnan(window)).sum(axis=0)
+    averages = np.divide(np.nansum(window, axis=0), counts, out=np.full(len(slots_num), np.nan), where=counts > 0)
+    return np.concatenate([rates, averages])
+
+
+def trends(history, habits):
+    """
+    Доля «да» (булевы) или среднее (числовые) за последние TREND_DAYS дней
+    и за TREND_DAYS дней до них; NaN — ответов в окне не было.
+    """
+    bools = [h for h in habits if h.kind == "bool"]
+    numbers = [h for h in habits if h.kind == "number"]
+    slots_bool, slots_num = [h.slot for h in bools], [h.slot for h in numbers]
+    current = _window_rates(history, slots_bool, slots_num, history.days)
+    previous = _window_rates(history, slots_bool, slots_num, history.days - TREND_DAYS)
+    return [
+        (habit, now, before)
+        for habit, now, before in zip(bools + numbers, current.tolist(), previous.tolist())
+        if not np.isnan(now)
+    ]
+
+
+def series_matrix(history, habits):
+    """
+    Матрица день × привычка: 0/1 для булевых, значение для числовых, NaN — нет ответа.
+    """
+    columns = []
+    for habit in habits:
+        if habit.kind == "bool":
+            column = np.where(history.answered[:, habit.slot] > 0, history.yes[:, habit.slot], np.nan)
+        else:
+            column = history.numbers[:, habit.slot]
+        columns.append(column)
+    return np.column_stack(columns) if columns else np.empty((history.days, 0))
+
+
+def pairwise_correlations(matrix):
+    """
+    Корреляции Пирсона всех пар колонок по строкам, где заданы обе колонки.
+    Возвращает (r, n): матрицы колонки × колонки; r = NaN, если у пары нет разброса.
+    """
+    present = (~np.isnan(matrix)).astype(float)
+    values = np.nan_to_num(matrix)
+    n = present.T @ present
+    sum_x = values.T @ present  # [i, j] — сумма i по общим с j дням
+    sum_xx = (values ** 2).T @ present
+    sum_xy = values.T @ values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sum_xy - sum_x * sum_x.T / n
+        var = sum_xx - sum_x ** 2 / n
+        r = cov / np.sqrt(var * var.T)
+    r[~np.isfinite(r)] = np.nan
+    return np.clip(r, -1, 1), n.astype(int)
+
+
+def correlations(history, habits):
+    """
+    Самые заметные связи между привычками набора (не больше ANALYTICS_MAX_CORRELATIONS).
+    """
+    r, n = pairwise_correlations(series_matrix(history, habits))
+    i, j = np.triu_indices(len(habits), k=1)
+    pairs = r[i, j]
+    keep = (n[i, j] >= ANALYTICS_MIN_DAYS) & (np.abs(np.nan_to_num(pairs)) >= ANALYTICS_MIN_CORRELATION)
+    order = np.argsort(-np.abs(pairs[keep]))[:ANALYTICS_MAX_CORRELATIONS]
+    i, j, pairs, days = i[keep][order], j[keep][order], pairs[keep][order], n[i, j][keep][order]
+    return [(habits[a], habits[b], float(value), int(d)) for a, b, value, d in zip(i, j, pairs, days)]
+
+
+def compute_insights(history, habits):
+    return Insights(
+        entries=history.entries,
+        streaks=streaks(history, habits),
+        trends=trends(history, habits),
+        correlations=correlations(history, habits),
+    )
+
+
+# -------------------------------------------------------------------
+# Кэш и форматирование
+# -------------------------------------------------------------------
+_insights = LRUCache(ANALYTICS_CACHE_SIZE)
+
+
+async def get_insights(user_id, habits, today=None):
+    """
+    Аналитика по набору привычек `habits` или None, если записей нет.
+    Пересчитывается, только если изменились история, набор привычек или дата.
+    """
+    today = today or datetime.date.today()
+    async with get_async_session() as session:
+        # Набор привычек — полным списком ключей: короткий fingerprint кнопок даёт коллизии
+        stamp = (await get_log_version(session, user_id), tuple(h.key for h in habits), today)
+        cached = _insights.get(user_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        history = await load_history(session, user_id, today)
+    insights = compute_insights(history, habits) if history is not None else None
+    _insights.set(user_id, (stamp, insights))
+    return insights
+
+
+def cache_stats():
+    return {"size": len(_insights), "hits": _insights.hits, "misses": _insights.misses}
+
+
+def _format_value(habit, value):
+    if habit.kind == "bool":
+        return f"{value * 100:.0f}%"
+    return f"{value:.1f} {habit.unit}".strip()
+
+
+def _arrow(now, before):
+    if np.isnan(before) or abs(now - before) < 1e-9:
+        return ""
+    return " ↑" if now > before else " ↓"
+
+
+def format_insights(insights):
+    lines = [f"Аналитика по {insights.entries} записям\n"]
+    if insights.streaks:
+        lines.append("Серии (текущая / лучшая), дней:")
+        lines += [f"• {habit.label}: {current} / {best}" for habit, current, best in insights.streaks]
+        lines.append("")
+    if insights.trends:
+        lines.append(f"Последние {TREND_DAYS} дней (до этого):")
+        for habit, now, before in insights.trends:
+            was = "—" if np.isnan(before) else _format_value(habit, before)
+            lines.append(f"• {habit.label}: {_format_value(habit, now)} ({was}){_arrow(now, before)}")
+        lines.append("")
+    if insights.correlations:
+        lines.append("Связи между привычками:")
+        for first, second, r, days in insights.correlations:
+            direction = "вместе" if r > 0 else "наоборот"
+            lines.append(f"• {first.label} и {second.label}: r = {r:+.2f} ({direction}, {days} дн.)")
+    else:
+        lines.append(f"Связи между привычками появятся, когда накопится {ANALYTICS_MIN_DAYS}+ дней записей.")
+    return "\n".join(lines).strip()
@@ -0,0 +1,310 @@
+# benchmarks/bench_bot.py
+"""
+Нагрузочный прогон настоящих хэндлеров бота (dp из main.py).
+
+Синтетические апдейты передаются в диспетчер (как при polling), Bot API заменён
+заглушкой (fake_bot_api.py, поднимается в этом же процессе), БД — локальный
+Postgres. Сценарии:
+
+    start_new         /start от новых пользователей (шторм регистраций)
+    start_known       повторный /start от тех же пользователей
+    survey_today      /gather_data и ответы на все вопросы
+    survey_backdated  /gather_data_backdated, выбор даты и ответы
+    survey_compact    /log, два переключателя и выбор часов спорта (компактный опрос)
+    weekly_stats      /weekly_stats
+    export            /export_excel (на части пользователей)
+    morning_job       рассылка напоминаний всем тестовым пользователям
+
+Для каждого сценария печатаются пропускная способность, p50/p95/p99 задержки
+обработки апдейта, число SQL-запросов и вызовов Bot API. Результаты можно
+сохранить (--save) и сравнить с эталоном (--compare): при деградации p95 или
+числа запросов на апдейт больше --tolerance скрипт завершается с кодом 1.
+
+Тестовые пользователи — диапазон telegram_id от --first-user-id, их данные
+удаляются до и после прогона. morning_job забирает всех пользователей, у кого
+наступило время напоминания, поэтому запускайте только на локальной БД.
+
+Запуск (нужен Postgres из docker-compose.yml со схемой: python migrations.py):
+    DB_PORT=5435 python benchmarks/bench_bot.py --users 500 --concurrency 100
+    DB_PORT=5435 python benchmarks/bench_bot.py --save baseline.json
+    DB_PORT=5435 python benchmarks/bench_bot.py --compare baseline.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+API_PORT = int(os.getenv("BENCH_API_PORT", "8089"))
+# main.py читает настройки при импорте — подставляем заглушку Bot API до него
+os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{API_PORT}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+# Лимит Telegram меряет не бот, а заглушку — по умолчанию снимаем его
+os.environ.setdefault("BROADCAST_GLOBAL_RATE", "1000")
+os.environ.setdefault("BROADCAST_PER_CHAT_INTERVAL", "0")
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from sqlalchemy import event, text
+
+import main
+import survey
+from database import engine, async_engine, get_async_session
+from habits import DEFAULT_HABITS
+from fake_bot_api import FakeBotAPI
+from fake_update_producer import make_message_update, make_callback_update
+from migrations import check_schema_version
+
+SURVEY_ANSWERS = ["Да", "Нет", "Да", "1.5"]
+
+
+class QueryCounter:
+    """
+    Считает SQL-запросы обоих движков (кроме процессов пула выгрузки).
+    """
+
+    def __init__(self):
+        self.count = 0
+        for target in (engine, async_engine.sync_engine):
+            event.listen(target, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+async def process(update):
+    """
+    Один апдейт в отдельной задаче (как в webhook-режиме). Возвращает время обработки.
+    """
+    started = time.perf_counter()
+    await asyncio.create_task(main.dp.updates_handler.notify(types.Update(**update)))
+    return time.perf_counter() - started
+
+
+# -------------------------------------------------------------------
+# Сценарии: функция пользователя -> список апдейтов по порядку
+# -------------------------------------------------------------------
+def backdated_script(user_id):
+    day = (datetime.date.today() - datetime.timedelta(days=3)).strftime("%Y-%m-%d")
+    return [
+        make_message_update(user_id, "/gather_data_backdated"),
+        make_callback_update(user_id, f"select_date:{day}"),
+        *(make_message_update(user_id, answer) for answer in SURVEY_ANSWERS),
+    ]
+
+
+def compact_script(user_id):
+    day = datetime.date.today() - datetime.timedelta(days=1)
+    return [
+        make_message_update(user_id, "/log"),
+        make_callback_update(user_id, survey.encode_callback(day, DEFAULT_HABITS, 0b001, [None])),
+        make_callback_update(user_id, survey.encode_callback(day, DEFAULT_HABITS, 0b101, [None])),
+        make_callback_update(user_id, survey.encode_callback(day, DEFAULT_HABITS, 0b101, [3])),
+    ]
+
+
+SCENARIOS = {
+    "start_new": lambda user_id: [make_message_update(user_id, "/start")],
+    "start_known": lambda user_id: [make_message_update(user_id, "/start")],
+    "survey_today": lambda user_id: [
+        make_message_update(user_id, "/gather_data"),
+        *(make_message_update(user_id, answer) for answer in SURVEY_ANSWERS),
+    ],
+    "survey_backdated": backdated_script,
+    "survey_compact": compact_script,
+    "weekly_stats": lambda user_id: [make_message_update(user_id, "/weekly_stats")],
+    "export": lambda user_id: [make_message_update(user_id, "/export_excel")],
+}
+
+
+async def run_scenario(script, user_ids, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run_user(user_id):
+        async with semaphore:
+            # Апдейты одного пользователя — строго по порядку, как в Telegram
+            for update in script(user_id):
+                latencies.append(await process(update))
+
+    await asyncio.gather(*(run_user(user_id) for user_id in user_ids))
+    return latencies
+
+
+async def run_morning_job(user_ids):
+    async with get_async_session() as session:
+        await session.execute(
+            text("UPDATE users SET next_reminder_at = now() AT TIME ZONE 'utc' "
+                 "WHERE telegram_id BETWEEN :first AND :last"),
+            {"first": user_ids[0], "last": user_ids[-1]},
+        )
+        await session.commit()
+    started = time.perf_counter()
+    await main.morning_job()
+    return [time.perf_counter() - started]
+
+
+async def flush_storage():
+    # Состояния FSM пишутся в БД фоном — дописываем, чтобы запросы попали в свой сценарий
+    flush = getattr(main.dp.storage, "flush", None)
+    if flush is not None:
+        await flush()
+
+
+async def cleanup(first, last):
+    async with get_async_session() as session:
+        for table, column in (("users", "telegram_id"), ("daily_logs", "user_id"),
+                              ("habit_rollups", "user_id"), ("fsm_states", "user_id"),
+                              ("log_versions", "user_id"), ("team_members", "user_id"),
+                              ("team_scores", "user_id"), ("broadcast_deliveries", "chat_id")):
+            await session.execute(
+                text(f"DELETE FROM {table} WHERE {column} BETWEEN :first AND :last"),
+                {"first": first, "last": last},
+            )
+        # Прогоны рассылок, в которых были только пользователи бенчмарка
+        await session.execute(text(
+            "DELETE FROM broadcast_runs r WHERE NOT EXISTS "
+            "(SELECT 1 FROM broadcast_deliveries d WHERE d.run_id = r.id)"
+        ))
+        await session.commit()
+
+
+# -------------------------------------------------------------------
+# Отчёт и сравнение с эталоном
+# -------------------------------------------------------------------
+def summarize(name, latencies, elapsed, queries, api_calls):
+    ms = [value * 1000 for value in latencies]
+    updates = len(latencies)
+    return {
+        "scenario": name,
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(updates / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "queries": queries,
+        "queries_per_update": round(queries / updates, 2) if updates else 0.0,
+        "api_calls": api_calls,
+    }
+
+
+def report(results):
+    print(f"\n{'сценарий':<17}{'апдейтов':>9}{'апд/с':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+          f"{'SQL':>8}{'SQL/апд':>9}{'Bot API':>9}")
+    for r in results:
+        print(f"{r['scenario']:<17}{r['updates']:>9}{r['throughput']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['queries']:>8}{r['queries_per_update']:>9}{r['api_calls']:>9}")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Регрессии относительно эталона: p95 и число запросов на апдейт.
+    """
+    regressions = []
+    previous = {r["scenario"]: r for r in baseline}
+    for r in results:
+        old = previous.get(r["scenario"])
+        if old is None:
+            continue
+        for metric in ("p95_ms", "queries_per_update"):
+            if old[metric] and r[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{r['scenario']}: {metric} {old[metric]} -> {r[metric]}")
+    return regressions
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.api_latency)
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await check_schema_version()
+    counter = QueryCounter()
+
+    user_ids = list(range(args.first_user_id, args.first_user_id + args.users))
+    await cleanup(user_ids[0], user_ids[-1])
+
+    scenarios = args.scenarios.split(",") if args.scenarios else [*SCENARIOS, "morning_job"]
+    results = []
+    try:
+        for name in scenarios:
+            queries_before, api_before = counter.count, sum(api.calls.values())
+            started = time.perf_counter()
+            if name == "morning_job":
+                latencies = await run_morning_job(user_ids)
+            elif name == "export":
+                latencies = await run_scenario(SCENARIOS[name], user_ids[:args.export_users], args.concurrency)
+            else:
+                latencies = await run_scenario(SCENARIOS[name], user_ids, args.concurrency)
+            await flush_storage()
+            elapsed = time.perf_counter() - started
+            results.append(summarize(
+                name, latencies, elapsed,
+                counter.count - queries_before, sum(api.calls.values()) - api_before,
+            ))
+            print(f"  {name}: {elapsed:.2f} c")
+    finally:
+        if not args.keep:
+            await cleanup(user_ids[0], user_ids[-1])
+        await main.on_shutdown(main.dp)
+        session = await main.bot.get_session()
+        await session.close()
+        await runner.cleanup()
+
+    print(f"\nBot API: {dict(Counter(api.calls))}")
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument("--first-user-id", type=int, default=900_000_000)
+    parser.add_argument("--export-users", type=int, default=20, help="сколько пользователей делают выгрузку")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа заглушки Bot API, c")
+    parser.add_argument("--scenarios", default="", help="через запятую; по умолчанию все")
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON эталонного прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимая деградация, доля")
+    parser.add_argument("--keep", action="store_true", help="не удалять данные тестовых пользователей")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Как в start_webhook: тот же loop, к которому привязаны объекты, созданные при импорте main
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nДеградация относительно эталона:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nДеградаций относительно эталона нет.")
+
+
+if __name__ == "__main__":
+    main_cli()
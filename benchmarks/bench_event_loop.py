@@ -0,0 +1,100 @@
+# benchmarks/bench_event_loop.py
+"""
+Задержка event loop под конкурентной нагрузкой: синхронные сессии vs асинхронные.
+
+Имитируем N одновременных хэндлеров, каждый делает запрос к Postgres
+(по умолчанию SELECT pg_sleep(0.01) — типичный «медленный» запрос),
+и параллельно измеряем, насколько опаздывает пробный таймер event loop.
+С синхронной сессией каждый запрос блокирует весь loop, с асинхронной — нет.
+
+Запуск (нужен Postgres из docker-compose.yml):
+    DB_PORT=5435 python benchmarks/bench_event_loop.py --handlers 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from database import get_session, get_async_session, dispose_engines
+
+PROBE_INTERVAL = 0.005
+
+
+async def probe_loop_lag(stop, lags):
+    """
+    Спим PROBE_INTERVAL и записываем, на сколько позже проснулись.
+    """
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def sync_handler(query):
+    session = get_session()
+    try:
+        session.execute(text(query))
+    finally:
+        session.close()
+
+
+async def async_handler(query):
+    async with get_async_session() as session:
+        await session.execute(text(query))
+
+
+async def run_case(handler, handlers, query):
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(probe_loop_lag(stop, lags))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(query) for _ in range(handlers)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe
+    return elapsed, lags
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+def report(name, elapsed, lags):
+    lags_ms = sorted(lag * 1000 for lag in lags)
+    print(
+        f"{name:<6} всего {elapsed:6.2f} c | задержка loop, мс: "
+        f"p50={percentile(lags_ms, 50):7.2f} p99={percentile(lags_ms, 99):7.2f} "
+        f"max={max(lags_ms, default=0):7.2f} (замеров: {len(lags_ms)})"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handlers", type=int, default=200, help="число одновременных хэндлеров")
+    parser.add_argument("--query", default="SELECT pg_sleep(0.01)", help="SQL, который выполняет каждый хэндлер")
+    args = parser.parse_args()
+
+    # Прогрев пулов соединений
+    await sync_handler("SELECT 1")
+    await async_handler("SELECT 1")
+
+    elapsed, lags = await run_case(sync_handler, args.handlers, args.query)
+    report("sync", elapsed, lags)
+    elapsed, lags = await run_case(async_handler, args.handlers, args.query)
+    report("async", elapsed, lags)
+
+    await dispose_engines()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
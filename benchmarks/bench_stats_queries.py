@@ -0,0 +1,125 @@
+# benchmarks/bench_stats_queries.py
+"""
+Запросы статистики и выгрузки по синтетической таблице DailyLog (~1 млн строк):
+без индекса и с уникальным индексом (user_id, date_of_entry).
+
+Таблица bench_daily_logs создаётся рядом с рабочей (LIKE daily_logs) и удаляется
+по окончании, рабочие данные не затрагиваются. Нужна схема не ниже 8-й версии
+(функции habit_array_sum, habit_bits).
+
+Запуск (нужен Postgres из docker-compose.yml):
+    DB_PORT=5435 python benchmarks/bench_stats_queries.py --users 10000 --days 100
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from database import engine
+
+TABLE = "bench_daily_logs"
+
+QUERIES = {
+    # cmd_weekly_stats до перехода на агрегаты
+    "weekly_stats": f"""
+        SELECT count(*),
+               habit_array_sum(habit_bits(habit_mask & answered_mask, 3)),
+               habit_array_sum(habit_bits(answered_mask, 3)),
+               habit_array_sum(numbers)
+        FROM {TABLE}
+        WHERE user_id = :user_id AND date_of_entry >= current_date - 7
+    """,
+    # export_excel: вся история пользователя
+    "export": f"""
+        SELECT id, date_of_entry, habit_mask, answered_mask, numbers, created_at
+        FROM {TABLE}
+        WHERE user_id = :user_id
+        ORDER BY date_of_entry, id
+    """,
+    # проверка существующей записи при upsert
+    "upsert_lookup": f"""
+        SELECT id FROM {TABLE}
+        WHERE user_id = :user_id AND date_of_entry = current_date - 1
+    """,
+}
+
+
+def populate(conn, users, days):
+    conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    conn.execute(text(f"CREATE TABLE {TABLE} (LIKE daily_logs INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        INSERT INTO {TABLE} (id, user_id, date_of_entry, habit_mask, answered_mask, numbers, created_at)
+        SELECT row_number() OVER (),
+               u,
+               current_date - d,
+               (random() < 0.6)::int | ((random() < 0.5)::int << 1) | ((random() < 0.7)::int << 2),
+               7,
+               ARRAY[round((random() * 3)::numeric, 1)::float8],
+               now() - make_interval(days => d)
+        FROM generate_series(1, :users) AS u, generate_series(0, :days - 1) AS d
+        ORDER BY random()
+    """), {"users": users, "days": days})
+    conn.execute(text(f"ANALYZE {TABLE}"))
+
+
+def run_queries(conn, users, repeats):
+    results = {}
+    for name, sql in QUERIES.items():
+        timings = []
+        for _ in range(repeats):
+            user_id = random.randint(1, users)
+            started = time.perf_counter()
+            conn.execute(text(sql), {"user_id": user_id}).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        plan = [row[0].strip() for row in conn.execute(text(f"EXPLAIN {sql}"), {"user_id": 1})]
+        scan = next((line for line in plan if "Scan" in line), plan[0])
+        results[name] = (statistics.median(timings), max(timings), scan.lstrip("-> "))
+    conn.rollback()
+    return results
+
+
+def report(title, results):
+    print(f"\n{title}")
+    for name, (median, worst, plan) in results.items():
+        print(f"  {name:<14} медиана {median:8.2f} мс, макс {worst:8.2f} мс | {plan}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--keep", action="store_true", help="не удалять таблицу после прогона")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        started = time.perf_counter()
+        with conn.begin():
+            populate(conn, args.users, args.days)
+        print(f"Сгенерировано {args.users * args.days} строк за {time.perf_counter() - started:.1f} c")
+
+        report("Без индекса:", run_queries(conn, args.users, args.repeats))
+
+        started = time.perf_counter()
+        with conn.begin():
+            conn.execute(text(
+                f"CREATE UNIQUE INDEX {TABLE}_user_date ON {TABLE} (user_id, date_of_entry)"
+            ))
+            conn.execute(text(f"ANALYZE {TABLE}"))
+        print(f"\nИндекс построен за {time.perf_counter() - started:.1f} c")
+
+        report("С индексом (user_id, date_of_entry):", run_queries(conn, args.users, args.repeats))
+
+        if not args.keep:
+            with conn.begin():
+                conn.execute(text(f"DROP TABLE {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# benchmarks/fake_bot_api.py
+"""
+Заглушка Telegram Bot API для локальных тестов и нагрузочных прогонов.
+
+Отвечает на любые методы правдоподобными объектами, умеет добавлять задержку
+и имитировать flood control (429 + retry_after) и пользователей, заблокировавших
+бота (403 для постоянной доли chat_id). Счётчики вызовов — GET /stats.
+
+Запуск:
+    python benchmarks/fake_bot_api.py --port 8081 --latency 0.05
+    TELEGRAM_API_URL=http://localhost:8081 python main.py
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+# Методы, которые возвращают отправленное сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "sendDocument", "sendPhoto", "editMessageText",
+    "editMessageReplyMarkup", "editMessageCaption",
+}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, flood_rate=0.0, retry_after=1, blocked_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.calls = Counter()
+        self.floods = 0
+        self.blocked = 0
+        self._message_ids = itertools.count(1)
+
+    def make_app(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        # Один и тот же chat_id «заблокировал» бота при каждом запуске
+        chat_id = int(params.get("chat_id") or 0)
+        if method in MESSAGE_METHODS and chat_id % 1000 < self.blocked_rate * 1000:
+            self.blocked += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }, status=403)
+
+        return web.json_response({"ok": True, "result": self.result_for(method, params)})
+
+    def result_for(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id") or 0)
+            message = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+            return message
+        return True
+
+    async def handle_stats(self, request):
+        return web.json_response({"calls": dict(self.calls), "floods": self.floods, "blocked": self.blocked})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="базовая задержка ответа, c")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, c")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="доля chat_id, заблокировавших бота (403)")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, flood_rate=args.flood_rate,
+                     blocked_rate=args.blocked_rate)
+    web.run_app(api.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
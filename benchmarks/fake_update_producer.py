@@ -0,0 +1,97 @@
+# benchmarks/fake_update_producer.py
+"""
+Генератор синтетических апдейтов Telegram для webhook-режима.
+
+Каждый виртуальный пользователь проходит сценарий /start -> /gather_data ->
+ответы на вопросы опроса, апдейты отправляются POST-запросами на webhook.
+В конце печатается пропускная способность, коды ответов и метрики очереди бота.
+
+Запуск (бот в режиме webhook с заглушкой Bot API):
+    python benchmarks/fake_bot_api.py --port 8081 &
+    BOT_MODE=webhook TELEGRAM_API_URL=http://localhost:8081 python main.py &
+    python benchmarks/fake_update_producer.py --users 500 --concurrency 100
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+import aiohttp
+
+SURVEY_SCRIPT = ["/start", "/gather_data", "Да", "Нет", "Да", "1.5"]
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def make_message_update(user_id, text):
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def make_callback_update(user_id, data, message_id=1):
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_message_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "",
+            },
+        },
+    }
+
+
+async def run_user(session, url, headers, user_id, script, statuses):
+    for text in script:
+        async with session.post(url, json=make_message_update(user_id, text), headers=headers) as response:
+            statuses[response.status] += 1
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--stats-url", default="http://localhost:8080/webhook/stats")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота, если задан")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        async def limited(user_id):
+            async with semaphore:
+                await run_user(session, args.url, headers, user_id, SURVEY_SCRIPT, statuses)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(args.first_user_id + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        total = sum(statuses.values())
+        print(f"Отправлено апдейтов: {total} за {elapsed:.2f} c ({total / elapsed:.1f} апд/с)")
+        print(f"Коды ответов: {dict(statuses)}")
+
+        async with session.get(args.stats_url) as response:
+            print(f"Метрики очереди бота: {await response.json()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,243 @@
+# broadcast.py
+"""
+Движок массовой рассылки.
+
+Пользователи читаются из БД пачками, сообщения отправляет ограниченный пул
+асинхронных воркеров. Скорость ограничивается token bucket'ом (общий лимит
+Telegram ~30 сообщений/с) и минимальным интервалом между сообщениями в один чат.
+RetryAfter (flood control) приостанавливает всю рассылку на указанное время.
+
+Итог по каждому получателю передаётся в необязательный колбэк on_result
+(журнал доставки — broadcast_log.py). stop() прекращает рассылку мягко:
+уже начатые отправки завершаются, остальные получатели остаются без итога.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    CantInitiateConversation,
+    ChatNotFound,
+    RetryAfter,
+    TelegramAPIError,
+    UserDeactivated,
+)
+
+# -------------------------------------------------------------------
+# Настройки рассылки
+# -------------------------------------------------------------------
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+# Telegram допускает ~30 сообщений/с суммарно — держим небольшой запас
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))
+# Не чаще одного сообщения в секунду в один чат
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Сколько получателей прерванного прогона читается из журнала за один запрос
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "1000"))
+
+# Ошибки, после которых повторять отправку бессмысленно
+UNREACHABLE_ERRORS = (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation)
+
+# Итоги доставки одному получателю (on_result)
+SENT = "sent"
+FAILED = "failed"
+UNREACHABLE = "unreachable"
+
+
+class TokenBucket:
+    """
+    Классический token bucket: `rate` токенов в секунду, не более `capacity` в запасе.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """
+        Останавливает выдачу токенов на `seconds` секунд (ответ RetryAfter).
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Запас за время паузы не копится: после неё — не всплеск, а обычная скорость
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """
+    Выдерживает минимальный интервал между сообщениями в один и тот же чат.
+    """
+
+    def __init__(self, interval, max_tracked=100_000):
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self._last_sent = {}
+
+    async def wait(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last_sent[chat_id] = time.monotonic()
+
+        if len(self._last_sent) > self.max_tracked:
+            self._prune()
+
+    def _prune(self):
+        threshold = time.monotonic() - self.interval
+        self._last_sent = {
+            chat_id: ts for chat_id, ts in self._last_sent.items() if ts > threshold
+        }
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    unreachable: int = 0
+    retries: int = 0
+    stopped: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"всего={self.total}, отправлено={self.sent}, ошибок={self.failed}, "
+            f"недоступно={self.unreachable}, повторов={self.retries}, "
+            f"время={self.elapsed:.1f} c, скорость={self.throughput:.1f} сообщ/с"
+            + (" (остановлена)" if self.stopped else "")
+        )
+
+
+async def one_batch(chat_ids):
+    """
+    Готовый список chat_id в формате, который принимает Broadcaster.run.
+    """
+    yield chat_ids
+
+
+class Broadcaster:
+    """
+    Рассылка по пачкам chat_id через пул воркеров.
+
+    `send` — корутина `send(chat_id)`, которая отправляет одно сообщение.
+    `batches` в `run()` — асинхронный итератор списков chat_id.
+    `on_result` — необязательная функция `on_result(chat_id, итог)`, итог — SENT, FAILED или UNREACHABLE.
+    """
+
+    def __init__(self, send,
+                 workers=BROADCAST_WORKERS,
+                 rate=BROADCAST_GLOBAL_RATE,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL,
+                 max_retries=BROADCAST_MAX_RETRIES,
+                 on_result=None):
+        self.send = send
+        self.workers = workers
+        self.max_retries = max_retries
+        self.on_result = on_result
+        self.bucket = TokenBucket(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+        self.stats = BroadcastStats()
+        self.stopping = False
+
+    def stop(self):
+        """
+        Мягкая остановка: новые отправки не начинаются, run() дожидается начатых.
+        """
+        self.stopping = True
+
+    async def run(self, batches):
+        self.stats = BroadcastStats()
+        # Очередь ограничена, чтобы не вычитывать из БД больше, чем успеваем отправить
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        try:
+            async for batch in batches:
+                if self.stopping:
+                    break
+                for chat_id in batch:
+                    self.stats.total += 1
+                    await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.stats.stopped = self.stopping
+            self.stats.elapsed = time.monotonic() - self.stats.started_at
+        return self.stats
+
+    async def _worker(self, queue):
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            if self.stopping:
+                # Остаток очереди просто вычитываем: run() ждёт воркеров
+                continue
+            result = await self._deliver(chat_id)
+            if result is not None and self.on_result is not None:
+                self.on_result(chat_id, result)
+
+    async def _deliver(self, chat_id):
+        """
+        Итог доставки или None, если рассылку остановили раньше.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.per_chat.wait(chat_id)
+            await self.bucket.acquire()
+            if self.stopping:
+                return None
+            try:
+                await self.send(chat_id)
+                self.stats.sent += 1
+                return SENT
+            except RetryAfter as e:
+                self.stats.retries += 1
+                logging.warning(f"Flood control при рассылке, пауза {e.timeout} c")
+                self.bucket.pause(e.timeout)
+            except UNREACHABLE_ERRORS as e:
+                self.stats.unreachable += 1
+                logging.info(f"Чат {chat_id} недоступен: {e}")
+                return UNREACHABLE
+            except TelegramAPIError as e:
+                self.stats.failed += 1
+                logging.error(f"Ошибка отправки в чат {chat_id}: {e}")
+                return FAILED
+            except Exception as e:
+                # Сеть или сбой в send: воркер не должен погибнуть, иначе run() не дождётся очереди
+                self.stats.failed += 1
+                logging.error(f"Сбой отправки в чат {chat_id}: {e!r}")
+                return FAILED
+        self.stats.failed += 1
+        logging.error(f"Не удалось отправить сообщение в чат {chat_id} после {self.max_retries} повторов")
+        return FAILED
@@ -0,0 +1,289 @@
+# broadcast_log.py
+"""
+Журнал рассылок: прогоны (broadcast_runs) и итог доставки каждому получателю
+(broadcast_deliveries).
+
+Получатели прогона записываются со статусом pending в той же транзакции, в
+которой их забирает планировщик (reminders.claim_due_reminders), поэтому после
+остановки или падения бота известно, кому сообщение ещё не ушло. Итоги
+доставки копятся в памяти и записываются одним UPDATE раз в
+BROADCAST_LOG_INTERVAL секунд вместе с heartbeat прогона: упавший процесс
+повторит не больше сообщений, чем успел отправить за этот интервал.
+
+Незавершённый прогон с heartbeat старше BROADCAST_RUN_LEASE (процесс упал) или
+сброшенным heartbeat (бот остановлен штатно, см. stop_broadcasts) забирает
+следующий запуск планировщика с тем же типом прогона (для напоминаний — в той
+же реплике) и досылает pending-получателям.
+
+Недоступные получатели (бот заблокирован, чат удалён) помечаются
+users.is_active = false: планировщик их больше не выбирает, пока пользователь
+снова не нажмёт /start.
+"""
+import asyncio
+import datetime
+import logging
+import os
+
+from sqlalchemy import delete, func, insert, select, text, update
+
+from broadcast import BROADCAST_BATCH_SIZE, UNREACHABLE
+from database import get_async_session, BroadcastDelivery, BroadcastRun, User
+
+BROADCAST_LOG_INTERVAL = float(os.getenv("BROADCAST_LOG_INTERVAL", "1.0"))
+# Прогон без heartbeat дольше этого времени считается прерванным
+BROADCAST_RUN_LEASE = int(os.getenv("BROADCAST_RUN_LEASE", "120"))
+# Сколько ждать завершения начатых отправок при остановке бота
+BROADCAST_DRAIN_TIMEOUT = float(os.getenv("BROADCAST_DRAIN_TIMEOUT", "10"))
+BROADCAST_LOG_RETENTION_DAYS = int(os.getenv("BROADCAST_LOG_RETENTION_DAYS", "7"))
+
+PENDING = "pending"
+EXPIRED = "expired"
+
+_UPDATE_DELIVERIES_SQL = text("""
+    UPDATE broadcast_deliveries AS d SET status = u.status, updated_at = :now
+    FROM unnest(CAST(:chat_ids AS bigint[]), CAST(:statuses AS varchar[])) AS u(chat_id, status)
+    WHERE d.run_id = :run_id AND d.chat_id = u.chat_id
+""")
+
+# Прогоны, которые сейчас идут в этом процессе: Broadcaster -> задача
+_active = {}
+_stopping = False
+
+
+# -------------------------------------------------------------------
+# Прогоны
+# -------------------------------------------------------------------
+async def create_run(session, kind, chat_ids, now=None):
+    """
+    Новый прогон со всеми получателями в статусе pending. Возвращает id прогона.
+    Коммит — на стороне вызывающего (в одной транзакции с выбором получателей).
+    """
+    now = now or datetime.datetime.utcnow()
+    result = await session.execute(
+        insert(BroadcastRun)
+        .values(kind=kind, started_at=now, heartbeat_at=now, total=len(chat_ids))
+        .returning(BroadcastRun.id)
+    )
+    run_id = result.scalar_one()
+    await session.execute(insert(BroadcastDelivery), [
+        {"run_id": run_id, "chat_id": chat_id, "status": PENDING} for chat_id in sorted(set(chat_ids))
+    ])
+    return run_id
+
+
+async def claim_interrupted_run(kind, max_age=None, now=None):
+    """
+    Забирает один прерванный прогон: продлевает его heartbeat и возвращает id
+    или None. Прогоны старше `max_age` секунд не досылаются — оставшиеся
+    получатели помечаются expired, и прогон закрывается.
+    """
+    now = now or datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=BROADCAST_RUN_LEASE)
+    while True:
+        async with get_async_session() as session:
+            candidate = (
+                select(BroadcastRun.id)
+                .where(
+                    BroadcastRun.kind == kind,
+                    BroadcastRun.finished_at.is_(None),
+                    (BroadcastRun.heartbeat_at.is_(None)) | (BroadcastRun.heartbeat_at < stale),
+                )
+                .order_by(BroadcastRun.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            result = await session.execute(
+                update(BroadcastRun).where(BroadcastRun.id == candidate)
+                .values(heartbeat_at=now)
+                .returning(BroadcastRun.id, BroadcastRun.started_at)
+            )
+            run = result.one_or_none()
+            await session.commit()
+        if run is None:
+            return None
+        if max_age is None or run.started_at >= now - datetime.timedelta(seconds=max_age):
+            logging.info(f"Возобновляется прерванная рассылка {kind} #{run.id}")
+            return run.id
+        await finish_run(run.id, expire=True)
+
+
+async def iter_pending(run_id, batch_size=BROADCAST_BATCH_SIZE):
+    """
+    Получатели прогона, которым сообщение ещё не ушло, — пачками для Broadcaster.run.
+    """
+    last = None
+    while True:
+        async with get_async_session() as session:
+            query = (
+                select(BroadcastDelivery.chat_id)
+                .where(BroadcastDelivery.run_id == run_id, BroadcastDelivery.status == PENDING)
+                .order_by(BroadcastDelivery.chat_id)
+                .limit(batch_size)
+            )
+            if last is not None:
+                query = query.where(BroadcastDelivery.chat_id > last)
+            chat_ids = (await session.execute(query)).scalars().all()
+        if not chat_ids:
+            return
+        last = chat_ids[-1]
+        yield chat_ids
+
+
+async def finish_run(run_id, expire=False):
+    """
+    Закрывает прогон: итоги по статусам доставки, очистка старых прогонов.
+    С `expire` оставшиеся pending-получатели помечаются expired.
+    """
+    now = datetime.datetime.utcnow()
+    async with get_async_session() as session:
+        if expire:
+            await session.execute(
+                update(BroadcastDelivery)
+                .where(BroadcastDelivery.run_id == run_id, BroadcastDelivery.status == PENDING)
+                .values(status=EXPIRED, updated_at=now)
+            )
+        result = await session.execute(
+            select(BroadcastDelivery.status, func.count())
+            .where(BroadcastDelivery.run_id == run_id)
+            .group_by(BroadcastDelivery.status)
+        )
+        counts = dict(result.all())
+        await session.execute(
+            update(BroadcastRun).where(BroadcastRun.id == run_id).values(
+                finished_at=now, heartbeat_at=now,
+                **{status: counts.get(status, 0) for status in ("sent", "failed", "unreachable", "expired")},
+            )
+        )
+        # Журнал нужен для досылки и разбора — старые прогоны удаляем (доставки — каскадом)
+        await session.execute(
+            delete(BroadcastRun).where(
+                BroadcastRun.finished_at < now - datetime.timedelta(days=BROADCAST_LOG_RETENTION_DAYS)
+            )
+        )
+        await session.commit()
+
+
+async def release_run(run_id):
+    """
+    Отпускает прогон при остановке бота: следующий запуск сразу его досылает.
+    """
+    async with get_async_session() as session:
+        await session.execute(update(BroadcastRun).where(BroadcastRun.id == run_id).values(heartbeat_at=None))
+        await session.commit()
+
+
+# -------------------------------------------------------------------
+# Запись итогов доставки
+# -------------------------------------------------------------------
+class DeliveryLog:
+    """
+    Буфер итогов доставки прогона; фоновая задача раз в `interval` секунд
+    записывает их одним UPDATE и продлевает heartbeat прогона. on_unreachable
+    вызывается для недоступных получателей, когда is_active = false уже записан.
+    """
+
+    def __init__(self, run_id, on_unreachable=None, interval=BROADCAST_LOG_INTERVAL):
+        self.run_id = run_id
+        self.on_unreachable = on_unreachable
+        self.interval = interval
+        self._pending = {}  # chat_id -> итог
+        self._flusher = None
+
+    def record(self, chat_id, status):
+        self._pending[chat_id] = status
+
+    def start(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                # Итоги остались в буфере — запишутся следующей попыткой
+                logging.error(f"Ошибка записи журнала рассылки #{self.run_id}: {e}")
+
+    async def flush(self):
+        batch, self._pending = self._pending, {}
+        now = datetime.datetime.utcnow()
+        chat_ids = sorted(batch)
+        unreachable = [chat_id for chat_id in chat_ids if batch[chat_id] == UNREACHABLE]
+        try:
+            async with get_async_session() as session:
+                if chat_ids:
+                    await session.execute(_UPDATE_DELIVERIES_SQL, {
+                        "run_id": self.run_id, "now": now,
+                        "chat_ids": chat_ids, "statuses": [batch[chat_id] for chat_id in chat_ids],
+                    })
+                if unreachable:
+                    await session.execute(
+                        update(User).where(User.telegram_id.in_(unreachable), User.is_active)
+                        .values(is_active=False)
+                    )
+                await session.execute(
+                    update(BroadcastRun).where(BroadcastRun.id == self.run_id).values(heartbeat_at=now)
+                )
+                await session.commit()
+        except Exception:
+            # Более свежие итоги, записанные за время запроса, не затираем
+            self._pending = {**batch, **self._pending}
+            raise
+        if self.on_unreachable is not None:
+            # После записи: /start, пришедший раньше, не вернёт пользователя в кэш неактивным
+            for chat_id in unreachable:
+                self.on_unreachable(chat_id)
+
+
+# -------------------------------------------------------------------
+# Прогон целиком и остановка
+# -------------------------------------------------------------------
+async def run_broadcast(broadcaster, run_id, batches, on_unreachable=None):
+    """
+    Рассылка прогона `run_id` с записью итогов в журнал. Прогон закрывается,
+    если дошёл до конца; остановленный (stop_broadcasts) — отпускается для досылки.
+    """
+    log = DeliveryLog(run_id, on_unreachable)
+    broadcaster.on_result = log.record
+    if _stopping:
+        # Бот уже останавливается — прогон сразу отпускается для досылки
+        broadcaster.stop()
+    _active[broadcaster] = asyncio.current_task()
+    log.start()
+    try:
+        stats = await broadcaster.run(batches)
+    finally:
+        _active.pop(broadcaster, None)
+        await log.close()
+    if stats.stopped:
+        await release_run(run_id)
+    else:
+        await finish_run(run_id)
+    return stats
+
+
+async def stop_broadcasts(timeout=BROADCAST_DRAIN_TIMEOUT):
+    """
+    Останавливает рассылки процесса и ждёт, пока начатые отправки завершатся,
+    а итоги запишутся в журнал.
+    """
+    global _stopping
+    _stopping = True
+    if not _active:
+        return
+    for broadcaster in _active:
+        broadcaster.stop()
+    done, pending = await asyncio.wait(list(_active.values()), timeout=timeout)
+    if pending:
+        logging.warning(f"Рассылки не завершились за {timeout} c — оставшиеся получатели будут досланы после рестарта")
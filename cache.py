@@ -0,0 +1,77 @@
+# cache.py
+"""
+Небольшой LRU-кэш с ограничением размера и необязательным TTL.
+"""
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Словарь с вытеснением давно не использованных ключей.
+
+    `maxsize` — максимальное число ключей, `ttl` — время жизни записи в секундах
+    (None — без ограничения). Если задан `max_bytes`, значения — bytes, и кэш
+    вытесняет записи, пока их суммарный размер больше лимита. Считает попадания,
+    промахи и вытеснения.
+    """
+
+    def __init__(self, maxsize, ttl=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _size(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            self.bytes -= self._size(value)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.pop(key)
+        self._data[key] = (value, expires_at)
+        self.bytes += self._size(value)
+        while len(self._data) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.bytes -= self._size(evicted)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= self._size(item[0])
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
@@ -0,0 +1,198 @@
+# charts.py
+"""
+Графики статистики в PNG (/weekly_stats chart, /stats month chart).
+
+Данные берутся из дневных агрегатов habit_rollups (одна выборка на график),
+а рисует matplotlib в отдельном пуле процессов: отрисовка занимает десятки
+миллисекунд CPU и в event loop задерживала бы всех остальных пользователей.
+В пул передаются только списки чисел — соединений с БД воркерам не нужно.
+
+Готовые PNG кэшируются в памяти процесса бота по ключу (пользователь, период,
+интервал дат, версия истории, набор привычек): ключ описывает всё, из чего
+построен график, поэтому запись не бывает устаревшей — новая запись в
+DailyLog меняет версию (log_versions), и старые картинки просто вытесняются.
+Размер кэша ограничен в байтах. Одинаковые запросы, пришедшие во время
+отрисовки, ждут один и тот же результат.
+"""
+import asyncio
+import datetime
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sqlalchemy import select
+
+from analytics import get_log_version
+from cache import LRUCache
+from database import get_async_session, HabitRollup
+from habits import BOOL_SLOTS, NUMBER_SLOTS, padded
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+CHART_CACHE_BYTES = int(os.getenv("CHART_CACHE_BYTES", str(32 * 1024 * 1024)))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "2000"))
+CHART_DPI = 100
+
+_executor = None
+_charts = LRUCache(CHART_CACHE_SIZE, max_bytes=CHART_CACHE_BYTES)
+_rendering = {}
+
+
+# -------------------------------------------------------------------
+# Данные графика (процесс бота)
+# -------------------------------------------------------------------
+async def load_series(session, user_id, habits, date_from, date_to):
+    """
+    Ряды по дням интервала: доля выполненных булевых привычек набора и среднее
+    значение каждой числовой. None — в этот день ответа не было.
+    """
+    result = await session.execute(
+        select(HabitRollup.period_start, HabitRollup.bool_yes, HabitRollup.bool_seen,
+               HabitRollup.num_sum, HabitRollup.num_seen)
+        .where(
+            HabitRollup.user_id == user_id,
+            HabitRollup.period == "day",
+            HabitRollup.period_start >= date_from,
+            HabitRollup.period_start <= date_to,
+        )
+    )
+    rows = result.all()
+    days = (date_to - date_from).days + 1
+    index = np.array([(row.period_start - date_from).days for row in rows], dtype=int)
+
+    bool_slots = [h.slot for h in habits if h.kind == "bool"]
+    numbers = [h for h in habits if h.kind == "number"]
+    yes, seen, sums, counts = (
+        _day_matrix(rows, index, days, column, width)
+        for column, width in (("bool_yes", BOOL_SLOTS), ("bool_seen", BOOL_SLOTS),
+                              ("num_sum", NUMBER_SLOTS), ("num_seen", NUMBER_SLOTS))
+    )
+
+    answered = seen[:, bool_slots].sum(axis=1)
+    adherence = np.divide(yes[:, bool_slots].sum(axis=1), answered, out=np.full(days, np.nan), where=answered > 0)
+    slots = [h.slot for h in numbers]
+    averages = np.divide(sums[:, slots], counts[:, slots], out=np.full((days, len(slots)), np.nan),
+                         where=counts[:, slots] > 0)
+    return {
+        "dates": [date_from + datetime.timedelta(days=i) for i in range(days)],
+        "adherence": _optional(adherence * 100) if bool_slots else None,
+        "numbers": [
+            (f"{habit.label}, {habit.unit}" if habit.unit else habit.label, _optional(averages[:, i]))
+            for i, habit in enumerate(numbers)
+        ],
+        "has_data": bool(rows),
+    }
+
+
+def _day_matrix(rows, index, days, column, width):
+    matrix = np.zeros((days, width))
+    if rows:
+        matrix[index] = [padded(getattr(row, column), width) for row in rows]
+    return matrix
+
+
+def _optional(values):
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+# -------------------------------------------------------------------
+# Отрисовка (процесс пула)
+# -------------------------------------------------------------------
+def render_chart(title, series):
+    """
+    PNG: столбцы — % выполненных привычек по дням, линии — числовые привычки.
+    """
+    import matplotlib.pyplot as plt
+
+    panels = (series["adherence"] is not None) + bool(series["numbers"])
+    fig, axes = plt.subplots(panels, 1, figsize=(8, 2.6 * panels + 0.6), sharex=True, squeeze=False)
+    axes = iter(axes[:, 0])
+    dates = series["dates"]
+    try:
+        fig.suptitle(title)
+        if series["adherence"] is not None:
+            ax = next(axes)
+            values = [np.nan if v is None else v for v in series["adherence"]]
+            ax.bar(dates, values, color="#4c9f70")
+            ax.set_ylim(0, 100)
+            ax.set_ylabel("Выполнено, %")
+            ax.grid(axis="y", alpha=0.3)
+        if series["numbers"]:
+            ax = next(axes)
+            for label, values in series["numbers"]:
+                ax.plot(dates, [np.nan if v is None else v for v in values], marker="o", label=label)
+            ax.set_ylim(bottom=0)
+            ax.grid(alpha=0.3)
+            ax.legend(loc="upper left", fontsize="small")
+        fig.autofmt_xdate()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=CHART_DPI, bbox_inches="tight")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def _init_worker():
+    # Бэкенд без дисплея и прогрев импорта — первая отрисовка не платит за загрузку matplotlib
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, initializer=_init_worker)
+    return _executor
+
+
+def shutdown_chart_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# -------------------------------------------------------------------
+# Кэш
+# -------------------------------------------------------------------
+async def _render(key, user_id, habits, date_from, date_to, title):
+    async with get_async_session() as session:
+        series = await load_series(session, user_id, habits, date_from, date_to)
+    if not series["has_data"]:
+        return None
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(_get_executor(), render_chart, title, series)
+    _charts.set(key, png)
+    return png
+
+
+async def get_chart(user_id, habits, period, date_from, date_to, title):
+    """
+    PNG графика за интервал дат или None, если данных за интервал нет.
+    """
+    async with get_async_session() as session:
+        version = await get_log_version(session, user_id)
+    # Набор привычек — полным списком ключей: короткий fingerprint кнопок даёт коллизии
+    key = (user_id, period, date_from, date_to, version, tuple(h.key for h in habits))
+    png = _charts.get(key)
+    if png is not None:
+        return png
+    pending = _rendering.get(key)
+    if pending is None:
+        pending = _rendering[key] = asyncio.ensure_future(_render(key, user_id, habits, date_from, date_to, title))
+        pending.add_done_callback(lambda _: _rendering.pop(key, None))
+    # Отмена одного ожидающего (например, при остановке) не отменяет общую отрисовку
+    return await asyncio.shield(pending)
+
+
+def cache_stats():
+    return {
+        "size": len(_charts),
+        "bytes": _charts.bytes,
+        "max_bytes": _charts.max_bytes,
+        "hits": _charts.hits,
+        "misses": _charts.misses,
+        "evictions": _charts.evictions,
+        "rendering": len(_rendering),
+    }
@@ -1,7 +1,9 @@
 # database.py
 import os
 import datetime
-from sqlalchemy import create_engine, Column, Integer, Boolean, Float, Date, DateTime, String
+from sqlalchemy import create_engine, cast, func, select, text, Boolean, Column, ForeignKey, Index, Integer, BigInteger, Float, Date, DateTime, String, Time
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -10,9 +12,30 @@ DB_NAME = os.getenv("DB_NAME", "mydb")
 DB_USER = os.getenv("DB_USER", "myuser")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "mypassword")
 
+# Пул соединений асинхронного движка: pool_size постоянных + max_overflow временных
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Синхронный движок — только для служебных операций вне event loop (миграции, выгрузки и т.п.)
 engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
+
+# Асинхронный движок — для всех хэндлеров бота
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
@@ -22,30 +45,195 @@ class User(Base):
     __tablename__ = 'users'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(255), nullable=True)  # Можете хранить username
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Напоминание приходит ежедневно в reminder_time по местному времени пользователя
+    timezone = Column(String(64), nullable=False, server_default="Europe/Moscow")
+    reminder_time = Column(Time, nullable=False, server_default=text("'08:00'"))
+    # Следующее напоминание (UTC) — по нему планировщик выбирает, кому пора писать
+    next_reminder_at = Column(DateTime, nullable=True)
+    # Ключи привычек из habits.HABITS; NULL — набор по умолчанию
+    habits = Column(ARRAY(String(64)), nullable=True)
+    # False — бот заблокирован или чат недоступен; снова True после /start
+    is_active = Column(Boolean, nullable=False, server_default=text("true"))
+
+# Планировщику нужны только активные пользователи
+Index("ix_users_next_reminder_at", User.next_reminder_at, postgresql_where=User.is_active)
 
 class DailyLog(Base):
     """
     Таблица для хранения ежедневных данных о привычках.
+    Не больше одной записи на пользователя и дату — повторный ввод обновляет запись.
+    Ответы хранятся по позициям привычек (habits.Habit.slot), а не колонками.
     """
     __tablename__ = "daily_logs"
+    __table_args__ = (
+        Index("uq_daily_logs_user_date", "user_id", "date_of_entry", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    username = Column(String(255), nullable=True)
     date_of_entry = Column(Date, default=datetime.date.today)
-    bedtime_before_midnight = Column(Boolean, default=False)
-    no_gadgets_after_23 = Column(Boolean, default=False)
-    followed_diet = Column(Boolean, default=False)
-    sport_hours = Column(Float, default=0.0)
+    habit_mask = Column(BigInteger, nullable=False, default=0)  # «да» по булевым привычкам
+    answered_mask = Column(BigInteger, nullable=False, default=0)  # на какие булевы привычки был ответ
+    numbers = Column(ARRAY(Float), nullable=False, default=list)  # числовые привычки; NULL — нет ответа
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
-def init_db():
+class HabitRollup(Base):
     """
-    Создание таблиц, если их ещё нет.
+    Предагрегированные данные DailyLog по пользователю и периоду (день, неделя, месяц, год).
+    Обновляются инкрементально при каждой записи DailyLog.
+    Векторы индексируются slot'ами привычек: bool_* — булевы, num_* — числовые.
+    """
+    __tablename__ = "habit_rollups"
+
+    user_id = Column(BigInteger, primary_key=True)
+    period = Column(String(8), primary_key=True)  # day | week | month | year
+    period_start = Column(Date, primary_key=True)
+    entries = Column(Integer, nullable=False, default=0)
+    bool_yes = Column(ARRAY(Integer), nullable=False, default=list)  # ответов «да»
+    bool_seen = Column(ARRAY(Integer), nullable=False, default=list)  # ответов всего
+    num_sum = Column(ARRAY(Float), nullable=False, default=list)  # сумма значений
+    num_seen = Column(ARRAY(Integer), nullable=False, default=list)  # число ответов
+
+class LogVersion(Base):
     """
-    Base.metadata.create_all(engine)
+    Счётчик изменений DailyLog пользователя: растёт с каждой пачкой записей,
+    затронувшей пользователя. По нему кэши производных данных (analytics.py)
+    понимают, что история изменилась, не перечитывая её.
+    """
+    __tablename__ = "log_versions"
+
+    user_id = Column(BigInteger, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class Team(Base):
+    """
+    Команда (группа коучинга): участники видят общий рейтинг /leaderboard.
+    """
+    __tablename__ = "teams"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(64), nullable=False)
+    invite_code = Column(String(16), unique=True, nullable=False)
+    owner_id = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class TeamMember(Base):
+    """
+    Участие в команде: пользователь состоит не больше чем в одной команде.
+    """
+    __tablename__ = "team_members"
+
+    user_id = Column(BigInteger, primary_key=True)
+    team_id = Column(Integer, ForeignKey("teams.id", ondelete="CASCADE"), nullable=False, index=True)
+    joined_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class TeamScore(Base):
+    """
+    Очки участника команды за период (неделя, месяц). Обновляются инкрементально
+    вместе с habit_rollups; индексы по очкам дают топ команды без пересчёта логов.
+    """
+    __tablename__ = "team_scores"
+
+    team_id = Column(Integer, primary_key=True)
+    period = Column(String(8), primary_key=True)  # week | month
+    period_start = Column(Date, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    done = Column(Integer, nullable=False, default=0)  # выполненных привычко-дней («да»)
+    answered = Column(Integer, nullable=False, default=0)  # ответов по булевым привычкам
+    sport_hours = Column(Float, nullable=False, default=0)
+
+# Доля выполненных привычко-дней: answered = 0 бывает только при done = 0
+TEAM_SCORE_RATE = cast(TeamScore.done, Float) / func.greatest(TeamScore.answered, 1)
+
+Index(
+    "ix_team_scores_rate", TeamScore.team_id, TeamScore.period, TeamScore.period_start,
+    TEAM_SCORE_RATE.desc(), TeamScore.done.desc(),
+)
+Index(
+    "ix_team_scores_sport", TeamScore.team_id, TeamScore.period, TeamScore.period_start,
+    TeamScore.sport_hours.desc(), TeamScore.done.desc(),
+)
+
+class BroadcastRun(Base):
+    """
+    Прогон рассылки (например, порция напоминаний за минуту). Незавершённый
+    прогон с устаревшим heartbeat_at — прерванный, его досылает следующий запуск.
+    """
+    __tablename__ = "broadcast_runs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(32), nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    heartbeat_at = Column(DateTime, nullable=True)  # NULL — прогон отпущен при остановке бота
+    finished_at = Column(DateTime, nullable=True)
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    unreachable = Column(Integer, nullable=False, default=0)
+    expired = Column(Integer, nullable=False, default=0)
+
+Index(
+    "ix_broadcast_runs_unfinished", BroadcastRun.kind, BroadcastRun.id,
+    postgresql_where=BroadcastRun.finished_at.is_(None),
+)
+
+class BroadcastDelivery(Base):
+    """
+    Статус доставки прогона одному получателю: pending | sent | failed | unreachable | expired.
+    """
+    __tablename__ = "broadcast_deliveries"
+
+    run_id = Column(Integer, ForeignKey("broadcast_runs.id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    status = Column(String(16), nullable=False, default="pending")
+    updated_at = Column(DateTime, nullable=True)
+
+Index(
+    "ix_broadcast_deliveries_pending", BroadcastDelivery.run_id, BroadcastDelivery.chat_id,
+    postgresql_where=BroadcastDelivery.status == "pending",
+)
+
+class FSMRecord(Base):
+    """
+    Состояния FSM (диалоги опроса), чтобы они переживали рестарт и были общими для реплик.
+    """
+    __tablename__ = "fsm_states"
+
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    state = Column(String(255), nullable=True)
+    data = Column(JSONB, nullable=False, default=dict)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
 
 def get_session():
-    return SessionLocal()
\ No newline at end of file
+    return SessionLocal()
+
+def get_async_session():
+    """
+    Асинхронная сессия: `async with get_async_session() as session: ...`
+    """
+    return AsyncSessionLocal()
+
+async def fetch_user_batch(after_id=0, limit=1000):
+    """
+    Keyset-пагинация активных пользователей: следующая пачка (id, telegram_id) с id > after_id.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(
+            select(User.id, User.telegram_id)
+            .where(User.id > after_id, User.is_active)
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return result.all()
+
+async def dispose_engines():
+    """
+    Закрытие пулов соединений при остановке бота.
+    """
+    await async_engine.dispose()
+    engine.dispose()
@@ -0,0 +1,206 @@
+# export.py
+"""
+Потоковая выгрузка DailyLog пользователя в xlsx / csv / parquet.
+
+Строки читаются серверным курсором пачками и сразу пишутся в файл (openpyxl
+в write-only режиме), поэтому память не зависит от длины истории. Колонки —
+привычки, по которым у пользователя есть ответы; маски и массивы пачки
+раскладываются в колонки векторно (numpy). Выгрузка
+выполняется в отдельном процессе пула, чтобы не блокировать event loop бота.
+Результат — временный файл; после отправки его нужно удалить.
+"""
+import asyncio
+import csv
+import datetime
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from openpyxl import Workbook
+from sqlalchemy import func, select
+
+from database import engine, get_session, DailyLog
+from habits import HABITS, bits, number_matrix
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
+_executor = None
+
+
+def export_habits(session, user_id):
+    """
+    Привычки, по которым у пользователя есть хотя бы один ответ (в порядке реестра).
+    """
+    answered, present = session.execute(
+        select(func.bit_or(DailyLog.answered_mask), func.habit_array_sum(func.habit_present(DailyLog.numbers)))
+        .where(DailyLog.user_id == user_id)
+    ).one()
+    answered, present = answered or 0, present or []
+    return [
+        habit for habit in HABITS
+        if (answered >> habit.slot & 1 if habit.kind == "bool"
+            else habit.slot < len(present) and present[habit.slot])
+    ]
+
+
+def export_header(habits):
+    return ["ID", "Дата", *(habit.label for habit in habits), "Дата записи (UTC)"]
+
+
+def _habit_columns(chunk, habits):
+    """
+    Колонки привычек для пачки строк: «Да»/«Нет»/число, пусто — ответа не было.
+    """
+    answered = bits([row.answered_mask for row in chunk])
+    yes = bits([row.habit_mask for row in chunk])
+    numbers = number_matrix([row.numbers for row in chunk])
+    columns = []
+    for habit in habits:
+        if habit.kind == "bool":
+            column = np.where(answered[:, habit.slot] == 1, np.where(yes[:, habit.slot] == 1, "Да", "Нет"), "")
+        else:
+            values = numbers[:, habit.slot]
+            column = np.where(np.isnan(values), "", values.astype(str))
+        columns.append(column.tolist())
+    return columns
+
+
+def iter_export_rows(user_id, habits, fetch_size=EXPORT_FETCH_SIZE):
+    """
+    Строки выгрузки, прочитанные серверным курсором пачками по fetch_size.
+    """
+    session = get_session()
+    try:
+        stmt = (
+            select(
+                DailyLog.id,
+                DailyLog.date_of_entry,
+                DailyLog.habit_mask,
+                DailyLog.answered_mask,
+                DailyLog.numbers,
+                DailyLog.created_at,
+            )
+            .where(DailyLog.user_id == user_id)
+            .order_by(DailyLog.date_of_entry, DailyLog.id)
+            .execution_options(stream_results=True, yield_per=fetch_size)
+        )
+        for chunk in session.execute(stmt).partitions():
+            columns = _habit_columns(chunk, habits)
+            for i, log in enumerate(chunk):
+                yield [
+                    log.id,
+                    log.date_of_entry.strftime("%Y-%m-%d"),
+                    *(column[i] for column in columns),
+                    log.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                ]
+    finally:
+        session.close()
+
+
+def _write_xlsx(header, rows, path):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Habit Logs")
+    ws.append(header)
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(path)
+    return count
+
+
+def _write_csv(header, rows, path):
+    # utf-8-sig — чтобы Excel корректно открыл кириллицу
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _write_parquet(header, rows, path, chunk_size=EXPORT_FETCH_SIZE):
+    # pyarrow тяжёлый — импортируется только при выгрузке в parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(name, pa.string()) for name in header])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        chunk = []
+        for row in rows:
+            chunk.append([str(value) for value in row])
+            if len(chunk) >= chunk_size:
+                writer.write_table(pa.Table.from_pylist([dict(zip(header, r)) for r in chunk], schema=schema))
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pylist([dict(zip(header, r)) for r in chunk], schema=schema))
+            count += len(chunk)
+    return count
+
+
+WRITERS = {
+    "xlsx": _write_xlsx,
+    "csv": _write_csv,
+    "parquet": _write_parquet,
+}
+
+
+def build_export(user_id, fmt="xlsx"):
+    """
+    Пишет выгрузку во временный файл. Возвращает путь или None, если данных нет.
+    Выполняется в процессе пула.
+    """
+    with get_session() as session:
+        habits = export_habits(session, user_id)
+    fd, path = tempfile.mkstemp(prefix=f"export_{user_id}_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = WRITERS[fmt](export_header(habits), iter_export_rows(user_id, habits), path)
+    except BaseException:
+        os.remove(path)
+        raise
+    if not count:
+        os.remove(path)
+        return None
+    return path
+
+
+def _init_worker():
+    # Соединения пула, унаследованные от родителя при fork, не трогаем и не закрываем
+    engine.dispose(close=False)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, initializer=_init_worker)
+    return _executor
+
+
+async def export_user_logs(user_id, fmt="xlsx"):
+    """
+    Асинхронная обёртка: выгрузка в пуле процессов, результат — путь к файлу или None.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), build_export, user_id, fmt)
+
+
+def export_filename(user_id, fmt):
+    return f"export_{user_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+
+
+def shutdown_export_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,296 @@
+# fsm_storage.py
+"""
+Хранилище состояний FSM в Postgres.
+
+Записи кэшируются в процессе (LRU), изменения сначала попадают в кэш и в буфер
+«грязных» записей, а в БД уходят пачками фоновой задачей — без обращения к
+Postgres на каждое сообщение. Брошенные диалоги истекают через FSM_STATE_TTL.
+
+Кэш и буфер верны, только пока состояние чата меняет один процесс. Поэтому при
+нескольких репликах (BOT_REPLICAS) каждый чат закреплён за одной из них —
+chat_owner(chat_id): webhook.py пересылает апдейты чужих чатов реплике-владельцу,
+а напоминания (reminders.py) реплика рассылает только своим чатам. БД при этом
+нужна для рестартов и пересылки между репликами, а не для согласования кэшей.
+Число реплик меняют одновременным перезапуском всех реплик.
+
+Выбор хранилища — переменная окружения FSM_STORAGE: "postgres" (по умолчанию)
+или "memory".
+"""
+import asyncio
+import copy
+import datetime
+import logging
+import os
+import typing
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import LRUCache
+from database import get_async_session, FSMRecord
+from metrics import count_fsm_transition, set_query_source
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "50000"))
+# Сколько секунд запись в кэше считается актуальной; 0 — кэш выключен
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "60"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_FLUSH_BATCH = int(os.getenv("FSM_FLUSH_BATCH", "500"))
+# Брошенные диалоги удаляются через сутки
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 60 * 60)))
+FSM_PURGE_INTERVAL = float(os.getenv("FSM_PURGE_INTERVAL", "600"))
+
+# Реплики бота: реплика BOT_REPLICA_INDEX (с 0) обслуживает чаты, для которых
+# chat_owner(chat_id) == BOT_REPLICA_INDEX
+BOT_REPLICAS = int(os.getenv("BOT_REPLICAS", "1"))
+BOT_REPLICA_INDEX = int(os.getenv("BOT_REPLICA_INDEX", "0"))
+if not 0 <= BOT_REPLICA_INDEX < BOT_REPLICAS:
+    raise ValueError(f"BOT_REPLICA_INDEX должен быть от 0 до {BOT_REPLICAS - 1}")
+
+_EMPTY = {"state": None, "data": {}}
+_MISSING = object()
+
+
+def chat_owner(chat_id):
+    """
+    Номер реплики, за которой закреплён чат.
+    """
+    return int(chat_id) % BOT_REPLICAS
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM-хранилище с кэшем и пакетной записью в таблицу fsm_states.
+    """
+
+    def __init__(self,
+                 cache_size=FSM_CACHE_SIZE,
+                 cache_ttl=FSM_CACHE_TTL,
+                 flush_interval=FSM_FLUSH_INTERVAL,
+                 flush_batch=FSM_FLUSH_BATCH,
+                 state_ttl=FSM_STATE_TTL,
+                 purge_interval=FSM_PURGE_INTERVAL):
+        self._cache = LRUCache(cache_size, ttl=cache_ttl) if cache_ttl > 0 else None
+        # Изменённые, но ещё не записанные в БД записи. Держим их отдельно от кэша,
+        # чтобы вытеснение из LRU не теряло изменения.
+        self._dirty = {}
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.state_ttl = state_ttl
+        self.purge_interval = purge_interval
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._closed = False
+
+    # ---------------------------------------------------------------
+    # Чтение / запись записи (chat, user)
+    # ---------------------------------------------------------------
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _load(self, key):
+        record = self._dirty.get(key, _MISSING)
+        if record is not _MISSING:
+            return record
+        if self._cache is not None:
+            record = self._cache.get(key, _MISSING)
+            if record is not _MISSING:
+                return record
+
+        chat_id, user_id = key
+        expires_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.state_ttl)
+        async with get_async_session() as session:
+            result = await session.execute(
+                select(FSMRecord.state, FSMRecord.data).where(
+                    FSMRecord.chat_id == chat_id,
+                    FSMRecord.user_id == user_id,
+                    FSMRecord.updated_at >= expires_before,
+                )
+            )
+            row = result.first()
+        # Кэшируем и отсутствие записи — большинство апдейтов приходит вне диалога
+        record = {"state": row.state, "data": row.data or {}} if row else _EMPTY
+        if self._cache is not None:
+            self._cache.set(key, record)
+        return record
+
+    def _store(self, key, record, previous):
+        count_fsm_transition(previous["state"], record["state"])
+        if self._cache is not None:
+            self._cache.set(key, record)
+        self._dirty[key] = record
+        self._ensure_flusher()
+        if len(self._dirty) >= self.flush_batch:
+            self._flush_requested.set()
+
+    # ---------------------------------------------------------------
+    # Интерфейс BaseStorage
+    # ---------------------------------------------------------------
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._load(self._key(chat, user))
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._load(self._key(chat, user))
+        return copy.deepcopy(record["data"] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, {"state": self.resolve_state(state), "data": record["data"]}, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, {"state": record["state"], "data": copy.deepcopy(data or {})}, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        new_data = copy.deepcopy(record["data"])
+        new_data.update(data or {}, **kwargs)
+        self._store(key, {"state": record["state"], "data": new_data}, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, _EMPTY if with_data else {"state": None, "data": record["data"]}, record)
+
+    async def close(self):
+        self._closed = True
+        if self._flusher is not None:
+            self._flush_requested.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    # ---------------------------------------------------------------
+    # Фоновая запись в БД
+    # ---------------------------------------------------------------
+    def _ensure_flusher(self):
+        if self._flusher is None and not self._closed:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        set_query_source("fsm_flush")
+        loop = asyncio.get_running_loop()
+        next_purge = loop.time() + self.purge_interval
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+
+            try:
+                await self.flush()
+                if loop.time() >= next_purge:
+                    await self.purge_expired()
+                    next_purge = loop.time() + self.purge_interval
+            except Exception as e:
+                logging.error(f"Ошибка записи состояний FSM в БД: {e}")
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения одной пачкой: пустые записи удаляются,
+        остальные — upsert.
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+
+            now = datetime.datetime.utcnow()
+            to_delete = [key for key, record in batch.items() if record["state"] is None and not record["data"]]
+            to_upsert = [
+                {"chat_id": key[0], "user_id": key[1], "state": record["state"],
+                 "data": record["data"], "updated_at": now}
+                for key, record in batch.items()
+                if record["state"] is not None or record["data"]
+            ]
+
+            try:
+                async with get_async_session() as session:
+                    if to_delete:
+                        await session.execute(
+                            delete(FSMRecord).where(tuple_(FSMRecord.chat_id, FSMRecord.user_id).in_(to_delete))
+                        )
+                    if to_upsert:
+                        stmt = insert(FSMRecord).values(to_upsert)
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[FSMRecord.chat_id, FSMRecord.user_id],
+                            set_={
+                                "state": stmt.excluded.state,
+                                "data": stmt.excluded.data,
+                                "updated_at": stmt.excluded.updated_at,
+                            },
+                        )
+                        await session.execute(stmt)
+                    await session.commit()
+            except Exception:
+                # Возвращаем несохранённое в буфер, не затирая более свежие изменения
+                for key, record in batch.items():
+                    self._dirty.setdefault(key, record)
+                raise
+
+    async def purge_expired(self):
+        """
+        Удаляет брошенные диалоги старше state_ttl.
+        """
+        expires_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.state_ttl)
+        async with get_async_session() as session:
+            result = await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < expires_before))
+            await session.commit()
+        if result.rowcount:
+            logging.info(f"Удалено просроченных состояний FSM: {result.rowcount}")
+
+
+class CountingMemoryStorage(MemoryStorage):
+    """
+    MemoryStorage с подсчётом переходов FSM (как у PostgresStorage).
+    """
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        before = await self.get_state(chat=chat, user=user)
+        await super().set_state(chat=chat, user=user, state=state)
+        count_fsm_transition(before, self.resolve_state(state))
+
+
+def create_storage(kind=FSM_STORAGE):
+    """
+    Создаёт FSM-хранилище по имени: "postgres" или "memory".
+    """
+    if kind == "postgres":
+        return PostgresStorage()
+    if kind == "memory":
+        return CountingMemoryStorage()
+    raise ValueError(f"Неизвестный тип FSM-хранилища: {kind}")
@@ -0,0 +1,242 @@
+# habits.py
+"""
+Реестр привычек и наборы привычек пользователей.
+
+Привычка описывается данными (Habit) и хранится не отдельной колонкой, а
+позицией в компактных полях записи DailyLog:
+
+  * булевы привычки — биты habit_mask («да») и answered_mask (был ли ответ);
+  * числовые — элементы массива numbers (NULL — ответа не было).
+
+Позиция (slot) закреплена за привычкой навсегда: новая привычка — новая строка
+в HABITS со следующим свободным slot, без миграций и нового кода хэндлеров.
+Булевых привычек может быть до 63 (BIGINT), числовых — сколько угодно.
+
+Набор привычек пользователя — users.habits (NULL — набор по умолчанию),
+меняется командой /habits. Агрегаты (habit_rollups) и статистика хранятся и
+считаются векторами той же раскладки.
+"""
+import os
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+from sqlalchemy import select, update
+
+from cache import LRUCache
+from database import get_async_session, User
+
+USER_HABITS_CACHE_SIZE = int(os.getenv("USER_HABITS_CACHE_SIZE", "10000"))
+# Реплики не оповещают друг друга о смене набора — запись живёт недолго
+USER_HABITS_CACHE_TTL = float(os.getenv("USER_HABITS_CACHE_TTL", "60"))
+
+MAX_BOOL_SLOTS = 63
+
+
+@dataclass(frozen=True)
+class Habit:
+    key: str
+    kind: str  # bool | number
+    slot: int  # бит в habit_mask (bool) или индекс в numbers (number); не меняется
+    question: str  # вопрос; {day} — «вчера» или дата
+    label: str  # подпись на кнопках, в статистике и выгрузке
+    invert: bool = False  # ответ «да» на вопрос сохраняется как False
+    choices: tuple = ()  # варианты для компактного опроса (number)
+    unit: str = ""
+    default: bool = True  # входит в набор новых пользователей
+
+
+HABITS = (
+    Habit("bedtime_before_midnight", "bool", 0, "Легли ли вы {day} до 00:00? (да/нет)", "Лёг до 00:00"),
+    Habit(
+        "no_gadgets_after_23", "bool", 1, "Использовали ли вы {day} гаджеты после 23:00? (да/нет)",
+        "Без гаджетов после 23:00", invert=True,
+    ),
+    Habit("followed_diet", "bool", 2, "Питались ли вы {day} по рациону? (да/нет)", "Питание по рациону"),
+    Habit(
+        "sport_hours", "number", 0, "Сколько часов вы {day} занимались спортом? (введите число)", "Спорт",
+        choices=(0, 0.5, 1, 1.5, 2, 3), unit="ч",
+    ),
+    Habit("water", "bool", 3, "Выпили ли вы {day} 2 литра воды? (да/нет)", "2 л воды", default=False),
+    Habit("meditation", "bool", 4, "Медитировали ли вы {day}? (да/нет)", "Медитация", default=False),
+    Habit("reading", "bool", 5, "Читали ли вы {day} хотя бы 20 минут? (да/нет)", "Чтение 20 минут", default=False),
+    Habit(
+        "sleep_hours", "number", 1, "Сколько часов вы спали {day}? (введите число)", "Сон",
+        choices=(5, 6, 7, 8, 9), unit="ч", default=False,
+    ),
+    Habit(
+        "steps", "number", 2, "Сколько тысяч шагов вы {day} прошли? (введите число)", "Шаги",
+        choices=(0, 3, 5, 8, 10, 15), unit="тыс.", default=False,
+    ),
+)
+
+BY_KEY = {habit.key: habit for habit in HABITS}
+BOOL_HABITS = tuple(h for h in HABITS if h.kind == "bool")
+NUMBER_HABITS = tuple(h for h in HABITS if h.kind == "number")
+# Длины векторов в агрегатах
+BOOL_SLOTS = max((h.slot for h in BOOL_HABITS), default=-1) + 1
+NUMBER_SLOTS = max((h.slot for h in NUMBER_HABITS), default=-1) + 1
+DEFAULT_HABITS = tuple(h for h in HABITS if h.default)
+
+
+def _check_registry():
+    assert len(BY_KEY) == len(HABITS), "Повторяющиеся ключи привычек"
+    for kind in ("bool", "number"):
+        slots = [h.slot for h in HABITS if h.kind == kind]
+        assert len(set(slots)) == len(slots), f"Повторяющиеся slot у привычек {kind}"
+    assert BOOL_SLOTS <= MAX_BOOL_SLOTS, f"Булевых привычек больше {MAX_BOOL_SLOTS}"
+
+
+_check_registry()
+
+
+def resolve(keys):
+    """
+    Привычки по списку ключей в порядке реестра; None — набор по умолчанию.
+    Неизвестные ключи (привычку убрали из реестра) пропускаются.
+    """
+    if keys is None:
+        return DEFAULT_HABITS
+    keys = set(keys)
+    return tuple(h for h in HABITS if h.key in keys)
+
+
+def fingerprint(habits):
+    """
+    Короткий отпечаток набора — чтобы отличить кнопки, созданные для другого набора.
+    """
+    return f"{zlib.crc32(','.join(h.key for h in habits).encode()) & 0xff:02x}"
+
+
+# -------------------------------------------------------------------
+# Упаковка ответов
+# -------------------------------------------------------------------
+def pack(values):
+    """
+    {ключ привычки: значение} -> (habit_mask, answered_mask, numbers).
+    Привычки без ответа в `values` не отмечаются.
+    """
+    habit_mask = answered_mask = 0
+    numbers = [None] * NUMBER_SLOTS
+    for key, value in values.items():
+        habit = BY_KEY[key]
+        if habit.kind == "bool":
+            answered_mask |= 1 << habit.slot
+            if value:
+                habit_mask |= 1 << habit.slot
+        elif value is not None:
+            numbers[habit.slot] = float(value)
+    while numbers and numbers[-1] is None:
+        numbers.pop()
+    return habit_mask, answered_mask, numbers
+
+
+def unpack(habit_mask, answered_mask, numbers):
+    """
+    Обратное к pack: только привычки, на которые был ответ.
+    """
+    values = {}
+    for habit in BOOL_HABITS:
+        if answered_mask >> habit.slot & 1:
+            values[habit.key] = bool(habit_mask >> habit.slot & 1)
+    numbers = numbers or []
+    for habit in NUMBER_HABITS:
+        if habit.slot < len(numbers) and numbers[habit.slot] is not None:
+            values[habit.key] = numbers[habit.slot]
+    return values
+
+
+# -------------------------------------------------------------------
+# Векторные операции (агрегаты, статистика, выгрузка)
+# -------------------------------------------------------------------
+def bits(masks, width=BOOL_SLOTS):
+    """
+    Матрица 0/1 (строки × width) из массива битовых масок.
+    """
+    masks = np.asarray(masks, dtype=np.int64).reshape(-1, 1)
+    return ((masks >> np.arange(width, dtype=np.int64)) & 1).astype(np.int32)
+
+
+def number_matrix(rows, width=NUMBER_SLOTS):
+    """
+    Матрица float (строки × width) из списков numbers; NaN — нет ответа.
+    """
+    matrix = np.full((len(rows), width), np.nan)
+    for i, row in enumerate(rows):
+        if row:
+            values = np.array(row[:width], dtype=float)  # None -> nan
+            matrix[i, :len(values)] = values
+    return matrix
+
+
+def padded(vector, width, dtype=float):
+    """
+    Вектор агрегата нужной длины (в старых строках привычек могло быть меньше).
+    """
+    result = np.zeros(width, dtype=dtype)
+    if vector:
+        values = np.asarray(vector[:width], dtype=dtype)
+        result[:len(values)] = values
+    return result
+
+
+def stats_lines(totals):
+    """
+    Строки статистики по агрегату (entries, bool_yes, bool_seen, num_sum, num_seen):
+    только привычки, по которым есть ответы.
+    """
+    yes = padded(totals.bool_yes, BOOL_SLOTS, int)
+    seen = padded(totals.bool_seen, BOOL_SLOTS, int)
+    sums = padded(totals.num_sum, NUMBER_SLOTS)
+    counts = padded(totals.num_seen, NUMBER_SLOTS, int)
+    averages = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+    lines = []
+    for habit in HABITS:
+        if habit.kind == "bool" and seen[habit.slot]:
+            lines.append(f"{habit.label}: {yes[habit.slot]} из {seen[habit.slot]}")
+        elif habit.kind == "number" and counts[habit.slot]:
+            lines.append(f"{habit.label}: в среднем {averages[habit.slot]:.2f} {habit.unit}/день")
+    return [f"{i}) {line}" for i, line in enumerate(lines, 1)]
+
+
+# -------------------------------------------------------------------
+# Наборы привычек пользователей
+# -------------------------------------------------------------------
+_user_habits = LRUCache(USER_HABITS_CACHE_SIZE, ttl=USER_HABITS_CACHE_TTL)
+
+
+async def get_user_habits(telegram_id):
+    """
+    Привычки пользователя в порядке реестра (кэшируются на USER_HABITS_CACHE_TTL секунд).
+    """
+    habits = _user_habits.get(telegram_id)
+    if habits is None:
+        async with get_async_session() as session:
+            result = await session.execute(select(User.habits).where(User.telegram_id == telegram_id))
+            habits = resolve(result.scalar_one_or_none())
+        _user_habits.set(telegram_id, habits)
+    return habits
+
+
+def cache_user_habits(telegram_id, keys):
+    """
+    Кладёт в кэш набор, прочитанный вместе с другими данными (users.habits),
+    чтобы get_user_habits не делал отдельного запроса.
+    """
+    _user_habits.set(telegram_id, resolve(keys))
+
+
+async def set_user_habits(telegram_id, habits):
+    """
+    Сохраняет набор привычек. Возвращает False, если пользователь не найден.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(
+            update(User).where(User.telegram_id == telegram_id).values(habits=[h.key for h in habits])
+        )
+        await session.commit()
+    if not result.rowcount:
+        return False
+    _user_habits.set(telegram_id, tuple(habits))
+    return True
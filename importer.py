@@ -0,0 +1,295 @@
+# importer.py
+"""
+Загрузка истории DailyLog из xlsx / csv (формат /export_excel).
+
+Файл читается потоково (openpyxl в read-only режиме, csv построчно) пачками
+по IMPORT_BATCH_SIZE строк; разбор пачки идёт в пуле потоков, чтобы не
+держать event loop. Каждая строка проверяется по реестру привычек, ошибочные
+строки пропускаются и попадают в отчёт. Пачка сохраняется через
+logbook.save_daily_logs — тем же upsert'ом, что и опросы, поэтому агрегаты,
+очки команд и версия истории обновляются вместе с логами, а повторная загрузка
+того же файла ничего не меняет.
+
+Колонки: «Дата» и привычки (подпись из реестра, как в выгрузке, ключ
+привычки или заголовок старой выгрузки до реестра привычек). «ID» и «Дата
+записи (UTC)» выгрузки игнорируются. Булевы значения — Да/Нет, числовые —
+число; пустая ячейка — ответа не было.
+
+Админская загрузка:
+    python importer.py <telegram_id> <файл.xlsx|файл.csv> [--username NAME] [--dry-run]
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import itertools
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+
+from openpyxl import load_workbook
+
+from database import get_async_session, dispose_engines
+from habits import BY_KEY, HABITS
+from logbook import save_daily_logs
+from metrics import set_query_source
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+# Лимит Telegram на скачивание файлов ботом — 20 МБ
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+IMPORT_FORMATS = ("xlsx", "csv")
+# Сколько ошибок строк хранить в отчёте (остальные только считаются)
+IMPORT_MAX_ERRORS = 20
+IMPORT_MIN_DATE = datetime.date(2000, 1, 1)
+
+DATE_COLUMNS = ("дата", "date", "date_of_entry")
+IGNORED_COLUMNS = ("id", "дата записи (utc)", "created_at")
+_TRUE = ("да", "yes", "true", "1", "+")
+_FALSE = ("нет", "no", "false", "0", "-")
+# Заголовки старой выгрузки /export_excel, у которых подпись с тех пор сменилась
+LEGACY_COLUMNS = {
+    "Не использовал гаджеты после 23:00": "no_gadgets_after_23",
+    "Питался по рациону": "followed_diet",
+    "Часы спорта": "sport_hours",
+}
+_HABIT_COLUMNS = {
+    **{name.lower(): habit for habit in HABITS for name in (habit.label, habit.key)},
+    **{name.lower(): BY_KEY[key] for name, key in LEGACY_COLUMNS.items()},
+}
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0  # прочитано строк данных
+    imported: int = 0  # сохранено (новые + обновлённые)
+    created: int = 0
+    skipped: int = 0  # строки с ошибками и пустые
+    errors: list = field(default_factory=list)  # (номер строки файла, текст ошибки)
+    unknown_columns: list = field(default_factory=list)
+
+    def add_error(self, line, error):
+        self.skipped += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append((line, error))
+
+
+# -------------------------------------------------------------------
+# Чтение файла
+# -------------------------------------------------------------------
+def file_format(path):
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError("Поддерживаются файлы .xlsx и .csv")
+    return fmt
+
+
+def read_rows(path):
+    """
+    Строки файла (кортежи значений) по одной; файл целиком в память не читается.
+    """
+    if file_format(path) == "xlsx":
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from wb.worksheets[0].iter_rows(values_only=True)
+        finally:
+            wb.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.reader(f)
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_header(row):
+    """
+    (индекс колонки даты, [(индекс, привычка)], нераспознанные колонки) или ValueError.
+    """
+    date_index, columns, unknown = None, [], []
+    for index, name in enumerate(row):
+        if _is_empty(name):
+            continue
+        name = str(name).strip()
+        key = name.lower()
+        if key in DATE_COLUMNS:
+            date_index = index
+        elif key in _HABIT_COLUMNS:
+            columns.append((index, _HABIT_COLUMNS[key]))
+        elif key not in IGNORED_COLUMNS:
+            unknown.append(name)
+    if date_index is None:
+        raise ValueError("В первой строке нет колонки «Дата»")
+    if not columns:
+        raise ValueError("В первой строке нет ни одной колонки привычек")
+    return date_index, columns, unknown
+
+
+def parse_date(value, today):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    elif not isinstance(value, datetime.date):
+        try:
+            value = datetime.datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError(f"дата «{value}» не в формате ГГГГ-ММ-ДД") from None
+    if not IMPORT_MIN_DATE <= value <= today:
+        raise ValueError(f"дата {value} вне диапазона {IMPORT_MIN_DATE} — {today}")
+    return value
+
+
+def parse_value(habit, value):
+    """
+    Значение ячейки для привычки (None — ответа нет) или ValueError.
+    """
+    # Старая выгрузка писала отсутствующее число как str(None)
+    if _is_empty(value) or (isinstance(value, str) and value.strip() == "None"):
+        return None
+    if habit.kind == "bool":
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in _TRUE:
+            return True
+        if text in _FALSE:
+            return False
+        raise ValueError(f"{habit.label}: ожидается Да/Нет, получено «{value}»")
+    try:
+        number = float(str(value).replace(",", ".")) if not isinstance(value, (int, float)) else float(value)
+    except ValueError:
+        raise ValueError(f"{habit.label}: ожидается число, получено «{value}»") from None
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"{habit.label}: недопустимое значение {value}")
+    return number
+
+
+def parse_row(row, date_index, columns, today):
+    """
+    (дата, {ключ привычки: значение}) или ValueError для строки с ошибкой.
+    """
+    cell = row[date_index] if date_index < len(row) else None
+    if _is_empty(cell):
+        raise ValueError("не указана дата")
+    date = parse_date(cell, today)
+    values = {}
+    for index, habit in columns:
+        value = parse_value(habit, row[index] if index < len(row) else None)
+        if value is not None:
+            values[habit.key] = value
+    if not values:
+        raise ValueError("нет ни одного ответа")
+    return date, values
+
+
+def parse_batch(rows, start_line, header, today, report):
+    """
+    Проверяет пачку строк; возвращает [(дата, значения)] для сохранения.
+    Пустые строки пропускаются молча.
+    """
+    date_index, columns, _ = header
+    entries = []
+    for line, row in enumerate(rows, start_line):
+        if all(_is_empty(value) for value in row):
+            continue
+        report.rows += 1
+        try:
+            entries.append(parse_row(row, date_index, columns, today))
+        except ValueError as e:
+            report.add_error(line, str(e))
+    return entries
+
+
+# -------------------------------------------------------------------
+# Загрузка
+# -------------------------------------------------------------------
+async def import_file(user_id, path, username=None, progress=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    """
+    Загружает файл в историю пользователя. `progress` — необязательная корутина
+    progress(report), вызывается после каждой пачки. Ошибка в заголовке —
+    ValueError; ошибочные строки пропускаются и попадают в отчёт.
+    """
+    set_query_source("import")
+    loop = asyncio.get_running_loop()
+    today = datetime.date.today()
+    report = ImportReport()
+    rows = read_rows(path)
+
+    def next_chunk():
+        return list(itertools.islice(rows, batch_size))
+
+    try:
+        first = await loop.run_in_executor(None, next_chunk)
+        if not first:
+            raise ValueError("Файл пустой")
+        header = parse_header(first[0])
+        report.unknown_columns = header[2]
+        chunk, line = first[1:], 2
+        while chunk:
+            entries = await loop.run_in_executor(None, parse_batch, chunk, line, header, today, report)
+            line += len(chunk)
+            if entries and not dry_run:
+                async with get_async_session() as session:
+                    created = await save_daily_logs(session, [
+                        {"user_id": user_id, "date_of_entry": date, "values": values, "username": username}
+                        for date, values in entries
+                    ])
+                    await session.commit()
+                report.created += sum(created)
+            report.imported += len(entries)
+            if progress is not None:
+                await progress(report)
+            chunk = await loop.run_in_executor(None, next_chunk)
+    finally:
+        await loop.run_in_executor(None, rows.close)
+    return report
+
+
+def format_report(report, dry_run=False):
+    lines = [
+        f"{'Проверено' if dry_run else 'Загружено'} записей: {report.imported} из {report.rows}"
+        + ("" if dry_run else f" (новых {report.created}, обновлено {report.imported - report.created})"),
+    ]
+    if report.skipped:
+        lines.append(f"Пропущено строк с ошибками: {report.skipped}")
+        lines += [f"  строка {line}: {error}" for line, error in report.errors]
+        if report.skipped > len(report.errors):
+            lines.append("  …")
+    if report.unknown_columns:
+        lines.append(f"Не распознаны колонки: {', '.join(report.unknown_columns)}")
+    return "\n".join(lines)
+
+
+# -------------------------------------------------------------------
+# Админская загрузка из командной строки
+# -------------------------------------------------------------------
+async def _cli(args):
+    async def progress(report):
+        logging.info(f"Прочитано {report.rows} строк, загружено {report.imported}, ошибок {report.skipped}")
+
+    try:
+        report = await import_file(
+            args.telegram_id, args.path, username=args.username, progress=progress,
+            batch_size=args.batch_size, dry_run=args.dry_run,
+        )
+    except ValueError as e:
+        raise SystemExit(f"Файл не загружен: {e}")
+    finally:
+        await dispose_engines()
+    print(format_report(report, args.dry_run))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Загрузка истории DailyLog из xlsx/csv")
+    parser.add_argument("telegram_id", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--username")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="только проверить файл, ничего не записывать")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_cli(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# logbook.py
+"""
+Сохранение записей DailyLog вместе с обновлением агрегатов.
+
+На пользователя и дату хранится одна запись (уникальный индекс
+uq_daily_logs_user_date): повторный ввод за тот же день заменяет прежние
+ответы, а агрегаты корректируются на разницу. Записи сохраняются пачками:
+несколько multi-row запросов на всю пачку вместо нескольких запросов на запись.
+Каждая пачка увеличивает log_versions затронутых пользователей и обновляет
+очки участников команд (team_scores).
+"""
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from database import DailyLog, LogVersion
+from habits import pack
+from rollups import apply_rollup_deltas, rollup_delta
+from teams import apply_score_deltas
+
+LOG_FIELDS = ("habit_mask", "answered_mask", "numbers")
+
+
+async def _lock_existing(session, keys):
+    """
+    Блокирует существующие записи (user_id, date_of_entry) и возвращает их прежние
+    значения — (habit_mask, answered_mask, numbers).
+    """
+    if not keys:
+        return {}
+    result = await session.execute(
+        select(DailyLog.user_id, DailyLog.date_of_entry, *(getattr(DailyLog, field) for field in LOG_FIELDS))
+        .where(tuple_(DailyLog.user_id, DailyLog.date_of_entry).in_(keys))
+        .order_by(DailyLog.user_id, DailyLog.date_of_entry)
+        .with_for_update()
+    )
+    return {
+        (row.user_id, row.date_of_entry): (row.habit_mask, row.answered_mask, row.numbers)
+        for row in result
+    }
+
+
+def _log_row(key, entry):
+    user_id, date_of_entry = key
+    return {
+        "user_id": user_id, "date_of_entry": date_of_entry, "username": entry["username"],
+        **dict(zip(LOG_FIELDS, entry["record"])),
+    }
+
+
+async def _bump_versions(session, user_ids):
+    """
+    +1 к версии истории пользователей (строки — в порядке user_id, как и агрегаты).
+    """
+    stmt = insert(LogVersion).values([{"user_id": user_id, "version": 1} for user_id in user_ids])
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[LogVersion.user_id], set_={"version": LogVersion.version + 1},
+    ))
+
+
+async def save_daily_logs(session, entries):
+    """
+    Атомарный upsert пачки записей DailyLog и обновление habit_rollups в одной транзакции.
+    `entries` — словари с ключами user_id, date_of_entry, values, username;
+    `values` — {ключ привычки из habits.HABITS: ответ}, только отвеченные привычки.
+    Возвращает список флагов по порядку entries: True — запись новая, False — обновлена
+    существующая (в том числе предыдущей записью той же пачки).
+    Коммит — на стороне вызывающего.
+    """
+    # Повторы одного (user_id, date_of_entry) внутри пачки: побеждает последний
+    latest = {}
+    for entry in entries:
+        latest[(entry["user_id"], entry["date_of_entry"])] = {**entry, "record": pack(entry["values"])}
+    keys = sorted(latest)
+
+    # Первой — строка версии: она же сериализует запись с вступлением в команду (teams.py)
+    await _bump_versions(session, sorted({user_id for user_id, _ in keys}))
+    previous = await _lock_existing(session, keys)
+    new_keys = [key for key in keys if key not in previous]
+    if new_keys:
+        result = await session.execute(
+            insert(DailyLog)
+            .values([_log_row(key, latest[key]) for key in new_keys])
+            .on_conflict_do_nothing(index_elements=[DailyLog.user_id, DailyLog.date_of_entry])
+            .returning(DailyLog.user_id, DailyLog.date_of_entry)
+        )
+        inserted = {(row.user_id, row.date_of_entry) for row in result}
+        # Параллельная транзакция успела вставить часть записей — их обновляем
+        previous.update(await _lock_existing(session, [key for key in new_keys if key not in inserted]))
+
+    existing = [key for key in keys if key in previous]
+    if existing:
+        stmt = insert(DailyLog).values([_log_row(key, latest[key]) for key in existing])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DailyLog.user_id, DailyLog.date_of_entry],
+            set_={column: getattr(stmt.excluded, column) for column in ("username", *LOG_FIELDS)},
+        )
+        await session.execute(stmt)
+
+    deltas = [
+        (user_id, date_of_entry, rollup_delta(latest[(user_id, date_of_entry)]["record"],
+                                              previous.get((user_id, date_of_entry))))
+        for user_id, date_of_entry in keys
+    ]
+    await apply_rollup_deltas(session, deltas)
+    await apply_score_deltas(session, deltas)
+
+    created, seen = [], set()
+    for entry in entries:
+        key = (entry["user_id"], entry["date_of_entry"])
+        created.append(key not in previous and key not in seen)
+        seen.add(key)
+    return created
+
+
+async def save_daily_log(session, user_id, date_of_entry, values, username=None):
+    """
+    Upsert одной записи (см. save_daily_logs). Возвращает True, если запись новая.
+    Коммит — на стороне вызывающего.
+    """
+    entry = {"user_id": user_id, "date_of_entry": date_of_entry, "values": values, "username": username}
+    return (await save_daily_logs(session, [entry]))[0]
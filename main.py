@@ -1,19 +1,43 @@
+import asyncio
 import logging
 import datetime
-from datetime import timedelta
+import signal
+import sys
+import tempfile
+import time
 from dotenv import load_dotenv
 import os
 
-from aiogram import Bot, Dispatcher, types, executor
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, types, executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler  # Для утренней рассылки
-from openpyxl import Workbook  # <-- Add this import
 
-from database import init_db, get_session, User, DailyLog
+from database import engine, async_engine, get_async_session, dispose_engines
+from broadcast import Broadcaster, one_batch
+from broadcast_log import claim_interrupted_run, iter_pending, run_broadcast, stop_broadcasts
+from fsm_storage import create_storage, BOT_REPLICAS
+from webhook import start_webhook, register_stats
+from migrations import check_schema_version
+from rollups import get_rollup, sum_daily_rollups
+from export import export_user_logs, export_filename, shutdown_export_pool, EXPORT_FORMATS
+from user_cache import KnownUserCache
+from write_behind import DailyLogWriter
+from reminders import (
+    claim_due_reminders, get_reminder, set_reminder, parse_timezone, REMINDER_MAX_DELAY, REMINDER_RUN_KIND,
+)
+from metrics import InstrumentedBot, MetricsMiddleware, instrument_engines, set_query_source, start_metrics_server
+from sender import Sender, BOT_CONNECTIONS_LIMIT, BOT_REQUEST_TIMEOUT, REMOVE_KB
+import survey
+from survey import SurveyState
+from habits import HABITS, get_user_habits, set_user_habits, stats_lines
+from analytics import get_insights, format_insights, cache_stats as insights_cache_stats
+from charts import get_chart, shutdown_chart_pool, cache_stats as chart_cache_stats
+from teams import create_team, join_team, leave_team, get_leaderboard, format_leaderboard
+from importer import import_file, file_format, format_report, IMPORT_MAX_BYTES
 
 # -------------------------------------------------------------------
 # Настройки
@@ -23,477 +47,763 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 print("TELEGRAM_BOT_TOKEN",TELEGRAM_BOT_TOKEN)
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable is not set")
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Адрес Bot API — можно направить на локальный сервер или заглушку для тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
 logging.basicConfig(level=logging.INFO)
-
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-storage = MemoryStorage()
+# Задача напоминаний запускается ежеминутно — не засоряем лог её запусками
+logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
+
+bot = InstrumentedBot(  # Bot с метриками вызовов Bot API
+    token=TELEGRAM_BOT_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+    connections_limit=BOT_CONNECTIONS_LIMIT,  # одна aiohttp-сессия с keep-alive на все вызовы
+    timeout=BOT_REQUEST_TIMEOUT,
+)
+# Ответы хэндлеров: порядок по чатам, повторы при flood control, слияние правок клавиатуры
+sender = Sender(bot)
+storage = create_storage()  # FSM_STORAGE=postgres|memory
 dp = Dispatcher(bot, storage=storage)
-
-# -------------------------------------------------------------------
-# Состояния для стандартного сбора данных "на сегодня"
-# -------------------------------------------------------------------
-class GatherDataState(StatesGroup):
-    bedtime_before_midnight = State()
-    no_gadgets_after_23 = State()
-    followed_diet = State()
-    sport_hours = State()
-
-# -------------------------------------------------------------------
-# Состояния для сбора данных задним числом
-# -------------------------------------------------------------------
-class BackdatedDataState(StatesGroup):
-    select_date = State()
-    bedtime_before_midnight = State()
-    no_gadgets_after_23 = State()
-    followed_diet = State()
-    sport_hours = State()
-
-# -------------------------------------------------------------------
-# Универсальная клавиатура «Да / Нет»
-# -------------------------------------------------------------------
-yes_no_kb = ReplyKeyboardMarkup(resize_keyboard=True)
-yes_no_kb.add("Да", "Нет")
+dp.middleware.setup(MetricsMiddleware())
+instrument_engines(engine, async_engine.sync_engine)
+# Известные пользователи: /start не ходит в БД, новые регистрируются пачками
+known_users = KnownUserCache()
+register_stats("user_cache", known_users.as_dict)
+# Результаты опросов пишутся в БД пачками
+log_writer = DailyLogWriter()
+register_stats("log_writer", log_writer.as_dict)
+register_stats("sender", sender.as_dict)
+register_stats("insights_cache", insights_cache_stats)
+register_stats("chart_cache", chart_cache_stats)
 
 # -------------------------------------------------------------------
 # Команда /start
 # -------------------------------------------------------------------
-@dp.message_handler(commands=["start"])
-async def cmd_start(message: types.Message):
+@dp.message_handler(commands=["start"], state="*")
+async def cmd_start(message: types.Message, state: FSMContext):
     """
     Регистрируем пользователя в базе (если ещё не зарегистрирован) и выводим приветствие.
+    /start работает в любом состоянии и сбрасывает незаконченный диалог: после
+    разблокировки бота Telegram присылает именно /start, а напоминание могло
+    успеть начать опрос.
     """
     user_id = message.from_user.id
     username = message.from_user.username
 
-    session = get_session()
     try:
-        # Проверяем, есть ли уже такой юзер
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            user = User(telegram_id=user_id, username=username)
-            session.add(user)
-            session.commit()
-
-        await message.answer(
+        if await state.get_state() is not None:
+            await state.finish()
+        await known_users.ensure_registered(user_id, username)
+
+        await sender.answer(
+            message,
             "Привет! Я бот для отслеживания привычек.\n"
-            "Каждое утро я напомню вам внести данные.\n\n"
+            "Каждый день я напомню вам внести данные.\n\n"
             "Доступные команды:\n"
-            "/gather_data — внести данные за сегодня\n"
+            "/log — быстро внести данные за вчера кнопками\n"
+            "/gather_data — внести данные за вчера по шагам\n"
             "/gather_data_backdated — внести данные за любой из последних 7 дней\n"
-            "/weekly_stats — статистика за 7 дней"
+            "/weekly_stats [chart] — статистика за 7 дней (с графиком)\n"
+            "/stats week|month|year [chart] — статистика за текущий период\n"
+            "/insights — серии, динамика и связи между привычками\n"
+            "/team_create, /join, /leaderboard — команды и рейтинг\n"
+            "/export_excel, /import_excel — выгрузка и загрузка истории\n"
+            "/habits — какие привычки отслеживать\n"
+            "/reminder — время и часовой пояс напоминания"
         )
     except Exception as e:
         logging.error(f"Ошибка при регистрации пользователя: {e}")
-        await message.answer("Произошла ошибка при регистрации пользователя.")
-    finally:
-        session.close()
+        await sender.answer(message, "Произошла ошибка при регистрации пользователя.")
 
 # -------------------------------------------------------------------
-# Стандартный сбор данных «на сегодня» – ручной запуск
+# Опрос о привычках — пошаговый режим (вопросы — привычки пользователя, habits.py)
 # -------------------------------------------------------------------
+async def ask_question(chat_id, habits, step, date):
+    await sender.send_message(
+        chat_id, survey.question_text(habits[step], date), reply_markup=survey.question_markup(habits, step),
+    )
+
+
+async def start_survey(chat_id, user_id, state, date):
+    habits = await get_user_habits(user_id)
+    await state.set_state(SurveyState.answering)
+    await state.set_data(survey.start_data(date, habits))
+    await ask_question(chat_id, habits, 0, date)
+
+
 @dp.message_handler(commands=["gather_data"])
-async def cmd_gather_data(message: types.Message):
+async def cmd_gather_data(message: types.Message, state: FSMContext):
+    """
+    Запуск пошагового опроса (FSM); данные пишутся за вчера.
+    """
+    await start_survey(message.chat.id, message.from_user.id, state, survey.default_date())
+
+
+@dp.message_handler(commands=["gather_data_backdated"])
+async def cmd_gather_data_backdated(message: types.Message, state: FSMContext):
     """
-    Запуск пошагового опроса (FSM) для сегодняшней даты.
+    Пользователь выбирает любую дату из последних 7 дней при помощи инлайн-кнопок,
+    затем идёт пошаговый опрос (как обычно), но данные пишутся на выбранную дату.
     """
-    state = dp.current_state(chat=message.chat.id, user=message.from_user.id)
-    await state.set_state(GatherDataState.bedtime_before_midnight.state)
+    await state.set_state(SurveyState.select_date)
 
-    # Спрашиваем первый вопрос
-    await message.answer(
-        "Легли ли вы вчера до 00:00? (да/нет)",
-        reply_markup=yes_no_kb
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    for day in survey.allowed_dates():
+        day_str = day.strftime("%Y-%m-%d")
+        keyboard.insert(InlineKeyboardButton(text=day_str, callback_data=f"select_date:{day_str}"))
+
+    await sender.answer(
+        message,
+        "Выберите дату, за которую хотите внести данные:",
+        reply_markup=keyboard
     )
 
-# -------------------------------------------------------------------
-# Шаг 1 (сегодня): Лёг ли пользователь до 00:00
-# -------------------------------------------------------------------
-@dp.message_handler(state=GatherDataState.bedtime_before_midnight)
-async def process_bedtime_today(message: types.Message, state: FSMContext):
-    text = message.text.strip().lower()
-    if text in ["да", "нет"]:
-        bedtime_before_midnight = (text == "да")
-        await state.update_data(bedtime_before_midnight=bedtime_before_midnight)
-        await GatherDataState.next()
-        await message.reply(
-            "Использовали ли вы вчера гаджеты после 23:00? (да/нет)",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
 
-# -------------------------------------------------------------------
-# Шаг 2 (сегодня): Гаджеты после 23:00
-# -------------------------------------------------------------------
-@dp.message_handler(state=GatherDataState.no_gadgets_after_23)
-async def process_no_gadgets_today(message: types.Message, state: FSMContext):
-    text = message.text.strip().lower()
-    if text in ["да", "нет"]:
-        gadgets_after_23 = (text == "да")
-        no_gadgets_after_23 = not gadgets_after_23
-        await state.update_data(no_gadgets_after_23=no_gadgets_after_23)
-        await GatherDataState.next()
-        await message.reply(
-            "Питались ли вы вчера по рациону? (да/нет)",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
+@dp.callback_query_handler(
+    lambda c: c.data.startswith("select_date:"),
+    state=[SurveyState.select_date, "BackdatedDataState:select_date"],
+)
+async def process_backdated_select_date(callback_query: types.CallbackQuery, state: FSMContext):
+    _, date_str = callback_query.data.split(":", 1)
+    date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()  # проверяем формат
+
+    # Убираем «часики» на кнопке, не дожидаясь ответа
+    sender.answer_callback(callback_query.id)
+    chat_id = callback_query.message.chat.id
+    # Первый вопрос идёт с reply-клавиатурой, её к отредактированному сообщению не прикрепить:
+    # снимаем инлайн-клавиатуру отдельной правкой, пока готовится опрос
+    await asyncio.gather(
+        sender.edit_reply_markup(chat_id, callback_query.message.message_id),
+        start_survey(chat_id, callback_query.from_user.id, state, date),
+    )
 
-# -------------------------------------------------------------------
-# Шаг 3 (сегодня): Питался ли по рациону
-# -------------------------------------------------------------------
-@dp.message_handler(state=GatherDataState.followed_diet)
-async def process_followed_diet_today(message: types.Message, state: FSMContext):
-    text = message.text.strip().lower()
-    if text in ["да", "нет"]:
-        followed_diet = (text == "да")
-        await state.update_data(followed_diet=followed_diet)
-        await GatherDataState.next()
-        await message.reply(
-            "Сколько часов вы вчера занимались спортом? (введите число)",
-            reply_markup=ReplyKeyboardRemove(),
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
 
-# -------------------------------------------------------------------
-# Шаг 4 (сегодня): Количество часов спорта
-# -------------------------------------------------------------------
-@dp.message_handler(state=GatherDataState.sport_hours)
-async def process_sport_hours_today(message: types.Message, state: FSMContext):
-    text = message.text.strip().replace(",", ".")
+@dp.message_handler(state=SurveyState.answering)
+async def process_survey_answer(message: types.Message, state: FSMContext):
+    """
+    Один хэндлер на все шаги: набор привычек, номер шага и ответы хранятся в данных FSM.
+    """
+    data = await state.get_data()
+    habits = survey.survey_habits(data)
+    step = data["step"]
+    date = datetime.datetime.strptime(data["date"], "%Y-%m-%d").date()
+    habit = habits[step]
     try:
-        sport_hours = float(text)
-    except ValueError:
-        await message.answer("Пожалуйста, введите число (например 1.5).")
+        value = survey.parse_answer(habit, message.text or "")
+    except ValueError as e:
+        await sender.answer(message, str(e), reply_markup=survey.error_markup(habit))
         return
-    
-    await state.update_data(sport_hours=sport_hours)
-    data = await state.get_data()
-    session = get_session()
+
+    step += 1
+    if step < len(habits):
+        await state.update_data({habit.key: value, "step": step})
+        await ask_question(message.chat.id, habits, step, date)
+        return
+
+    data[habit.key] = value
     try:
-        yesterday = datetime.date.today() - timedelta(days=1) # Calculate yesterday's date
-        new_log = DailyLog(
-            user_id=message.from_user.id,
+        created = await log_writer.submit(
+            message.from_user.id, date, {h.key: data[h.key] for h in habits},
             username=message.from_user.username,
-            bedtime_before_midnight=data["bedtime_before_midnight"],
-            no_gadgets_after_23=data["no_gadgets_after_23"],
-            followed_diet=data["followed_diet"],
-            sport_hours=data["sport_hours"],
-            date_of_entry=yesterday, # Use yesterday's date
-        )
-        session.add(new_log)
-        session.commit()
-        await message.reply(
-            f"Данные за {yesterday.strftime('%Y-%m-%d')} успешно сохранены! Спасибо!",
-            reply_markup=ReplyKeyboardRemove(),
         )
     except Exception as e:
-        session.rollback()
         logging.error(f"Ошибка сохранения в БД: {e}")
-        await message.answer("Произошла ошибка при сохранении данных.")
+        await sender.answer(message, "Произошла ошибка при сохранении данных.")
         return
-    finally:
-        session.close()
     await state.finish()
+    await sender.answer(message, survey.saved_text(date, created))
+
+
+@dp.message_handler(state=list(survey.LEGACY_STATES))
+async def process_legacy_survey_answer(message: types.Message, state: FSMContext, raw_state: str):
+    """
+    Опрос, начатый до перехода на survey.py (состояние могло сохраниться в БД):
+    переводим на общий хэндлер с того же шага.
+    """
+    data = await state.get_data()
+    date = data.get("selected_date") or survey.default_date().strftime("%Y-%m-%d")
+    await state.set_state(SurveyState.answering)
+    await state.update_data(date=date, step=survey.LEGACY_STATES[raw_state])
+    await process_survey_answer(message, state)
 
 # -------------------------------------------------------------------
-# Новая команда: /gather_data_backdated (задним числом)
+# Опрос о привычках — компактный режим: одно сообщение с инлайн-кнопками
 # -------------------------------------------------------------------
-@dp.message_handler(commands=["gather_data_backdated"])
-async def cmd_gather_data_backdated(message: types.Message):
+@dp.message_handler(commands=["log"], state="*")
+async def cmd_log(message: types.Message):
     """
-    Пользователь выбирает любую дату из последних 7 дней при помощи инлайн-кнопок,
-    затем идёт пошаговый опрос (как обычно), но данные пишутся на выбранную дату.
+    /log [ГГГГ-ММ-ДД] — запись одним сообщением, без состояния FSM.
     """
-    state = dp.current_state(chat=message.chat.id, user=message.from_user.id)
-    await state.set_state(BackdatedDataState.select_date.state)
+    arg = message.get_args().strip()
+    try:
+        date = datetime.datetime.strptime(arg, "%Y-%m-%d").date() if arg else survey.default_date()
+    except ValueError:
+        date = None
+    if date not in survey.allowed_dates():
+        await sender.answer(message, f"Использование: /log [ГГГГ-ММ-ДД] — дата за последние {survey.SURVEY_DAYS} дней")
+        return
+    habits = await get_user_habits(message.from_user.id)
+    await sender.answer(message, survey.compact_text(date, habits), reply_markup=survey.compact_keyboard(date, habits))
 
-    # Сформируем список последних 7 дней (включая сегодня)
-    keyboard = InlineKeyboardMarkup(row_width=3)
-    today = datetime.date.today()
-    for i in range(7):
-        day = today - timedelta(days=i)
-        day_str = day.strftime("%Y-%m-%d")
-        btn = InlineKeyboardButton(
-            text=day_str,
-            callback_data=f"select_date:{day_str}"
-        )
-        keyboard.insert(btn)
 
-    await message.answer(
-        "Выберите дату, за которую хотите внести данные:",
-        reply_markup=keyboard
-    )
+@dp.callback_query_handler(lambda c: c.data.startswith(f"{survey.CALLBACK_PREFIX}:"), state="*")
+async def process_compact_survey(callback_query: types.CallbackQuery):
+    """
+    Нажатие в компактном опросе: весь вектор ответов приходит в callback_data.
+    """
+    chat_id = callback_query.message.chat.id
+    message_id = callback_query.message.message_id
+    habits = await get_user_habits(callback_query.from_user.id)
+    try:
+        date, mask, indexes, save = survey.decode_callback(callback_query.data, habits)
+    except ValueError as e:
+        logging.warning(str(e))
+        sender.answer_callback(callback_query.id, "Опрос устарел, начните заново: /log")
+        return
 
+    if not survey.is_complete(indexes, save):
+        sender.answer_callback(callback_query.id)
+        await sender.edit_reply_markup(chat_id, message_id, survey.compact_keyboard(date, habits, mask, indexes))
+        return
+
+    values = survey.compact_values(habits, mask, indexes)
+    try:
+        created = await log_writer.submit(
+            callback_query.from_user.id, date, values, username=callback_query.from_user.username,
+        )
+    except Exception as e:
+        logging.error(f"Ошибка сохранения в БД: {e}")
+        sender.answer_callback(callback_query.id, "Произошла ошибка при сохранении данных.")
+        return
+    sender.answer_callback(callback_query.id)
+    await sender.edit_message_text(
+        chat_id, message_id, f"{survey.saved_text(date, created)}\n\n{survey.summary(habits, values)}",
+    )
 
 @dp.message_handler(commands=["export_excel"])
 async def export_excel_cmd(message: types.Message):
+    """
+    Выгрузка всех логов пользователя: /export_excel [xlsx|csv|parquet].
+    Файл собирается потоково в пуле процессов и отправляется из временного каталога.
+    """
     user_id = message.from_user.id
-    session = get_session()
+    fmt = message.get_args().strip().lower() or "xlsx"
+    if fmt not in EXPORT_FORMATS:
+        await sender.answer(message, "Использование: /export_excel [xlsx|csv|parquet]")
+        return
 
     try:
-        # Берём все логи пользователя (или измените фильтр по датам, если нужно)
-        logs = session.query(DailyLog).filter(DailyLog.user_id == user_id).all()
-    finally:
-        session.close()
+        path = await export_user_logs(user_id, fmt)
+    except Exception as e:
+        logging.error(f"Ошибка при выгрузке данных: {e}")
+        await sender.answer(message, "Произошла ошибка при выгрузке данных.")
+        return
 
-    if not logs:
-        await message.answer("У вас нет данных для экспорта.")
+    if path is None:
+        await sender.answer(message, "У вас нет данных для экспорта.")
         return
 
-    # Создаём Excel-книгу
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Habit Logs"
-
-    # Добавим строку заголовков (пример)
-    ws.append([
-        "ID",
-        "Дата",
-        "Лёг до 00:00",
-        "Не использовал гаджеты после 23:00",
-        "Питался по рациону",
-        "Часы спорта",
-        "Дата записи (UTC)"
-    ])
-
-    # Заполняем строки из БД
-    for log in logs:
-        ws.append([
-            log.id,
-            log.date_of_entry.strftime("%Y-%m-%d"),
-            "Да" if log.bedtime_before_midnight else "Нет",
-            "Да" if log.no_gadgets_after_23 else "Нет",
-            "Да" if log.followed_diet else "Нет",
-            str(log.sport_hours),
-            log.created_at.strftime("%Y-%m-%d %H:%M:%S")
-        ])
+    try:
+        # Отправляем файл
+        await sender.send_document(
+            message.chat.id,
+            types.InputFile(path, filename=export_filename(user_id, fmt)),
+            caption="Вот ваши данные в Excel!" if fmt == "xlsx" else "Вот ваши данные!"
+        )
+    finally:
+        # Удаляем временный файл
+        os.remove(path)
 
-    # Сохраняем во временный файл
-    filename = f"export_{user_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    wb.save(filename)
+# -------------------------------------------------------------------
+# Команда /import_excel — загрузка истории из xlsx / csv (importer.py)
+# -------------------------------------------------------------------
+# Не чаще одного обновления сообщения о ходе загрузки за столько секунд
+IMPORT_PROGRESS_INTERVAL = 2.0
+_importing = set()
 
-    # Отправляем файл
-    await message.answer_document(
-        document=types.InputFile(filename),
-        caption="Вот ваши данные в Excel!"
-    )
 
-    # Удаляем временный файл
-    os.remove(filename)
+class ImportState(StatesGroup):
+    waiting_file = State()
 
-# -------------------------------------------------------------------
-# Хэндлер нажатия инлайн-кнопки (выбор даты)
-# -------------------------------------------------------------------
-@dp.callback_query_handler(lambda c: c.data.startswith("select_date:"), state=BackdatedDataState.select_date)
-async def process_backdated_select_date(callback_query: types.CallbackQuery, state: FSMContext):
-    # Парсим дату из callback_data
-    _, date_str = callback_query.data.split(":", 1)
-    selected_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-
-    # Сохраняем дату в FSM
-    await state.update_data(selected_date=selected_date)
-    # Переходим к первому вопросу (bedtime)
-    await BackdatedDataState.bedtime_before_midnight.set()
-
-    # Удалим инлайн-клавиатуру
-    await callback_query.message.edit_reply_markup()
-    # Задаём вопрос
-    await callback_query.message.answer(
-        f"Легли ли вы {date_str} до 00:00? (да/нет)",
-        reply_markup=yes_no_kb
+
+@dp.message_handler(commands=["import_excel"], state="*")
+async def cmd_import_excel(message: types.Message, state: FSMContext):
+    await state.set_state(ImportState.waiting_file)
+    await sender.answer(
+        message,
+        "Пришлите файл .xlsx или .csv в формате /export_excel: колонка «Дата» (ГГГГ-ММ-ДД) "
+        "и колонки привычек (Да/Нет или число). Записи за те же даты будут заменены.\n"
+        "Отмена — /cancel",
+        reply_markup=REMOVE_KB,
     )
 
-# -------------------------------------------------------------------
-# Шаг 1 (задним числом): Лёг ли до 00:00
-# -------------------------------------------------------------------
-@dp.message_handler(state=BackdatedDataState.bedtime_before_midnight)
-async def process_bedtime_backdated(message: types.Message, state: FSMContext):
-    text = message.text.lower().strip()
-    if text in ["да", "нет"]:
-        bedtime_before_midnight = (text == "да")
-        await state.update_data(bedtime_before_midnight=bedtime_before_midnight)
-        await BackdatedDataState.next()
-        data = await state.get_data()
-        date_str = data.get("selected_date", datetime.date.today()).strftime("%Y-%m-%d")
-        await message.answer(
-            f"Использовали ли вы {date_str} гаджеты после 23:00? (да/нет)",
-            reply_markup=yes_no_kb
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
 
-# -------------------------------------------------------------------
-# Шаг 2 (задним числом): Гаджеты после 23:00
-# -------------------------------------------------------------------
-@dp.message_handler(state=BackdatedDataState.no_gadgets_after_23)
-async def process_no_gadgets_backdated(message: types.Message, state: FSMContext):
-    text = message.text.lower().strip()
-    if text in ["да", "нет"]:
-        gadgets_after_23 = (text == "да")
-        no_gadgets_after_23 = not gadgets_after_23
-        await state.update_data(no_gadgets_after_23=no_gadgets_after_23)
-        await BackdatedDataState.next()
-
-        data = await state.get_data()
-        date_str = data.get("selected_date", datetime.date.today()).strftime("%Y-%m-%d")
-        await message.answer(
-            f"Питались ли вы {date_str} по рациону? (да/нет)",
-            reply_markup=yes_no_kb
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
+@dp.message_handler(commands=["cancel"], state=ImportState.waiting_file)
+async def cancel_import(message: types.Message, state: FSMContext):
+    await state.finish()
+    await sender.answer(message, "Загрузка отменена.")
 
-# -------------------------------------------------------------------
-# Шаг 3 (задним числом): Питался по рациону
-# -------------------------------------------------------------------
-@dp.message_handler(state=BackdatedDataState.followed_diet)
-async def process_followed_diet_backdated(message: types.Message, state: FSMContext):
-    text = message.text.lower().strip()
-    if text in ["да", "нет"]:
-        followed_diet = (text == "да")
-        await state.update_data(followed_diet=followed_diet)
-        await BackdatedDataState.next()
-
-        data = await state.get_data()
-        date_str = data.get("selected_date", datetime.date.today()).strftime("%Y-%m-%d")
-        await message.answer(
-            f"Сколько часов занялись спортом {date_str}? (введите число)",
-            reply_markup=ReplyKeyboardRemove()
-        )
-    else:
-        await message.answer("Пожалуйста, выберите «да» или «нет».", reply_markup=yes_no_kb)
 
-# -------------------------------------------------------------------
-# Шаг 4 (задним числом): Часы спорта
-# -------------------------------------------------------------------
-@dp.message_handler(state=BackdatedDataState.sport_hours)
-async def process_sport_hours_backdated(message: types.Message, state: FSMContext):
-    text = message.text.strip().replace(",", ".")
+@dp.message_handler(state=ImportState.waiting_file, content_types=types.ContentTypes.ANY)
+async def process_import_file(message: types.Message, state: FSMContext):
+    """
+    Файл скачивается во временный каталог и загружается пачками; сообщение о
+    ходе загрузки редактируется не чаще раза в IMPORT_PROGRESS_INTERVAL секунд.
+    """
+    user_id = message.from_user.id
+    document = message.document
+    if document is None:
+        await sender.answer(message, "Пришлите файл .xlsx или .csv документом или /cancel для отмены.")
+        return
     try:
-        sport_hours = float(text)
-    except ValueError:
-        await message.answer("Пожалуйста, введите число (например 1.5).")
+        fmt = file_format(document.file_name or "")
+    except ValueError as e:
+        await sender.answer(message, str(e))
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await sender.answer(message, f"Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ.")
+        return
+    if user_id in _importing:
+        await sender.answer(message, "Предыдущая загрузка ещё идёт, подождите.")
         return
-    
-    await state.update_data(sport_hours=sport_hours)
-    data = await state.get_data()
-    await state.finish()
-
-    selected_date = data["selected_date"]
-    bedtime_before_midnight = data["bedtime_before_midnight"]
-    no_gadgets_after_23 = data["no_gadgets_after_23"]
-    followed_diet = data["followed_diet"]
 
-    # Сохраняем данные в БД
-    session = get_session()
+    _importing.add(user_id)
+    await state.finish()
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
     try:
-        log_entry = DailyLog(
-            user_id=message.from_user.id,
-            date_of_entry=selected_date,
-            bedtime_before_midnight=bedtime_before_midnight,
-            no_gadgets_after_23=no_gadgets_after_23,
-            followed_diet=followed_diet,
-            sport_hours=sport_hours
-        )
-        session.add(log_entry)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Ошибка сохранения в БД: {e}")
-        await message.answer("Произошла ошибка при сохранении данных.")
-        return
-    finally:
-        session.close()
+        status = await sender.answer(message, "Загружаю файл…")
+        last_update = time.monotonic()
+
+        async def progress(report):
+            nonlocal last_update
+            if time.monotonic() - last_update < IMPORT_PROGRESS_INTERVAL:
+                return
+            last_update = time.monotonic()
+            await sender.edit_message_text(
+                message.chat.id, status.message_id,
+                f"Загружаю файл… прочитано строк: {report.rows}, ошибок: {report.skipped}",
+            )
 
-    await message.answer(
-        f"Данные за {selected_date.strftime('%Y-%m-%d')} успешно сохранены! Спасибо!"
-    )
+        try:
+            await document.download(destination_file=path)
+            report = await import_file(user_id, path, username=message.from_user.username, progress=progress)
+        except ValueError as e:
+            text = f"Файл не загружен: {e}"
+        except Exception as e:
+            logging.error(f"Ошибка при загрузке данных: {e}")
+            text = "Произошла ошибка при загрузке данных."
+        else:
+            text = format_report(report)
+        await sender.edit_message_text(message.chat.id, status.message_id, text)
+    finally:
+        _importing.discard(user_id)
+        # Удаляем временный файл
+        os.remove(path)
 
 # -------------------------------------------------------------------
 # Команда /weekly_stats — статистика за 7 дней
 # -------------------------------------------------------------------
+CHART_ARGS = ("chart", "график")
+
+
+async def send_stats_chart(message, period, date_from, date_to, title):
+    """
+    График по дневным агрегатам (рисуется в пуле процессов, см. charts.py).
+    """
+    habits = await get_user_habits(message.from_user.id)
+    png = await get_chart(message.from_user.id, habits, period, date_from, date_to, title)
+    if png is not None:
+        await sender.send_photo(message.chat.id, png)
+
+
 @dp.message_handler(commands=["weekly_stats"])
 async def cmd_weekly_stats(message: types.Message):
+    """
+    /weekly_stats [chart] — статистика за 7 дней; с chart — ещё и график по дням.
+    """
     user_id = message.from_user.id
     today = datetime.date.today()
     week_ago = today - datetime.timedelta(days=7)
-    
-    session = get_session()
+    chart = message.get_args().strip().lower() in CHART_ARGS
+
     try:
-        logs = session.query(DailyLog).filter(
-            DailyLog.user_id == user_id,
-            DailyLog.date_of_entry >= week_ago
-        ).all()
+        # Суммируем дневные агрегаты в БД — логи в Python не загружаем
+        async with get_async_session() as session:
+            totals = await sum_daily_rollups(session, user_id, week_ago, today)
 
-        if not logs:
-            await message.answer("Нет данных за последние 7 дней.")
+        if not totals.entries:
+            await sender.answer(message, "Нет данных за последние 7 дней.")
             return
 
-        days_count = len(logs)
-        bedtime_count = sum(log.bedtime_before_midnight for log in logs)
-        gadgets_count = sum(log.no_gadgets_after_23 for log in logs)
-        diet_count = sum(log.followed_diet for log in logs)
-        total_sport_hours = sum(log.sport_hours for log in logs)
-
-        avg_sport = round(total_sport_hours / days_count, 2)
-
-        text_stats = (
-            f"Статистика за последние 7 дней:\n\n"
-            f"Всего записей: {days_count}\n"
-            f"1) Легли до 00:00: {bedtime_count} раз(а)\n"
-            f"2) Не использовали гаджеты после 23:00: {gadgets_count} раз(а)\n"
-            f"3) Питались по рациону: {diet_count} раз(а)\n"
-            f"4) Среднее кол-во часов спорта: {avg_sport} ч/день\n"
-        )
-        await message.answer(text_stats)
+        text_stats = "\n".join([
+            "Статистика за последние 7 дней:\n",
+            f"Всего записей: {totals.entries}",
+            *stats_lines(totals),
+        ])
+        await sender.answer(message, text_stats)
+        if chart:
+            await send_stats_chart(message, "week", week_ago, today, "Последние 7 дней")
     except Exception as e:
         logging.error(f"Ошибка при получении статистики: {e}")
-        await message.answer("Произошла ошибка при получении статистики.")
-    finally:
-        session.close()
+        await sender.answer(message, "Произошла ошибка при получении статистики.")
+
+# -------------------------------------------------------------------
+# Команда /stats <period> — статистика за текущий день/неделю/месяц/год
+# -------------------------------------------------------------------
+STATS_PERIODS = {
+    "day": "day", "день": "day",
+    "week": "week", "неделя": "week",
+    "month": "month", "месяц": "month",
+    "year": "year", "год": "year",
+}
+STATS_PERIOD_TITLES = {
+    "day": "сегодня",
+    "week": "текущую неделю",
+    "month": "текущий месяц",
+    "year": "текущий год",
+}
+
+@dp.message_handler(commands=["stats"])
+async def cmd_stats(message: types.Message):
+    """
+    Статистика из предагрегированной таблицы: одна строка на запрос.
+    /stats month chart — то же с графиком по дням периода.
+    """
+    args = message.get_args().strip().lower().split()
+    chart = bool(args) and args[-1] in CHART_ARGS
+    if chart:
+        args.pop()
+    period = STATS_PERIODS.get(args[0] if args else "week") if len(args) <= 1 else None
+    if period is None:
+        await sender.answer(message, "Использование: /stats day|week|month|year [chart]")
+        return
+
+    try:
+        async with get_async_session() as session:
+            rollup = await get_rollup(session, message.from_user.id, period)
+
+        if rollup is None or not rollup.entries:
+            await sender.answer(message, f"Нет данных за {STATS_PERIOD_TITLES[period]}.")
+            return
+
+        await sender.answer(message, "\n".join([
+            f"Статистика за {STATS_PERIOD_TITLES[period]} "
+            f"(с {rollup.period_start.strftime('%Y-%m-%d')}):\n",
+            f"Всего записей: {rollup.entries}",
+            *stats_lines(rollup),
+        ]))
+        if chart:
+            title = f"Статистика за {STATS_PERIOD_TITLES[period]}"
+            await send_stats_chart(message, period, rollup.period_start, datetime.date.today(), title)
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики: {e}")
+        await sender.answer(message, "Произошла ошибка при получении статистики.")
 
 # -------------------------------------------------------------------
-# Автоматическая рассылка утром для всех зарегистрированных
+# Команда /insights — серии, динамика и связи между привычками
 # -------------------------------------------------------------------
-async def morning_job():
+@dp.message_handler(commands=["insights"])
+async def cmd_insights(message: types.Message):
     """
-    Каждый день обходим всех пользователей и автоматически запускаем им FSM-опрос (на сегодня).
+    Аналитика по всей истории; пересчитывается, только если история изменилась.
     """
-    session = get_session()
     try:
-        users = session.query(User).all()
-        for user in users:
-            # Программно запускаем сбор данных (сегодня)
-            state = dp.current_state(chat=user.telegram_id, user=user.telegram_id)
-            await state.set_state(GatherDataState.bedtime_before_midnight.state)
-            await bot.send_message(
-                user.telegram_id,
-                "Доброе утро! Самое время внести данные за сегодня.\n"
-                "Легли ли вы вчера до 00:00? (да/нет)",
-                reply_markup=yes_no_kb
+        habits = await get_user_habits(message.from_user.id)
+        insights = await get_insights(message.from_user.id, habits)
+        if insights is None:
+            await sender.answer(message, "Пока нет данных. Внесите первую запись: /log")
+            return
+        await sender.answer(message, format_insights(insights))
+    except Exception as e:
+        logging.error(f"Ошибка при расчёте аналитики: {e}")
+        await sender.answer(message, "Произошла ошибка при расчёте аналитики.")
+
+# -------------------------------------------------------------------
+# Команды и рейтинг: /team_create, /join, /team_leave, /leaderboard
+# -------------------------------------------------------------------
+LEADERBOARD_PERIODS = {"week": "week", "неделя": "week", "month": "month", "месяц": "month"}
+LEADERBOARD_METRICS = {"sport": "sport", "спорт": "sport"}
+
+
+@dp.message_handler(commands=["team_create"])
+async def cmd_team_create(message: types.Message):
+    name = message.get_args().strip()
+    if not name or len(name) > 64:
+        await sender.answer(message, "Использование: /team_create <название команды> (до 64 символов)")
+        return
+    try:
+        team = await create_team(message.from_user.id, name)
+    except Exception as e:
+        logging.error(f"Ошибка создания команды: {e}")
+        await sender.answer(message, "Произошла ошибка при создании команды.")
+        return
+    await sender.answer(
+        message,
+        f"Команда «{team.name}» создана.\n"
+        f"Пригласите участников: /join {team.invite_code}\n"
+        "Рейтинг: /leaderboard",
+    )
+
+
+@dp.message_handler(commands=["join"])
+async def cmd_join(message: types.Message):
+    code = message.get_args().strip()
+    if not code:
+        await sender.answer(message, "Использование: /join <код приглашения>")
+        return
+    try:
+        team = await join_team(message.from_user.id, code)
+    except Exception as e:
+        logging.error(f"Ошибка вступления в команду: {e}")
+        await sender.answer(message, "Произошла ошибка при вступлении в команду.")
+        return
+    if team is None:
+        await sender.answer(message, "Команда с таким кодом не найдена.")
+        return
+    await sender.answer(message, f"Вы в команде «{team.name}». Рейтинг: /leaderboard")
+
+
+@dp.message_handler(commands=["team_leave"])
+async def cmd_team_leave(message: types.Message):
+    try:
+        team = await leave_team(message.from_user.id)
+    except Exception as e:
+        logging.error(f"Ошибка выхода из команды: {e}")
+        await sender.answer(message, "Произошла ошибка при выходе из команды.")
+        return
+    if team is None:
+        await sender.answer(message, "Вы не состоите в команде.")
+        return
+    await sender.answer(message, f"Вы вышли из команды «{team.name}».")
+
+
+@dp.message_handler(commands=["leaderboard"])
+async def cmd_leaderboard(message: types.Message):
+    """
+    /leaderboard [week|month] [sport] — топ команды из готовых очков (team_scores).
+    """
+    period, metric = "week", "rate"
+    for arg in message.get_args().strip().lower().split():
+        if arg in LEADERBOARD_PERIODS:
+            period = LEADERBOARD_PERIODS[arg]
+        elif arg in LEADERBOARD_METRICS:
+            metric = LEADERBOARD_METRICS[arg]
+        else:
+            await sender.answer(message, "Использование: /leaderboard [week|month] [sport]")
+            return
+    try:
+        board = await get_leaderboard(message.from_user.id, period, metric)
+    except Exception as e:
+        logging.error(f"Ошибка при получении рейтинга: {e}")
+        await sender.answer(message, "Произошла ошибка при получении рейтинга.")
+        return
+    if board is None:
+        await sender.answer(message, "Вы не состоите в команде. Создайте свою: /team_create <название>, "
+                                     "или вступите по коду: /join <код>")
+        return
+    await sender.answer(message, format_leaderboard(board, period, metric))
+
+# -------------------------------------------------------------------
+# Команда /habits — набор отслеживаемых привычек
+# -------------------------------------------------------------------
+def habits_keyboard(selected):
+    keyboard = InlineKeyboardMarkup()
+    for habit in HABITS:
+        mark = "✅" if habit in selected else "⬜"
+        keyboard.row(InlineKeyboardButton(f"{mark} {habit.label}", callback_data=f"hb:{habit.key}"))
+    return keyboard
+
+
+@dp.message_handler(commands=["habits"])
+async def cmd_habits(message: types.Message):
+    habits = await get_user_habits(message.from_user.id)
+    await sender.answer(
+        message, "Отметьте привычки, которые хотите отслеживать:", reply_markup=habits_keyboard(habits),
+    )
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("hb:"), state="*")
+async def process_habit_toggle(callback_query: types.CallbackQuery):
+    """
+    Включение/выключение привычки; в наборе остаётся хотя бы одна.
+    Записанные ранее ответы не меняются — привычка просто перестаёт спрашиваться.
+    """
+    user_id = callback_query.from_user.id
+    key = callback_query.data.split(":", 1)[1]
+    habits = await get_user_habits(user_id)
+    selected = {h.key for h in habits} ^ {key}
+    if not selected:
+        sender.answer_callback(callback_query.id, "Нужна хотя бы одна привычка.")
+        return
+    if not await set_user_habits(user_id, [h for h in HABITS if h.key in selected]):
+        sender.answer_callback(callback_query.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    sender.answer_callback(callback_query.id)
+    await sender.edit_reply_markup(
+        callback_query.message.chat.id, callback_query.message.message_id,
+        habits_keyboard(await get_user_habits(user_id)),
+    )
+
+# -------------------------------------------------------------------
+# Команда /reminder — время и часовой пояс напоминания
+# -------------------------------------------------------------------
+@dp.message_handler(commands=["reminder"])
+async def cmd_reminder(message: types.Message):
+    """
+    /reminder — текущие настройки; /reminder 07:30, /reminder Asia/Almaty
+    или /reminder 07:30 Asia/Almaty — изменить.
+    """
+    timezone, reminder_time = None, None
+    for arg in message.get_args().split():
+        try:
+            reminder_time = datetime.datetime.strptime(arg, "%H:%M").time()
+            continue
+        except ValueError:
+            pass
+        if parse_timezone(arg) is None:
+            await sender.answer(
+                message,
+                f"Не понимаю «{arg}». Укажите время в формате ЧЧ:ММ и/или часовой пояс, "
+                "например: /reminder 07:30 Asia/Almaty"
             )
-    finally:
-        session.close()
+            return
+        timezone = arg
+
+    try:
+        if timezone is None and reminder_time is None:
+            settings = await get_reminder(message.from_user.id)
+            if settings is None:
+                await sender.answer(message, "Сначала зарегистрируйтесь командой /start.")
+                return
+            await sender.answer(
+                message,
+                f"Напоминание приходит в {settings.reminder_time.strftime('%H:%M')} ({settings.timezone}).\n"
+                "Изменить: /reminder 07:30 Asia/Almaty"
+            )
+            return
+
+        settings = await set_reminder(message.from_user.id, timezone=timezone, reminder_time=reminder_time)
+        if settings is None:
+            await sender.answer(message, "Сначала зарегистрируйтесь командой /start.")
+            return
+        timezone, reminder_time, _ = settings
+        await sender.answer(message, f"Готово! Напоминание будет приходить в {reminder_time.strftime('%H:%M')} ({timezone}).")
+    except Exception as e:
+        logging.error(f"Ошибка при настройке напоминания: {e}")
+        await sender.answer(message, "Произошла ошибка при настройке напоминания.")
+
+# -------------------------------------------------------------------
+# Ежедневные напоминания по местному времени пользователей
+# -------------------------------------------------------------------
+async def send_morning_reminder(chat_id):
+    date = survey.default_date()
+    # Набор привычек уже в кэше: его заполняет claim_due_reminders
+    habits = await get_user_habits(chat_id)
+    if survey.REMINDER_SURVEY_MODE == "compact":
+        # Компактный опрос не трогает FSM — только одно сообщение
+        await bot.send_message(
+            chat_id,
+            f"Напоминание: самое время внести данные.\n{survey.compact_text(date, habits)}",
+            reply_markup=survey.compact_keyboard(date, habits),
+        )
+        return
+    # Программно запускаем пошаговый опрос (за вчера)
+    state = dp.current_state(chat=chat_id, user=chat_id)
+    await state.set_state(SurveyState.answering)
+    await state.set_data(survey.start_data(date, habits))
+    await bot.send_message(
+        chat_id,
+        f"Напоминание: самое время внести данные за сегодня.\n{survey.question_text(habits[0], date)}",
+        reply_markup=survey.question_markup(habits, 0)
+    )
+
+
+async def send_reminders(run_id, batches):
+    """
+    Отправка идёт через Broadcaster: пул воркеров с ограничением скорости под лимиты Telegram.
+    Итоги доставки пишутся в журнал рассылок; заблокировавшие бота убираются из кэша
+    известных пользователей — кэш держит только активных.
+    """
+    broadcaster = Broadcaster(send_morning_reminder)
+    stats = await run_broadcast(broadcaster, run_id, batches, on_unreachable=known_users.discard)
+    if stats.total:
+        logging.info(f"Напоминания #{run_id} отправлены: {stats}")
+    return stats
+
+
+async def morning_job():
+    """
+    Раз в минуту забираем порцию пользователей, у которых наступило время
+    напоминания, и автоматически запускаем им FSM-опрос (на сегодня).
+    Сначала досылаем прогоны, прерванные остановкой или падением бота.
+    """
+    set_query_source("morning_job")
+    while True:
+        run_id = await claim_interrupted_run(REMINDER_RUN_KIND, max_age=REMINDER_MAX_DELAY)
+        if run_id is None:
+            break
+        if (await send_reminders(run_id, iter_pending(run_id))).stopped:
+            return
+
+    run_id, chat_ids = await claim_due_reminders()
+    if run_id is not None:
+        await send_reminders(run_id, one_batch(chat_ids))
 
 # -------------------------------------------------------------------
-# on_startup: инициализация БД + запуск APScheduler
+# on_startup: проверка схемы БД + запуск APScheduler
 # -------------------------------------------------------------------
 async def on_startup(dp):
-    init_db()
-    logging.info("База данных инициализирована.")
+    # Схему меняет только `python migrations.py`; здесь — одна быстрая проверка версии
+    await check_schema_version()
+    logging.info("Схема БД актуальна.")
+
+    # Прогрев в фоне: до его окончания /start просто чаще обращается к БД
+    known_users.start_warm_up()
 
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")  # поменяйте при желании
-    # Пример: запускать каждый день в 08:00
-    scheduler.add_job(morning_job, 'cron', hour=8, minute=0)
+    dp["metrics_runner"] = await start_metrics_server()
+
+    scheduler = AsyncIOScheduler(timezone="UTC")
+    # Каждую минуту — напоминания тем, у кого наступило их местное время.
+    # max_instances=1: если порция не успела уйти за минуту, следующий запуск пропускается
+    scheduler.add_job(morning_job, 'cron', minute='*', max_instances=1, coalesce=True)
     scheduler.start()
+    dp["scheduler"] = scheduler
     logging.info("Scheduler (APS) запущен.")
 
+# -------------------------------------------------------------------
+# on_shutdown: сохраняем состояния FSM и закрываем пулы соединений с БД
+# -------------------------------------------------------------------
+async def on_shutdown(dp):
+    # Новые рассылки не запускаем; начатые отправки завершаются, итоги пишутся в журнал,
+    # остальных получателей дошлёт следующий запуск бота
+    if dp.get("scheduler") is not None:
+        dp["scheduler"].shutdown(wait=False)
+    await stop_broadcasts()
+    # Затем дописываем в БД принятые ответы и несохранённые состояния FSM
+    await log_writer.close()
+    await dp.storage.close()
+    await known_users.batcher.flush()
+    await sender.close()
+    logging.info(f"Кэш пользователей: {known_users.as_dict()}")
+    shutdown_export_pool()
+    shutdown_chart_pool()
+    if dp.get("metrics_runner") is not None:
+        await dp["metrics_runner"].cleanup()
+    await dispose_engines()
+
 # -------------------------------------------------------------------
 # Точка входа
 # -------------------------------------------------------------------
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        if BOT_REPLICAS > 1:
+            # getUpdates отдаёт апдейты только одному процессу — закреплять чаты не за кем
+            raise ValueError("Несколько реплик (BOT_REPLICAS > 1) работают только в режиме webhook")
+        # docker stop присылает SIGTERM — останавливаемся так же штатно, как по Ctrl+C (с on_shutdown)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
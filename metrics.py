@@ -0,0 +1,185 @@
+# metrics.py
+"""
+Метрики Prometheus: хэндлеры, FSM, очередь апдейтов, запросы к БД и вызовы Bot API.
+
+    MetricsMiddleware   — латентность хэндлеров, задержка апдейтов
+    count_fsm_transition — переходы FSM (вызывает хранилище состояний)
+    instrument_engines  — число и длительность SQL-запросов по источнику
+                          (хэндлер или фоновая задача)
+    InstrumentedBot     — латентность и ошибки вызовов Bot API, ожидания flood control
+
+Метрики отдаются в текстовом формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics
+(по умолчанию только локально). METRICS_PORT=0 отключает сервер.
+"""
+import contextvars
+import logging
+import os
+import time
+
+from aiohttp import web
+from aiogram import Bot, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import RetryAfter
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Бакеты для быстрых операций (SQL, очередь) — от 0.5 мс
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+UPDATES = Counter("bot_updates_total", "Полученные апдейты", ["type"])
+UPDATE_LAG = Histogram(
+    "bot_update_lag_seconds", "Задержка от отправки сообщения до начала обработки",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+UPDATE_QUEUE_WAIT = Histogram(
+    "bot_update_queue_wait_seconds", "Ожидание апдейта в очереди webhook-сервера", buckets=FAST_BUCKETS,
+)
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Апдейтов в очереди webhook-сервера")
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Время работы хэндлера", ["handler"])
+FSM_TRANSITIONS = Counter("bot_fsm_transitions_total", "Переходы FSM", ["from_state", "to_state"])
+DB_QUERIES = Counter("bot_db_queries_total", "SQL-запросы", ["source"])
+DB_QUERY_DURATION = Histogram(
+    "bot_db_query_duration_seconds", "Длительность SQL-запросов", ["source"], buckets=FAST_BUCKETS,
+)
+BOT_API_LATENCY = Histogram("bot_api_request_duration_seconds", "Вызовы Bot API", ["method"])
+BOT_API_ERRORS = Counter("bot_api_errors_total", "Ошибки вызовов Bot API", ["method", "error"])
+BOT_API_FLOOD_WAITS = Counter("bot_api_flood_waits_total", "Ответы RetryAfter (flood control)", ["method"])
+REMINDERS_SKIPPED = Counter(
+    "bot_reminders_skipped_total", "Напоминания, опоздавшие больше REMINDER_MAX_DELAY и не отправленные",
+)
+
+# Кому приписывать SQL-запросы: имя хэндлера или фоновой задачи
+_query_source = contextvars.ContextVar("query_source", default="background")
+
+
+def set_query_source(name):
+    """
+    Помечает SQL-запросы текущей задачи. Долгоживущие фоновые задачи вызывают это
+    в начале, иначе унаследуют метку хэндлера, из которого были запущены.
+    """
+    _query_source.set(name)
+
+
+def count_fsm_transition(before, after):
+    """
+    Переход FSM; вызывается хранилищем состояний, которое знает старое и новое значения.
+    """
+    if after != before:
+        FSM_TRANSITIONS.labels(before or "none", after or "none").inc()
+
+
+# -------------------------------------------------------------------
+# Хэндлеры и FSM
+# -------------------------------------------------------------------
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Латентность хэндлеров и задержка апдейтов. Переходы FSM считает хранилище
+    состояний (fsm_storage.py) — без лишнего чтения состояния после хэндлера.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        # Запросы до выбора хэндлера (чтение состояния FSM фильтрами) — диспетчеру
+        set_query_source("dispatcher")
+        update_type = next((name for name in update.values if name != "update_id"), "unknown")
+        UPDATES.labels(update_type).inc()
+        if update.message is not None and update.message.date is not None:
+            # Точность даты в Telegram — секунда
+            UPDATE_LAG.observe(max(0.0, time.time() - update.message.date.timestamp()))
+
+    def _start(self, data):
+        handler = current_handler.get()
+        name = getattr(handler, "__name__", "unknown")
+        data["_metrics_handler"] = name
+        data["_metrics_started"] = time.perf_counter()
+        set_query_source(name)
+
+    async def _finish(self, data):
+        name = data.get("_metrics_handler")
+        if name is None:
+            return
+        HANDLER_LATENCY.labels(name).observe(time.perf_counter() - data["_metrics_started"])
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        await self._finish(data)
+
+
+# -------------------------------------------------------------------
+# SQL
+# -------------------------------------------------------------------
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    if started is None:
+        return
+    source = _query_source.get()
+    DB_QUERIES.labels(source).inc()
+    DB_QUERY_DURATION.labels(source).observe(time.perf_counter() - started)
+
+
+def instrument_engines(*engines):
+    """
+    Подписывается на выполнение запросов (для async-движка передавайте .sync_engine).
+    """
+    for target in engines:
+        event.listen(target, "before_cursor_execute", _before_execute)
+        event.listen(target, "after_cursor_execute", _after_execute)
+
+
+# -------------------------------------------------------------------
+# Bot API
+# -------------------------------------------------------------------
+class InstrumentedBot(Bot):
+    """
+    Bot, который меряет каждый вызов Bot API.
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            BOT_API_FLOOD_WAITS.labels(method).inc()
+            raise
+        except Exception as e:
+            BOT_API_ERRORS.labels(method, type(e).__name__).inc()
+            raise
+        finally:
+            BOT_API_LATENCY.labels(method).observe(time.perf_counter() - started)
+
+
+# -------------------------------------------------------------------
+# HTTP-эндпоинт
+# -------------------------------------------------------------------
+async def handle_metrics(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Отдельный aiohttp-сервер с /metrics. Возвращает runner (для cleanup) или None.
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики Prometheus: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,450 @@
+# migrations.py
+"""
+Версионные миграции схемы БД.
+
+Применённые версии записываются в таблицу schema_version. Миграции запускаются
+отдельной командой (один раз на деплой), а бот при старте только сверяет версию
+одним запросом:
+
+    python migrations.py           — применить новые миграции
+    python migrations.py status    — текущая и последняя версии схемы
+
+Параллельные запуски сериализуются advisory-lock'ом Postgres.
+Новая миграция — новый элемент в конце MIGRATIONS со следующим номером.
+"""
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+
+from database import engine, async_engine
+
+# Если схема устарела, бот может применить миграции сам (удобно для локального запуска)
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+# Запуск старого кода на более новой схеме — только явно, после проверки, что
+# новые миграции его не ломают (например, при откате релиза)
+ALLOW_NEWER_SCHEMA = os.getenv("ALLOW_NEWER_SCHEMA", "false").lower() in ("1", "true", "yes")
+
+# Произвольный, но постоянный ключ advisory-lock для миграций
+MIGRATION_LOCK_ID = 4_250_001
+
+
+def _sql(*statements):
+    def apply(conn):
+        for statement in statements:
+            conn.execute(text(statement))
+    return apply
+
+
+# Пересборка агрегатов в схеме версий 3–7 (колонки привычек). Зафиксирована здесь:
+# rollups.rebuild_rollups работает уже с текущей схемой
+_LEGACY_ROLLUPS_SQL = """
+    INSERT INTO habit_rollups
+    SELECT user_id, p.period, date_trunc(p.period, date_of_entry)::date, count(*),
+           count(*) FILTER (WHERE bedtime_before_midnight),
+           count(*) FILTER (WHERE no_gadgets_after_23),
+           count(*) FILTER (WHERE followed_diet),
+           coalesce(sum(sport_hours), 0)
+    FROM daily_logs, (VALUES ('day'), ('week'), ('month'), ('year')) AS p(period)
+    WHERE date_of_entry IS NOT NULL
+    GROUP BY user_id, p.period, date_trunc(p.period, date_of_entry)
+"""
+
+
+def _unique_daily_logs(conn):
+    """
+    Из дублей (user_id, date_of_entry) остаётся самая поздняя запись,
+    затем строится уникальный индекс. Если дубли были — агрегаты пересобираются.
+    """
+    conn.execute(text("LOCK TABLE daily_logs IN SHARE ROW EXCLUSIVE MODE"))
+    deleted = conn.execute(text("""
+        DELETE FROM daily_logs older
+        USING daily_logs newer
+        WHERE older.user_id = newer.user_id
+          AND older.date_of_entry = newer.date_of_entry
+          AND older.id < newer.id
+    """)).rowcount
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_daily_logs_user_date ON daily_logs (user_id, date_of_entry)"
+    ))
+    logging.info(f"Удалено дублей daily_logs: {deleted}")
+    if deleted:
+        conn.execute(text("DELETE FROM habit_rollups"))
+        conn.execute(text(_LEGACY_ROLLUPS_SQL))
+
+
+# Поэлементные операции над векторами привычек (используются агрегатами habit_rollups)
+_HABIT_ARRAY_FUNCTIONS = [
+    *(
+        f"""
+        CREATE OR REPLACE FUNCTION habit_array_add(a {kind}[], b {kind}[]) RETURNS {kind}[]
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT coalesce(array_agg(coalesce(x, 0) + coalesce(y, 0) ORDER BY i), '{{}}')
+            FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+        $$
+        """
+        for kind in ("integer", "double precision")
+    ),
+    *(
+        statement
+        for kind in ("integer", "double precision")
+        for statement in (
+            f"DROP AGGREGATE IF EXISTS habit_array_sum({kind}[])",
+            f"CREATE AGGREGATE habit_array_sum({kind}[]) (SFUNC = habit_array_add, STYPE = {kind}[])",
+        )
+    ),
+    """
+    CREATE OR REPLACE FUNCTION habit_bits(mask bigint, width integer) RETURNS integer[]
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT coalesce(array_agg(((mask >> b) & 1)::integer ORDER BY b), '{}')
+        FROM generate_series(0, width - 1) AS b
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION habit_present(vals double precision[]) RETURNS integer[]
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT coalesce(array_agg((x IS NOT NULL)::integer ORDER BY i), '{}')
+        FROM unnest(vals) WITH ORDINALITY AS t(x, i)
+    $$
+    """,
+]
+
+
+# Пересборка агрегатов в схеме версии 8: три булевы привычки в битах 0–2,
+# sport_hours в numbers[1]. Зафиксирована здесь по той же причине, что и
+# _LEGACY_ROLLUPS_SQL: rollups.rebuild_rollups следует за текущими схемой и HABITS
+_V8_ROLLUPS_SQL = """
+    INSERT INTO habit_rollups (user_id, period, period_start, entries, bool_yes, bool_seen, num_sum, num_seen)
+    SELECT user_id, p.period, date_trunc(p.period, date_of_entry)::date, count(*),
+           coalesce(habit_array_sum(habit_bits(habit_mask & answered_mask, 3)), '{}'),
+           coalesce(habit_array_sum(habit_bits(answered_mask, 3)), '{}'),
+           coalesce(habit_array_sum(numbers), '{}'),
+           coalesce(habit_array_sum(habit_present(numbers)), '{}')
+    FROM daily_logs, (VALUES ('day'), ('week'), ('month'), ('year')) AS p(period)
+    WHERE date_of_entry IS NOT NULL
+    GROUP BY user_id, p.period, date_trunc(p.period, date_of_entry)
+"""
+
+
+def _habit_vectors(conn):
+    """
+    Колонки привычек daily_logs и habit_rollups -> битовые маски и массивы
+    (slot'ы этих привычек закреплены в habits.HABITS). Агрегаты пересобираются.
+    """
+    _sql(*_HABIT_ARRAY_FUNCTIONS)(conn)
+    conn.execute(text("LOCK TABLE daily_logs IN SHARE ROW EXCLUSIVE MODE"))
+    _sql(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS habits VARCHAR(64)[]",
+        """
+        ALTER TABLE daily_logs
+            ADD COLUMN habit_mask BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN answered_mask BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN numbers DOUBLE PRECISION[] NOT NULL DEFAULT '{}'
+        """,
+        """
+        UPDATE daily_logs SET
+            habit_mask = CASE WHEN bedtime_before_midnight THEN 1 ELSE 0 END
+                       | CASE WHEN no_gadgets_after_23 THEN 2 ELSE 0 END
+                       | CASE WHEN followed_diet THEN 4 ELSE 0 END,
+            answered_mask = CASE WHEN bedtime_before_midnight IS NOT NULL THEN 1 ELSE 0 END
+                          | CASE WHEN no_gadgets_after_23 IS NOT NULL THEN 2 ELSE 0 END
+                          | CASE WHEN followed_diet IS NOT NULL THEN 4 ELSE 0 END,
+            numbers = ARRAY[sport_hours]
+        """,
+        """
+        ALTER TABLE daily_logs
+            DROP COLUMN bedtime_before_midnight,
+            DROP COLUMN no_gadgets_after_23,
+            DROP COLUMN followed_diet,
+            DROP COLUMN sport_hours
+        """,
+        """
+        ALTER TABLE habit_rollups
+            DROP COLUMN bedtime_before_midnight,
+            DROP COLUMN no_gadgets_after_23,
+            DROP COLUMN followed_diet,
+            DROP COLUMN sport_hours,
+            ADD COLUMN bool_yes INTEGER[] NOT NULL DEFAULT '{}',
+            ADD COLUMN bool_seen INTEGER[] NOT NULL DEFAULT '{}',
+            ADD COLUMN num_sum DOUBLE PRECISION[] NOT NULL DEFAULT '{}',
+            ADD COLUMN num_seen INTEGER[] NOT NULL DEFAULT '{}'
+        """,
+        "DELETE FROM habit_rollups",
+        _V8_ROLLUPS_SQL,
+    )(conn)
+
+
+# (версия, описание, функция применения). IF NOT EXISTS в первых миграциях —
+# чтобы базы, созданные раньше через create_all, спокойно перешли на миграции.
+MIGRATIONS = [
+    (1, "Базовые таблицы users и daily_logs", _sql(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id INTEGER NOT NULL UNIQUE,
+            username VARCHAR(255),
+            created_at TIMESTAMP WITHOUT TIME ZONE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_logs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            date_of_entry DATE,
+            bedtime_before_midnight BOOLEAN,
+            no_gadgets_after_23 BOOLEAN,
+            followed_diet BOOLEAN,
+            sport_hours DOUBLE PRECISION,
+            created_at TIMESTAMP WITHOUT TIME ZONE
+        )
+        """,
+    )),
+    (2, "Состояния FSM (fsm_states)", _sql(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state VARCHAR(255),
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_fsm_states_updated_at ON fsm_states (updated_at)",
+    )),
+    (3, "Агрегаты habit_rollups", _sql(
+        """
+        CREATE TABLE IF NOT EXISTS habit_rollups (
+            user_id BIGINT NOT NULL,
+            period VARCHAR(8) NOT NULL,
+            period_start DATE NOT NULL,
+            entries INTEGER NOT NULL,
+            bedtime_before_midnight INTEGER NOT NULL,
+            no_gadgets_after_23 INTEGER NOT NULL,
+            followed_diet INTEGER NOT NULL,
+            sport_hours DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, period, period_start)
+        )
+        """,
+        # Базы до появления миграций: агрегаты могли не заполняться
+        """
+        INSERT INTO habit_rollups
+        SELECT user_id, p.period, date_trunc(p.period, date_of_entry)::date, count(*),
+               count(*) FILTER (WHERE bedtime_before_midnight),
+               count(*) FILTER (WHERE no_gadgets_after_23),
+               count(*) FILTER (WHERE followed_diet),
+               coalesce(sum(sport_hours), 0)
+        FROM daily_logs, (VALUES ('day'), ('week'), ('month'), ('year')) AS p(period)
+        WHERE date_of_entry IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM habit_rollups)
+        GROUP BY user_id, p.period, date_trunc(p.period, date_of_entry)
+        """,
+    )),
+    (4, "Уникальность daily_logs (user_id, date_of_entry)", _unique_daily_logs),
+    (5, "daily_logs.username", _sql(
+        "ALTER TABLE daily_logs ADD COLUMN IF NOT EXISTS username VARCHAR(255)",
+    )),
+    (6, "BIGINT для Telegram id (id пользователей больше 2^31)", _sql(
+        "ALTER TABLE users ALTER COLUMN telegram_id TYPE BIGINT",
+        "ALTER TABLE daily_logs ALTER COLUMN user_id TYPE BIGINT",
+    )),
+    (7, "Часовой пояс и время напоминания пользователей", _sql(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'Europe/Moscow'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS reminder_time TIME NOT NULL DEFAULT '08:00'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS next_reminder_at TIMESTAMP WITHOUT TIME ZONE",
+        # Ближайшее reminder_time по местному времени, в UTC
+        """
+        UPDATE users SET next_reminder_at = (
+            (now() AT TIME ZONE timezone)::date + reminder_time
+            + CASE WHEN (now() AT TIME ZONE timezone)::time >= reminder_time
+                   THEN interval '1 day' ELSE interval '0' END
+        ) AT TIME ZONE timezone AT TIME ZONE 'UTC'
+        WHERE next_reminder_at IS NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_users_next_reminder_at ON users (next_reminder_at)",
+    )),
+    (8, "Привычки: битовые маски и массивы вместо колонок, наборы привычек пользователей", _habit_vectors),
+    (9, "Версии истории пользователей (log_versions)", _sql(
+        """
+        CREATE TABLE IF NOT EXISTS log_versions (
+            user_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+    )),
+    (10, "Команды и рейтинги (teams, team_members, team_scores)", _sql(
+        """
+        CREATE TABLE IF NOT EXISTS teams (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(64) NOT NULL,
+            invite_code VARCHAR(16) NOT NULL UNIQUE,
+            owner_id BIGINT NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS team_members (
+            user_id BIGINT PRIMARY KEY,
+            team_id INTEGER NOT NULL REFERENCES teams (id) ON DELETE CASCADE,
+            joined_at TIMESTAMP WITHOUT TIME ZONE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_team_members_team_id ON team_members (team_id)",
+        """
+        CREATE TABLE IF NOT EXISTS team_scores (
+            team_id INTEGER NOT NULL,
+            period VARCHAR(8) NOT NULL,
+            period_start DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            answered INTEGER NOT NULL DEFAULT 0,
+            sport_hours DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (team_id, period, period_start, user_id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_team_scores_done
+        ON team_scores (team_id, period, period_start, done DESC, sport_hours DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_team_scores_sport
+        ON team_scores (team_id, period, period_start, sport_hours DESC, done DESC)
+        """,
+    )),
+    (11, "Журнал рассылок (broadcast_runs, broadcast_deliveries), users.is_active", _sql(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT true",
+        "DROP INDEX IF EXISTS ix_users_next_reminder_at",
+        "CREATE INDEX ix_users_next_reminder_at ON users (next_reminder_at) WHERE is_active",
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_runs (
+            id SERIAL PRIMARY KEY,
+            kind VARCHAR(32) NOT NULL,
+            started_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            heartbeat_at TIMESTAMP WITHOUT TIME ZONE,
+            finished_at TIMESTAMP WITHOUT TIME ZONE,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            unreachable INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_broadcast_runs_unfinished
+        ON broadcast_runs (kind, id) WHERE finished_at IS NULL
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            run_id INTEGER NOT NULL REFERENCES broadcast_runs (id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            updated_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (run_id, chat_id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_broadcast_deliveries_pending
+        ON broadcast_deliveries (run_id, chat_id) WHERE status = 'pending'
+        """,
+    )),
+    (12, "Рейтинг команд по доле выполненных привычек", _sql(
+        "DROP INDEX IF EXISTS ix_team_scores_done",
+        """
+        CREATE INDEX IF NOT EXISTS ix_team_scores_rate
+        ON team_scores (team_id, period, period_start, (CAST(done AS FLOAT) / greatest(answered, 1)) DESC, done DESC)
+        """,
+    )),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+CREATE_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+    )
+"""
+
+
+def _current_version(conn):
+    return conn.execute(text("SELECT coalesce(max(version), 0) FROM schema_version")).scalar()
+
+
+def migrate():
+    """
+    Применяет все ещё не применённые миграции, каждую — в своей транзакции.
+    """
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        conn.commit()
+        try:
+            with conn.begin():
+                conn.execute(text(CREATE_VERSION_TABLE))
+            with conn.begin():
+                current = _current_version(conn)
+
+            for version, description, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+                logging.info(f"Миграция {version}: {description}")
+                with conn.begin():
+                    apply(conn)
+                    conn.execute(
+                        text("INSERT INTO schema_version (version, description) VALUES (:v, :d)"),
+                        {"v": version, "d": description},
+                    )
+            logging.info(f"Схема БД актуальна (версия {LATEST_VERSION})")
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            conn.commit()
+
+
+async def get_schema_version():
+    """
+    Текущая версия схемы (0 — миграции ещё не применялись). Без рефлексии метаданных.
+    """
+    async with async_engine.connect() as conn:
+        exists = await conn.scalar(text("SELECT to_regclass('schema_version')"))
+        if exists is None:
+            return 0
+        return await conn.scalar(text("SELECT coalesce(max(version), 0) FROM schema_version"))
+
+
+async def check_schema_version():
+    """
+    Проверка при старте бота: схема должна быть актуальной. Рефлексия и DDL не выполняются.
+    """
+    version = await get_schema_version()
+    if version == LATEST_VERSION:
+        return
+    if version > LATEST_VERSION:
+        if ALLOW_NEWER_SCHEMA:
+            logging.warning(f"Версия схемы БД ({version}) новее кода ({LATEST_VERSION}): запуск разрешён ALLOW_NEWER_SCHEMA")
+            return
+        raise RuntimeError(
+            f"Версия схемы БД ({version}) новее кода ({LATEST_VERSION}): обновите бота "
+            f"или, если новые миграции с этим кодом совместимы, задайте ALLOW_NEWER_SCHEMA=true"
+        )
+    if AUTO_MIGRATE:
+        logging.warning(f"Схема БД устарела (версия {version}), применяем миграции (AUTO_MIGRATE)")
+        migrate()
+        return
+    raise RuntimeError(
+        f"Схема БД устарела (версия {version}, нужна {LATEST_VERSION}): выполните python migrations.py"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        migrate()
+    elif command == "status":
+        with engine.connect() as conn:
+            exists = conn.execute(text("SELECT to_regclass('schema_version')")).scalar()
+            current = _current_version(conn) if exists else 0
+        print(f"Текущая версия схемы: {current}, последняя: {LATEST_VERSION}")
+    else:
+        sys.exit("Использование: python migrations.py [upgrade|status]")
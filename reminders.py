@@ -0,0 +1,163 @@
+# reminders.py
+"""
+Планирование ежедневных напоминаний по часовым поясам пользователей.
+
+У каждого пользователя есть timezone и reminder_time (местное время) и
+вычисленное по ним next_reminder_at (UTC, индексировано). Планировщик раз в
+минуту забирает порцию пользователей, которым пора написать, и сдвигает им
+next_reminder_at на следующий день. Так нагрузка распределяется по суткам
+вместо одного пика в 08:00, а размер порции ограничивает пик внутри минуты:
+кто не поместился, получит напоминание в следующую минуту. Новым пользователям
+время по умолчанию разносится по окну REMINDER_DEFAULT_SPREAD минут: с одним
+общим 08:00 очередь на утро растёт с числом пользователей, и всё, что не
+успело уйти за REMINDER_MAX_DELAY, пропускалось бы.
+
+Выборка идёт с FOR UPDATE SKIP LOCKED и сдвигом next_reminder_at в той же
+транзакции, поэтому пользователь не будет забран дважды. При нескольких
+репликах каждая выбирает только закреплённые за ней чаты
+(fsm_storage.chat_owner): напоминание запускает опрос, и его состояние FSM
+должна менять та реплика, которая получит ответ. В той же транзакции порция
+записывается прогоном в журнал рассылок (broadcast_log.py): если бот
+остановится посреди отправки, оставшиеся получатели будут досланы — той же
+репликой, у каждой свой тип прогона. Неактивных пользователей (заблокировали
+бота) планировщик не выбирает.
+"""
+import datetime
+import logging
+import os
+import random
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import select, update
+
+from broadcast_log import create_run
+from database import get_async_session, User
+from fsm_storage import BOT_REPLICAS, BOT_REPLICA_INDEX
+from habits import cache_user_habits
+from metrics import REMINDERS_SKIPPED
+
+DEFAULT_TIMEZONE = "Europe/Moscow"
+DEFAULT_REMINDER_TIME = datetime.time(8, 0)
+# Окно (минут от DEFAULT_REMINDER_TIME), по которому разносится время новых пользователей
+REMINDER_DEFAULT_SPREAD = int(os.getenv("REMINDER_DEFAULT_SPREAD", "120"))
+
+# Сколько напоминаний одна реплика отправляет за минуту (~25 сообщений/с с запасом)
+REMINDER_BUCKET_SIZE = int(os.getenv("REMINDER_BUCKET_SIZE", "1200"))
+# Напоминания, опоздавшие сильнее (бот был остановлен), не отправляются, а переносятся
+REMINDER_MAX_DELAY = int(os.getenv("REMINDER_MAX_DELAY", str(2 * 60 * 60)))
+# Тип прогона в журнале рассылок; прерванные прогоны реплики досылает она же
+REMINDER_RUN_KIND = "reminders" if BOT_REPLICAS == 1 else f"reminders:{BOT_REPLICA_INDEX}"
+
+_UTC = datetime.timezone.utc
+
+
+def parse_timezone(name):
+    """
+    ZoneInfo по имени IANA (например, Asia/Almaty) или None, если такого пояса нет.
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def next_reminder_at(timezone, reminder_time, after=None):
+    """
+    Ближайший момент reminder_time по местному времени строго после `after`.
+    Возвращает наивный datetime в UTC (как остальные даты в БД).
+    """
+    tz = ZoneInfo(timezone)
+    after = (after or datetime.datetime.utcnow()).replace(tzinfo=_UTC)
+    local_now = after.astimezone(tz)
+    candidate = datetime.datetime.combine(local_now.date(), reminder_time, tzinfo=tz)
+    if candidate <= local_now:
+        candidate = datetime.datetime.combine(local_now.date() + datetime.timedelta(days=1), reminder_time, tzinfo=tz)
+    return candidate.astimezone(_UTC).replace(tzinfo=None)
+
+
+def default_reminder_time():
+    """
+    Время напоминания нового пользователя: случайная минута в окне
+    REMINDER_DEFAULT_SPREAD после DEFAULT_REMINDER_TIME.
+    """
+    start = DEFAULT_REMINDER_TIME.hour * 60 + DEFAULT_REMINDER_TIME.minute
+    minutes = (start + random.randrange(max(REMINDER_DEFAULT_SPREAD, 1))) % (24 * 60)
+    return datetime.time(minutes // 60, minutes % 60)
+
+
+async def claim_due_reminders(limit=REMINDER_BUCKET_SIZE, now=None):
+    """
+    Забирает до `limit` пользователей, которым пора напомнить, и сдвигает им
+    next_reminder_at. Возвращает (id прогона в журнале рассылок, telegram_id
+    тех, кому нужно отправить напоминание); сильно опоздавшие только
+    переносятся. Если отправлять некому — (None, []).
+    """
+    now = now or datetime.datetime.utcnow()
+    due_filter = [User.next_reminder_at <= now, User.is_active]
+    if BOT_REPLICAS > 1:
+        # Только чаты этой реплики (chat_owner; telegram_id пользователя — id его чата)
+        due_filter.append(User.telegram_id % BOT_REPLICAS == BOT_REPLICA_INDEX)
+    async with get_async_session() as session:
+        result = await session.execute(
+            select(User.id, User.telegram_id, User.timezone, User.reminder_time, User.next_reminder_at, User.habits)
+            .where(*due_filter)
+            .order_by(User.next_reminder_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        rows = result.all()
+        if not rows:
+            return None, []
+        await session.execute(update(User), [
+            {"id": row.id, "next_reminder_at": next_reminder_at(row.timezone, row.reminder_time, now)}
+            for row in rows
+        ])
+        oldest = now - datetime.timedelta(seconds=REMINDER_MAX_DELAY)
+        due = [row for row in rows if row.next_reminder_at >= oldest]
+        skipped = len(rows) - len(due)
+        chat_ids = [row.telegram_id for row in due]
+        run_id = await create_run(session, REMINDER_RUN_KIND, chat_ids, now) if chat_ids else None
+        await session.commit()
+
+    if skipped:
+        REMINDERS_SKIPPED.inc(skipped)
+        logging.warning(
+            f"Пропущено напоминаний: {skipped} (опоздали больше чем на {REMINDER_MAX_DELAY} c) — "
+            f"не хватает REMINDER_BUCKET_SIZE или реплик"
+        )
+    # Напоминанию нужен набор привычек — он уже прочитан вместе с пользователем
+    for row in due:
+        cache_user_habits(row.telegram_id, row.habits)
+    return run_id, chat_ids
+
+
+async def set_reminder(telegram_id, timezone=None, reminder_time=None):
+    """
+    Меняет часовой пояс и/или время напоминания и пересчитывает next_reminder_at.
+    Возвращает (timezone, reminder_time, next_reminder_at) или None, если пользователь не найден.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(
+            select(User).where(User.telegram_id == telegram_id).with_for_update()
+        )
+        user = result.scalar_one_or_none()
+        if user is None:
+            return None
+        if timezone is not None:
+            user.timezone = timezone
+        if reminder_time is not None:
+            user.reminder_time = reminder_time
+        user.next_reminder_at = next_reminder_at(user.timezone, user.reminder_time)
+        await session.commit()
+        return user.timezone, user.reminder_time, user.next_reminder_at
+
+
+async def get_reminder(telegram_id):
+    """
+    (timezone, reminder_time) пользователя или None.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(
+            select(User.timezone, User.reminder_time).where(User.telegram_id == telegram_id)
+        )
+        return result.first()
@@ -0,0 +1,188 @@
+# rollups.py
+"""
+Инкрементальные агрегаты DailyLog по периодам (таблица habit_rollups).
+
+Каждая запись DailyLog добавляется в четыре строки: день, неделя (с понедельника),
+месяц и год. Статистика за период читается одной строкой вместо сканирования логов.
+
+Пересборка агрегатов по существующим данным:
+    python rollups.py backfill
+"""
+import datetime
+import logging
+import sys
+
+import numpy as np
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from database import engine, HabitRollup
+from habits import BOOL_SLOTS, bits, number_matrix
+
+PERIODS = ("day", "week", "month", "year")
+
+# Векторы агрегата: по slot'ам булевых (bool_*) и числовых (num_*) привычек
+VECTORS = ("bool_yes", "bool_seen", "num_sum", "num_seen")
+
+
+def period_start(period, day):
+    """
+    Начало периода, которому принадлежит дата (совпадает с date_trunc в Postgres).
+    """
+    if period == "day":
+        return day
+    if period == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    if period == "year":
+        return day.replace(month=1, day=1)
+    raise ValueError(f"Неизвестный период: {period}")
+
+
+def _record_vectors(record):
+    habit_mask, answered_mask, numbers = record
+    numbers = number_matrix([numbers])[0]
+    return {
+        "bool_yes": bits(habit_mask & answered_mask)[0],
+        "bool_seen": bits(answered_mask)[0],
+        "num_sum": np.nan_to_num(numbers),
+        "num_seen": (~np.isnan(numbers)).astype(np.int32),
+    }
+
+
+def rollup_delta(record, previous=None):
+    """
+    Изменение агрегатов от записи DailyLog. Если `previous` задан (запись
+    за эту дату заменяется), считается только разница.
+    `record` и `previous` — (habit_mask, answered_mask, numbers), см. habits.pack.
+    """
+    delta = _record_vectors(record)
+    delta["entries"] = 1
+    if previous is not None:
+        for column, vector in _record_vectors(previous).items():
+            delta[column] = delta[column] - vector
+        delta["entries"] = 0
+    return delta
+
+
+async def apply_rollup_deltas(session, deltas):
+    """
+    Применяет пачку изменений одним multi-row upsert.
+    `deltas` — список (user_id, date_of_entry, delta из rollup_delta).
+    Изменения, попадающие в одну строку агрегата, суммируются заранее: Postgres
+    не даёт обновить строку дважды в одном INSERT ... ON CONFLICT.
+    Коммит — на стороне вызывающего.
+    """
+    rows = {}
+    for user_id, date_of_entry, delta in deltas:
+        for period in PERIODS:
+            key = (user_id, period, period_start(period, date_of_entry))
+            row = rows.get(key)
+            if row is None:
+                rows[key] = dict(delta)
+            else:
+                for column, value in delta.items():
+                    row[column] = row[column] + value
+    if not rows:
+        return
+
+    # Строки в порядке ключа — параллельные транзакции блокируют их в одном порядке
+    stmt = insert(HabitRollup).values([
+        {
+            "user_id": user_id, "period": period, "period_start": start, "entries": row["entries"],
+            **{column: row[column].tolist() for column in VECTORS},
+        }
+        for (user_id, period, start), row in sorted(rows.items())
+    ])
+    # Векторы складываются поэлементно функцией habit_array_add (миграция 8)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[HabitRollup.user_id, HabitRollup.period, HabitRollup.period_start],
+        set_={
+            "entries": HabitRollup.entries + stmt.excluded.entries,
+            **{
+                column: func.habit_array_add(getattr(HabitRollup, column), getattr(stmt.excluded, column))
+                for column in VECTORS
+            },
+        },
+    )
+    await session.execute(stmt)
+
+
+async def get_rollup(session, user_id, period, day=None):
+    """
+    Агрегат за текущий (или содержащий `day`) период — одна строка или None.
+    """
+    day = day or datetime.date.today()
+    result = await session.execute(
+        select(HabitRollup).where(
+            HabitRollup.user_id == user_id,
+            HabitRollup.period == period,
+            HabitRollup.period_start == period_start(period, day),
+        )
+    )
+    return result.scalar_one_or_none()
+
+
+async def sum_daily_rollups(session, user_id, date_from, date_to=None):
+    """
+    Сумма дневных агрегатов за интервал дат (скользящее окно, например 7 дней).
+    Векторы суммируются поэлементно агрегатом habit_array_sum.
+    """
+    date_to = date_to or datetime.date.today()
+    result = await session.execute(
+        select(
+            func.coalesce(func.sum(HabitRollup.entries), 0).label("entries"),
+            *(func.habit_array_sum(getattr(HabitRollup, column)).label(column) for column in VECTORS),
+        ).where(
+            HabitRollup.user_id == user_id,
+            HabitRollup.period == "day",
+            HabitRollup.period_start >= date_from,
+            HabitRollup.period_start <= date_to,
+        )
+    )
+    return result.one()
+
+
+BACKFILL_SQL = text("""
+    INSERT INTO habit_rollups (user_id, period, period_start, entries, bool_yes, bool_seen, num_sum, num_seen)
+    SELECT
+        user_id,
+        :period,
+        date_trunc(:period, date_of_entry)::date,
+        count(*),
+        coalesce(habit_array_sum(habit_bits(habit_mask & answered_mask, :bool_slots)), '{}'),
+        coalesce(habit_array_sum(habit_bits(answered_mask, :bool_slots)), '{}'),
+        coalesce(habit_array_sum(numbers), '{}'),
+        coalesce(habit_array_sum(habit_present(numbers)), '{}')
+    FROM daily_logs
+    WHERE date_of_entry IS NOT NULL
+    GROUP BY user_id, date_trunc(:period, date_of_entry)
+""")
+
+
+def rebuild_rollups(conn):
+    """
+    Пересобирает habit_rollups из daily_logs в транзакции соединения `conn`.
+    На время пересборки запись в daily_logs блокируется, чтобы не потерять новые строки.
+    """
+    conn.execute(text("LOCK TABLE daily_logs IN SHARE MODE"))
+    conn.execute(text("DELETE FROM habit_rollups"))
+    for period in PERIODS:
+        result = conn.execute(BACKFILL_SQL, {"period": period, "bool_slots": BOOL_SLOTS})
+        logging.info(f"Агрегаты '{period}': {result.rowcount} строк")
+
+
+def backfill_rollups():
+    """
+    Полностью пересобирает habit_rollups одной транзакцией.
+    """
+    with engine.begin() as conn:
+        rebuild_rollups(conn)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("Использование: python rollups.py backfill")
+    backfill_rollups()
@@ -0,0 +1,165 @@
+# sender.py
+"""
+Исходящие вызовы Bot API из хэндлеров.
+
+Все сообщения пользователю идут через Sender:
+  * сообщения в один чат уходят строго по порядку, не больше одного запроса
+    на чат одновременно; общее число запросов в полёте ограничено SEND_CONCURRENCY;
+  * RetryAfter (flood control) обрабатывается централизованно: все отправки
+    ждут указанное время, затем запрос повторяется (до SEND_MAX_RETRIES раз).
+
+BOT_CONNECTIONS_LIMIT и BOT_REQUEST_TIMEOUT — параметры HTTP-пула самого Bot
+(одна aiohttp-сессия на процесс).
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+
+from aiogram.types import InputFile, ReplyKeyboardRemove
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+BOT_CONNECTIONS_LIMIT = int(os.getenv("BOT_CONNECTIONS_LIMIT", "100"))
+BOT_REQUEST_TIMEOUT = float(os.getenv("BOT_REQUEST_TIMEOUT", "10"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "64"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Общий объект вместо ReplyKeyboardRemove() в каждом хэндлере
+REMOVE_KB = ReplyKeyboardRemove()
+
+
+class Sender:
+    """
+    Очередность по чатам, общий лимит параллельности и повторы при flood control.
+    """
+
+    def __init__(self, bot,
+                 concurrency=SEND_CONCURRENCY,
+                 max_retries=SEND_MAX_RETRIES):
+        self.bot = bot
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_locks = {}
+        self._paused_until = 0.0
+        self._background = set()
+
+    # ---------------------------------------------------------------
+    # Базовый вызов
+    # ---------------------------------------------------------------
+    async def _request(self, make_call):
+        """
+        Один вызов Bot API с ограничением параллельности и повторами при RetryAfter.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                async with self._semaphore:
+                    return await make_call()
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Flood control, пауза отправки {e.timeout} c")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.timeout)
+
+    async def _in_chat(self, chat_id, make_call):
+        """
+        Выполняет вызов для чата под его замком (порядок сообщений сохраняется).
+        """
+        # [lock, число ожидающих] — запись удаляется, когда чат никто не ждёт
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._request(make_call)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+    def _spawn(self, coro, what):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+
+        def done(task):
+            self._background.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(f"Ошибка фоновой отправки ({what}): {task.exception()}")
+
+        task.add_done_callback(done)
+
+    # ---------------------------------------------------------------
+    # Сообщения
+    # ---------------------------------------------------------------
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        return await self._in_chat(
+            chat_id, lambda: self.bot.send_message(chat_id, text, reply_markup=reply_markup, **kwargs)
+        )
+
+    async def answer(self, message, text, **kwargs):
+        """
+        Аналог message.answer(...).
+        """
+        return await self.send_message(message.chat.id, text, **kwargs)
+
+    async def reply(self, message, text, **kwargs):
+        """
+        Аналог message.reply(...).
+        """
+        return await self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        return await self._edit(chat_id, lambda: self.bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup, **kwargs
+        ))
+
+    async def edit_reply_markup(self, chat_id, message_id, reply_markup=None):
+        return await self._edit(chat_id, lambda: self.bot.edit_message_reply_markup(
+            chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+        ))
+
+    async def _edit(self, chat_id, make_call):
+        try:
+            return await self._in_chat(chat_id, make_call)
+        except MessageNotModified:
+            # Повторное нажатие той же кнопки — сообщение уже в нужном виде
+            return None
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._in_chat(chat_id, lambda: self.bot.send_document(chat_id, document, **kwargs))
+
+    async def send_photo(self, chat_id, photo, filename="chart.png", **kwargs):
+        """
+        `photo` — байты изображения; файл собирается заново на каждую попытку,
+        чтобы повтор после RetryAfter не отправил уже прочитанный поток.
+        """
+        return await self._in_chat(
+            chat_id, lambda: self.bot.send_photo(chat_id, InputFile(io.BytesIO(photo), filename=filename), **kwargs)
+        )
+
+    # ---------------------------------------------------------------
+    # Callback-запросы
+    # ---------------------------------------------------------------
+    def answer_callback(self, callback_query_id, text=None):
+        """
+        Ответ на callback-запрос (убирает «часики» на кнопке). Не блокирует хэндлер.
+        """
+        self._spawn(
+            self._request(lambda: self.bot.answer_callback_query(callback_query_id, text=text)),
+            "ответ на callback",
+        )
+
+    async def close(self):
+        """
+        Дожидается фоновых отправок (ответы на callback).
+        """
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def as_dict(self):
+        return {
+            "active_chats": len(self._chat_locks),
+            "paused_for": round(max(self._paused_until - time.monotonic(), 0.0), 1),
+        }
@@ -0,0 +1,243 @@
+# survey.py
+"""
+Опрос о привычках, описанный данными.
+
+Вопросы берутся из набора привычек пользователя (habits.get_user_habits);
+по нему работают оба режима:
+
+  * пошаговый (/gather_data, /gather_data_backdated, утреннее напоминание):
+    одно состояние FSM SurveyState.answering, набор привычек, номер шага и
+    ответы — в данных FSM;
+  * компактный (/log): одно сообщение с инлайн-клавиатурой. Весь вектор
+    ответов закодирован в callback_data кнопок, сообщение редактируется на
+    месте, состояние FSM не используется. Нажатие на значение числового
+    вопроса, после которого ответ полный, сохраняет запись (если числовых
+    привычек нет — кнопка «Сохранить»).
+
+Формат callback_data компактного режима:
+    sv:<ГГГГММДД>:<отпечаток набора>:<маска булевых ответов, hex>:<индексы значений>
+например «sv:20240105:3f:5:2» — первый и третий булевы вопросы набора «да»,
+для числового выбран третий вариант. Неотвеченный числовой вопрос — «_»,
+кнопка «Сохранить» — «!». Длина укладывается в лимит Telegram (64 байта)
+для наборов до ~30 числовых привычек.
+"""
+import datetime
+import os
+
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from habits import DEFAULT_HABITS, fingerprint, resolve
+from sender import REMOVE_KB
+
+# За сколько последних дней (включая сегодня) можно вносить данные
+SURVEY_DAYS = 7
+# Какой опрос присылает утреннее напоминание: steps (пошаговый) или compact
+REMINDER_SURVEY_MODE = os.getenv("REMINDER_SURVEY_MODE", "steps")
+CALLBACK_PREFIX = "sv"
+_INDEX_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+_UNSET = "_"
+_SAVE = "!"
+
+YES_NO_KB = ReplyKeyboardMarkup(resize_keyboard=True)
+YES_NO_KB.add("Да", "Нет")
+
+
+class SurveyState(StatesGroup):
+    select_date = State()
+    answering = State()
+
+
+# Состояния прежних цепочек хэндлеров (могли остаться в хранилище FSM) -> шаг опроса
+LEGACY_STATES = {
+    f"{group}:{habit.key}": step
+    for group in ("GatherDataState", "BackdatedDataState")
+    for step, habit in enumerate(DEFAULT_HABITS)
+}
+
+
+# -------------------------------------------------------------------
+# Даты
+# -------------------------------------------------------------------
+def default_date():
+    """
+    Дата записи по умолчанию — вчера (опрос приходит утром).
+    """
+    return datetime.date.today() - datetime.timedelta(days=1)
+
+
+def allowed_dates():
+    """
+    Даты, за которые можно внести данные: последние SURVEY_DAYS дней, начиная с сегодня.
+    """
+    today = datetime.date.today()
+    return [today - datetime.timedelta(days=i) for i in range(SURVEY_DAYS)]
+
+
+def day_title(date):
+    return "вчера" if date == default_date() else date.strftime("%Y-%m-%d")
+
+
+# -------------------------------------------------------------------
+# Пошаговый режим
+# -------------------------------------------------------------------
+def start_data(date, habits):
+    """
+    Данные FSM в начале пошагового опроса. Набор привычек фиксируется на весь опрос.
+    """
+    return {"date": date.strftime("%Y-%m-%d"), "step": 0, "habits": [h.key for h in habits]}
+
+
+def survey_habits(data):
+    """
+    Привычки опроса из данных FSM (у опросов до появления наборов — набор по умолчанию).
+    """
+    return resolve(data.get("habits"))
+
+
+def parse_answer(habit, text):
+    """
+    Значение ответа на вопрос или ValueError с подсказкой для пользователя.
+    """
+    text = text.strip().lower()
+    if habit.kind == "bool":
+        if text not in ("да", "нет"):
+            raise ValueError("Пожалуйста, выберите «да» или «нет».")
+        return (text == "да") != habit.invert
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        raise ValueError("Пожалуйста, введите число (например 1.5).") from None
+
+
+def _keyboard_for(habit):
+    return YES_NO_KB if habit.kind == "bool" else REMOVE_KB
+
+
+def question_markup(habits, step):
+    """
+    Reply-клавиатура для вопроса. Клавиатура остаётся на экране между сообщениями,
+    поэтому отправляется, только когда меняется.
+    """
+    keyboard = _keyboard_for(habits[step])
+    if step > 0 and _keyboard_for(habits[step - 1]) is keyboard:
+        return None
+    return keyboard
+
+
+def error_markup(habit):
+    return YES_NO_KB if habit.kind == "bool" else None
+
+
+def question_text(habit, date):
+    return habit.question.format(day=day_title(date))
+
+
+def saved_text(date, created):
+    return f"Данные за {date.strftime('%Y-%m-%d')} {'успешно сохранены' if created else 'обновлены'}! Спасибо!"
+
+
+# -------------------------------------------------------------------
+# Компактный режим
+# -------------------------------------------------------------------
+def _split(habits):
+    return [h for h in habits if h.kind == "bool"], [h for h in habits if h.kind == "number"]
+
+
+def encode_callback(date, habits, mask, indexes, save=False):
+    numbers = _SAVE if save else "".join(_UNSET if i is None else _INDEX_CHARS[i] for i in indexes)
+    return f"{CALLBACK_PREFIX}:{date.strftime('%Y%m%d')}:{fingerprint(habits)}:{mask:x}:{numbers}"
+
+
+def decode_callback(data, habits):
+    """
+    (date, mask, indexes, save) из callback_data или ValueError, если данные
+    повреждены, созданы для другого набора привычек или дата вне допустимого диапазона.
+    """
+    bools, numbers = _split(habits)
+    prefix, date_str, habits_fp, mask_str, encoded = data.split(":")
+    date = datetime.datetime.strptime(date_str, "%Y%m%d").date()
+    mask = int(mask_str, 16)
+    if (prefix != CALLBACK_PREFIX or habits_fp != fingerprint(habits) or date not in allowed_dates()
+            or not 0 <= mask < 2 ** len(bools)):
+        raise ValueError(f"Некорректные данные опроса: {data}")
+    if encoded == _SAVE and not numbers:
+        return date, mask, [], True
+    if len(encoded) != len(numbers):
+        raise ValueError(f"Некорректные данные опроса: {data}")
+    indexes = []
+    for char, habit in zip(encoded, numbers):
+        if char == _UNSET:
+            indexes.append(None)
+            continue
+        index = _INDEX_CHARS.find(char)
+        if not 0 <= index < len(habit.choices):
+            raise ValueError(f"Некорректные данные опроса: {data}")
+        indexes.append(index)
+    return date, mask, indexes, False
+
+
+def is_complete(indexes, save):
+    return save or (bool(indexes) and all(i is not None for i in indexes))
+
+
+def compact_values(habits, mask, indexes):
+    """
+    Ответы записи из закодированного вектора: булевы — по битам маски, числовые — по индексам.
+    """
+    bools, numbers = _split(habits)
+    values = {habit.key: bool(mask >> bit & 1) for bit, habit in enumerate(bools)}
+    values.update({habit.key: float(habit.choices[i]) for habit, i in zip(numbers, indexes)})
+    return values
+
+
+def compact_text(date, habits):
+    _, numbers = _split(habits)
+    if not numbers:
+        action = "нажмите «Сохранить»"
+    else:
+        action = f"выберите значение ({', '.join(h.label.lower() for h in numbers)}) — запись сохранится сразу"
+    return f"Данные за {date.strftime('%Y-%m-%d')}.\nОтметьте выполненное и {action}."
+
+
+def compact_keyboard(date, habits, mask=0, indexes=None):
+    """
+    Инлайн-клавиатура: по кнопке-переключателю на булеву привычку и ряд вариантов
+    на числовую. Каждая кнопка несёт вектор ответов, который получится после нажатия.
+    """
+    bools, numbers = _split(habits)
+    indexes = list(indexes) if indexes is not None else [None] * len(numbers)
+    keyboard = InlineKeyboardMarkup()
+    for bit, habit in enumerate(bools):
+        checked = mask >> bit & 1
+        keyboard.row(InlineKeyboardButton(
+            f"{'✅' if checked else '⬜'} {habit.label}",
+            callback_data=encode_callback(date, habits, mask ^ (1 << bit), indexes),
+        ))
+    for position, habit in enumerate(numbers):
+        buttons = []
+        for index, choice in enumerate(habit.choices):
+            picked = indexes[:position] + [index] + indexes[position + 1:]
+            selected = "• " if indexes[position] == index else ""
+            buttons.append(InlineKeyboardButton(
+                f"{selected}{choice:g} {habit.unit}".strip(),
+                callback_data=encode_callback(date, habits, mask, picked),
+            ))
+        keyboard.row(*buttons)
+    if not numbers:
+        keyboard.row(InlineKeyboardButton("Сохранить", callback_data=encode_callback(date, habits, mask, [], True)))
+    return keyboard
+
+
+def summary(habits, values):
+    """
+    Итог записи для сообщения после сохранения.
+    """
+    lines = []
+    for habit in habits:
+        value = values[habit.key]
+        if habit.kind == "bool":
+            lines.append(f"{'✅' if value else '❌'} {habit.label}")
+        else:
+            lines.append(f"{habit.label}: {value:g} {habit.unit}".strip())
+    return "\n".join(lines)
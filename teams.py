@@ -0,0 +1,272 @@
+# teams.py
+"""
+Команды и рейтинги участников (/team_create, /join, /team_leave, /leaderboard).
+
+Очки участника за неделю и месяц хранятся готовыми в team_scores и
+обновляются инкрементально в той же транзакции, что и habit_rollups
+(logbook.save_daily_logs): одна multi-row вставка на пачку записей, только для
+пользователей, состоящих в команде. Рейтинг — чтение первых k строк индекса
+(team_id, period, period_start, очки DESC): O(k), без пересчёта логов участников.
+Собственное место участника вне топа — число строк индекса выше его, но не
+больше LEADERBOARD_RANK_LIMIT: дальше место показывается как «N+».
+
+Очки:
+  * done / answered — выполненные привычко-дни (ответы «да» по булевым
+    привычкам) из отвеченных; рейтинг по умолчанию — по их доле, чтобы
+    отвечающие не каждый день не проигрывали только из-за числа записей;
+  * sport_hours — сумма часов спорта.
+
+При вступлении очки участника заполняются из его habit_rollups; чтобы
+параллельная запись не потерялась и не посчиталась дважды, вступление берёт ту
+же блокировку, что и запись логов (строка log_versions пользователя).
+"""
+import datetime
+import os
+import secrets
+import string
+
+from sqlalchemy import delete, func, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from database import get_async_session, LogVersion, Team, TeamMember, TeamScore, User, TEAM_SCORE_RATE
+from habits import BY_KEY
+from rollups import period_start
+
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))
+# Дальше этого места точная позиция не считается (подсчёт — O(места))
+LEADERBOARD_RANK_LIMIT = int(os.getenv("LEADERBOARD_RANK_LIMIT", "1000"))
+TEAM_PERIODS = ("week", "month")
+INVITE_CODE_LENGTH = 8
+_INVITE_ALPHABET = string.ascii_uppercase + string.digits
+
+SPORT_SLOT = BY_KEY["sport_hours"].slot
+METRICS = {
+    "rate": (TEAM_SCORE_RATE, TeamScore.done),
+    "sport": (TeamScore.sport_hours, TeamScore.done),
+}
+
+# Изменения очков пачки записей: строки — только для участников команд
+_APPLY_SCORES_SQL = text("""
+    INSERT INTO team_scores AS s (team_id, period, period_start, user_id, done, answered, sport_hours)
+    SELECT m.team_id, d.period, d.period_start, d.user_id, d.done, d.answered, d.sport_hours
+    FROM unnest(
+        CAST(:user_ids AS bigint[]), CAST(:periods AS varchar[]), CAST(:starts AS date[]),
+        CAST(:done AS integer[]), CAST(:answered AS integer[]), CAST(:sport_hours AS double precision[])
+    ) AS d(user_id, period, period_start, done, answered, sport_hours)
+    JOIN team_members m ON m.user_id = d.user_id
+    ORDER BY m.team_id, d.period, d.period_start, d.user_id
+    ON CONFLICT (team_id, period, period_start, user_id) DO UPDATE SET
+        done = s.done + excluded.done,
+        answered = s.answered + excluded.answered,
+        sport_hours = s.sport_hours + excluded.sport_hours
+""")
+
+# Очки нового участника — из уже посчитанных агрегатов за недели и месяцы
+_BACKFILL_SCORES_SQL = text("""
+    INSERT INTO team_scores (team_id, period, period_start, user_id, done, answered, sport_hours)
+    SELECT :team_id, period, period_start, user_id,
+           (SELECT coalesce(sum(x), 0) FROM unnest(bool_yes) AS x),
+           (SELECT coalesce(sum(x), 0) FROM unnest(bool_seen) AS x),
+           coalesce(num_sum[:sport_index], 0)
+    FROM habit_rollups
+    WHERE user_id = :user_id AND period IN ('week', 'month')
+""")
+
+
+# -------------------------------------------------------------------
+# Инкрементальное обновление (из logbook.save_daily_logs)
+# -------------------------------------------------------------------
+async def apply_score_deltas(session, deltas):
+    """
+    Применяет изменения агрегатов пачки (те же, что в rollups.apply_rollup_deltas)
+    к очкам участников команд. Коммит — на стороне вызывающего.
+    """
+    rows = {}
+    for user_id, date_of_entry, delta in deltas:
+        done = int(delta["bool_yes"].sum())
+        answered = int(delta["bool_seen"].sum())
+        sport = float(delta["num_sum"][SPORT_SLOT]) if SPORT_SLOT < len(delta["num_sum"]) else 0.0
+        if not (done or answered or sport):
+            continue
+        for period in TEAM_PERIODS:
+            key = (user_id, period, period_start(period, date_of_entry))
+            row = rows.setdefault(key, [0, 0, 0.0])
+            row[0] += done
+            row[1] += answered
+            row[2] += sport
+    if not rows:
+        return
+    keys = sorted(rows)
+    await session.execute(_APPLY_SCORES_SQL, {
+        "user_ids": [user_id for user_id, _, _ in keys],
+        "periods": [period for _, period, _ in keys],
+        "starts": [start for _, _, start in keys],
+        "done": [rows[key][0] for key in keys],
+        "answered": [rows[key][1] for key in keys],
+        "sport_hours": [rows[key][2] for key in keys],
+    })
+
+
+# -------------------------------------------------------------------
+# Команды и участники
+# -------------------------------------------------------------------
+def _invite_code():
+    return "".join(secrets.choice(_INVITE_ALPHABET) for _ in range(INVITE_CODE_LENGTH))
+
+
+async def _lock_user_logs(session, user_id):
+    """
+    Блокировка, которую берёт и save_daily_logs: до коммита вступления записи
+    пользователя ждут, а уже начатые — успевают закоммититься.
+    """
+    await session.execute(
+        insert(LogVersion).values(user_id=user_id, version=0)
+        .on_conflict_do_update(index_elements=[LogVersion.user_id], set_={"version": LogVersion.version})
+    )
+
+
+async def _join(session, user_id, team_id):
+    await _lock_user_logs(session, user_id)
+    await session.execute(delete(TeamScore).where(TeamScore.user_id == user_id))
+    await session.execute(
+        insert(TeamMember).values(user_id=user_id, team_id=team_id)
+        .on_conflict_do_update(index_elements=[TeamMember.user_id], set_={"team_id": team_id})
+    )
+    await session.execute(_BACKFILL_SCORES_SQL, {
+        "team_id": team_id, "user_id": user_id, "sport_index": SPORT_SLOT + 1,
+    })
+
+
+async def create_team(owner_id, name):
+    """
+    Создаёт команду; создатель становится её участником (и выходит из прежней).
+    """
+    async with get_async_session() as session:
+        team = Team(name=name, invite_code=_invite_code(), owner_id=owner_id)
+        session.add(team)
+        await session.flush()
+        await _join(session, owner_id, team.id)
+        await session.commit()
+    return team
+
+
+async def join_team(user_id, invite_code):
+    """
+    Вступление по коду приглашения. Возвращает команду или None, если код неверный.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(select(Team).where(Team.invite_code == invite_code.upper()))
+        team = result.scalar_one_or_none()
+        if team is None:
+            return None
+        await _join(session, user_id, team.id)
+        await session.commit()
+    return team
+
+
+async def leave_team(user_id):
+    """
+    Выход из команды. Возвращает команду или None, если пользователь ни в одной не состоит.
+    """
+    async with get_async_session() as session:
+        team = await _user_team(session, user_id)
+        if team is None:
+            return None
+        await _lock_user_logs(session, user_id)
+        await session.execute(delete(TeamMember).where(TeamMember.user_id == user_id))
+        await session.execute(delete(TeamScore).where(TeamScore.user_id == user_id))
+        await session.commit()
+    return team
+
+
+async def _user_team(session, user_id):
+    result = await session.execute(
+        select(Team).join(TeamMember, TeamMember.team_id == Team.id).where(TeamMember.user_id == user_id)
+    )
+    return result.scalar_one_or_none()
+
+
+# -------------------------------------------------------------------
+# Рейтинг
+# -------------------------------------------------------------------
+async def get_leaderboard(user_id, period="week", metric="rate", day=None, limit=LEADERBOARD_SIZE):
+    """
+    Топ команды пользователя за текущий период и его собственное место.
+    Возвращает None, если пользователь не в команде, иначе словарь:
+    team, period_start, top — [(место, имя, done, answered, sport_hours)], me — то же.
+    Участник без очков за период стоит после всех, у кого они есть. Место за
+    пределами LEADERBOARD_RANK_LIMIT — строка «N+».
+    """
+    start = period_start(period, day or datetime.date.today())
+    order = METRICS[metric]
+    async with get_async_session() as session:
+        team = await _user_team(session, user_id)
+        if team is None:
+            return None
+        scope = (TeamScore.team_id == team.id, TeamScore.period == period, TeamScore.period_start == start)
+        result = await session.execute(
+            select(TeamScore.user_id, User.username, TeamScore.done, TeamScore.answered, TeamScore.sport_hours)
+            .outerjoin(User, User.telegram_id == TeamScore.user_id)
+            .where(*scope)
+            .order_by(*(column.desc() for column in order), TeamScore.user_id)
+            .limit(limit)
+        )
+        top = [(place, *row) for place, row in enumerate(result.all(), 1)]
+
+        me = next((row for row in top if row[1] == user_id), None)
+        if me is None:
+            own = (await session.execute(
+                select(TeamScore.done, TeamScore.answered, TeamScore.sport_hours, *order)
+                .where(*scope, TeamScore.user_id == user_id)
+            )).one_or_none()
+            if own is not None:
+                # Место = число участников выше в том же порядке, что и топ: больше
+                # очков (просмотр начала индекса), затем равные с меньшим user_id
+                points, mine = tuple_(*order), tuple_(*own[3:])
+                ahead = await _count_capped(session, *scope, points > mine)
+                if ahead < LEADERBOARD_RANK_LIMIT:
+                    ahead += await _count_capped(session, *scope, points == mine, TeamScore.user_id < user_id)
+                me = (_place(ahead), user_id, None, *own[:3])
+            else:
+                # Очков за период ещё нет — после всех, у кого они есть
+                me = (_place(await _count_capped(session, *scope)), user_id, None, 0, 0, 0.0)
+    return {"team": team, "period_start": start, "top": top, "me": me}
+
+
+async def _count_capped(session, *conditions):
+    """
+    Число строк team_scores по условиям, но не больше LEADERBOARD_RANK_LIMIT.
+    """
+    rows = select(TeamScore.user_id).where(*conditions).limit(LEADERBOARD_RANK_LIMIT).subquery()
+    return (await session.execute(select(func.count()).select_from(rows))).scalar_one()
+
+
+def _place(ahead):
+    return ahead + 1 if ahead < LEADERBOARD_RANK_LIMIT else f"{LEADERBOARD_RANK_LIMIT}+"
+
+
+PERIOD_TITLES = {"week": "неделю", "month": "месяц"}
+
+
+def _score_line(place, user_id, username, done, answered, sport_hours):
+    name = f"@{username}" if username else f"участник …{str(user_id)[-4:]}"
+    if not answered and not sport_hours:
+        return f"{place}. {name} — пока без очков"
+    rate = f"{done / answered * 100:.0f}%" if answered else "—"
+    return f"{place}. {name} — {rate} ({done} из {answered}), спорт {sport_hours:g} ч"
+
+
+def format_leaderboard(board, period, metric):
+    by = "часам спорта" if metric == "sport" else "доле выполненных привычек"
+    lines = [
+        f"Команда «{board['team'].name}»: рейтинг за {PERIOD_TITLES[period]} "
+        f"(с {board['period_start'].strftime('%Y-%m-%d')}) по {by}",
+        f"Код приглашения: {board['team'].invite_code}\n",
+    ]
+    if not board["top"]:
+        lines.append("За этот период ещё нет записей.")
+    lines += [_score_line(*row) for row in board["top"]]
+    me = board["me"]
+    if me not in board["top"]:
+        lines += ["…", _score_line(*me)]
+    return "\n".join(lines)
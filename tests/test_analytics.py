@@ -0,0 +1,112 @@
+# tests/test_analytics.py
+"""
+Метрики /insights: серии, динамика неделя к неделе и попарные корреляции.
+История собирается в памяти так же, как load_history раскладывает записи
+из БД, — БД не нужна.
+"""
+import datetime
+import math
+
+import numpy as np
+import pytest
+
+from analytics import History, TREND_DAYS, pairwise_correlations, run_lengths, streaks, trends
+from habits import BOOL_SLOTS, BY_KEY, NUMBER_SLOTS, bits, number_matrix, pack
+
+START = datetime.date(2024, 3, 1)
+BED, DIET, SPORT = (BY_KEY[key] for key in ("bedtime_before_midnight", "followed_diet", "sport_hours"))
+
+
+def history(days):
+    """
+    История из списка {ключ: значение} по дням подряд; None — записи за день нет.
+    Последний день — «сегодня».
+    """
+    count = len(days)
+    yes = np.zeros((count, BOOL_SLOTS), dtype=np.int32)
+    answered = np.zeros((count, BOOL_SLOTS), dtype=np.int32)
+    numbers = np.full((count, NUMBER_SLOTS), np.nan)
+    entries = [(i, pack(values)) for i, values in enumerate(days) if values is not None]
+    index = [i for i, _ in entries]
+    row_answered = bits([packed[1] for _, packed in entries])
+    answered[index] = row_answered
+    yes[index] = bits([packed[0] for _, packed in entries]) & row_answered
+    numbers[index] = number_matrix([packed[2] for _, packed in entries])
+    return History(START, count, len(entries), yes, answered, numbers)
+
+
+def test_run_lengths():
+    success = np.array([[1, 0], [1, 1], [0, 1], [1, 1], [1, 1]], dtype=bool)
+
+    assert run_lengths(success).tolist() == [[1, 0], [2, 1], [0, 2], [1, 3], [2, 4]]
+
+
+def test_streaks_current_and_best():
+    days = [{"bedtime_before_midnight": True}] * 4 + [{"bedtime_before_midnight": False}] + \
+           [{"bedtime_before_midnight": True}] * 2
+
+    assert streaks(history(days), (BED,)) == [(BED, 2, 4)]
+
+
+def test_streak_survives_unanswered_today():
+    # Сегодня ответа ещё нет — серия считается по вчера
+    days = [{"bedtime_before_midnight": True}] * 3 + [None]
+
+    assert streaks(history(days), (BED,)) == [(BED, 3, 3)]
+
+
+def test_streak_broken_by_missing_day_or_no():
+    days = [{"bedtime_before_midnight": True, "followed_diet": True}] * 3 + [None] + \
+           [{"bedtime_before_midnight": True, "followed_diet": False}] * 2
+
+    # Пропущенный день серию прерывает; «нет» по одной привычке не трогает другую
+    assert streaks(history(days), (BED, DIET)) == [(BED, 2, 3), (DIET, 0, 3)]
+
+
+def test_streaks_skip_number_habits():
+    assert streaks(history([{"sport_hours": 1}]), (SPORT,)) == []
+
+
+def test_trends_week_over_week():
+    previous = [{"bedtime_before_midnight": i < 2, "sport_hours": 1.0} for i in range(TREND_DAYS)]
+    current = [{"bedtime_before_midnight": i < 5, "sport_hours": 2.0 if i % 2 else None} for i in range(TREND_DAYS)]
+
+    result = trends(history(previous + current), (BED, SPORT))
+
+    assert result[0][0] == BED and result[0][1:] == pytest.approx((5 / 7, 2 / 7))
+    # Среднее — только по дням с ответом
+    assert result[1] == (SPORT, 2.0, 1.0)
+
+
+def test_trends_without_previous_week():
+    result = trends(history([{"bedtime_before_midnight": True}, {"bedtime_before_midnight": False}]), (BED, SPORT))
+
+    # Нет ответов в окне: предыдущая неделя — NaN, привычка без ответов не показывается
+    assert len(result) == 1
+    habit, now, before = result[0]
+    assert habit == BED and now == 0.5 and math.isnan(before)
+
+
+def test_pairwise_correlations_match_numpy():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(40, 3))
+    matrix[:, 2] = 2 * matrix[:, 0] + rng.normal(scale=0.1, size=40)
+    matrix[rng.random((40, 3)) < 0.2] = np.nan
+
+    r, n = pairwise_correlations(matrix)
+
+    for a in range(3):
+        for b in range(3):
+            both = ~np.isnan(matrix[:, a]) & ~np.isnan(matrix[:, b])
+            assert n[a, b] == both.sum()
+            assert r[a, b] == pytest.approx(np.corrcoef(matrix[both, a], matrix[both, b])[0, 1])
+    assert r[0, 2] > 0.95
+
+
+def test_pairwise_correlations_constant_column():
+    matrix = np.array([[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]])
+
+    r, n = pairwise_correlations(matrix)
+
+    # Без разброса корреляция не определена
+    assert math.isnan(r[0, 1]) and n[0, 1] == 3
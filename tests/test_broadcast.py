@@ -0,0 +1,139 @@
+# tests/test_broadcast.py
+"""
+Ограничители скорости рассылки: TokenBucket и PerChatLimiter. Время
+подменяется часами, которые двигает asyncio.sleep, — тесты не ждут и не
+зависят от загрузки машины. БД не нужна.
+"""
+import asyncio
+import types
+
+import pytest
+
+import broadcast
+from broadcast import PerChatLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        # Настоящий sleep не просыпается раньше срока: без этого запаса ожидание
+        # остатка токена в 1e-16 с не сдвигает часы, и acquire крутится вечно
+        self.now += max(0.0, seconds) + 1e-9
+        await _real_sleep(0)
+
+
+_real_sleep = asyncio.sleep
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(broadcast, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=10, capacity=5)
+
+    async def run():
+        times = []
+        for _ in range(25):
+            await bucket.acquire()
+            times.append(clock.now)
+        return times
+
+    times = asyncio.run(run())
+
+    # Запас capacity уходит сразу, дальше — по токену в 1 / rate секунд
+    assert times[:5] == [1000.0] * 5
+    assert times[-1] - times[0] == pytest.approx(2.0, abs=1e-6)
+    gaps = [b - a for a, b in zip(times[5:], times[6:])]
+    assert all(gap == pytest.approx(0.1, abs=1e-6) for gap in gaps)
+
+
+def test_token_bucket_refills_while_idle(clock):
+    bucket = TokenBucket(rate=2, capacity=4)
+
+    async def run():
+        for _ in range(4):
+            await bucket.acquire()
+        clock.now += 10  # простой дольше, чем нужно на полный запас
+        started = clock.now
+        for _ in range(4):
+            await bucket.acquire()
+        waited = clock.now - started
+        await bucket.acquire()
+        return waited, clock.now - started
+
+    waited, total = asyncio.run(run())
+
+    # Запас не больше capacity: четыре токена сразу, пятый — через 1 / rate
+    assert waited == pytest.approx(0, abs=1e-6)
+    assert total == pytest.approx(0.5, abs=1e-6)
+
+
+def test_token_bucket_pause(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+
+    async def run():
+        await bucket.acquire()
+        bucket.pause(3)
+        bucket.pause(1)  # более короткая пауза не сокращает уже назначенную
+        started = clock.now
+        await bucket.acquire()
+        return clock.now - started
+
+    # Пауза обнуляет запас: после неё ждём ещё один токен
+    assert asyncio.run(run()) == pytest.approx(3.1, abs=1e-6)
+
+
+def test_token_bucket_concurrent_acquires(clock):
+    bucket = TokenBucket(rate=5, capacity=1)
+
+    async def run():
+        started = clock.now
+        await asyncio.gather(*(bucket.acquire() for _ in range(11)))
+        return clock.now - started
+
+    assert asyncio.run(run()) == pytest.approx(2.0, abs=1e-6)
+
+
+def test_per_chat_limiter_interval(clock):
+    limiter = PerChatLimiter(interval=1.0)
+
+    async def run():
+        sent = []
+        for chat_id in (1, 2, 1, 1, 2):
+            await limiter.wait(chat_id)
+            sent.append((chat_id, clock.now - 1000.0))
+        return sent
+
+    sent = asyncio.run(run())
+
+    # Разные чаты не ждут друг друга; в один чат — не чаще интервала
+    assert sent[0] == (1, 0.0) and sent[1] == (2, 0.0)
+    assert sent[2] == (1, pytest.approx(1.0, abs=1e-6))
+    assert sent[3] == (1, pytest.approx(2.0, abs=1e-6))
+    # Чат 2 отдыхал дольше интервала, пока ждал чат 1
+    assert sent[4] == (2, pytest.approx(2.0, abs=1e-6))
+
+
+def test_per_chat_limiter_prunes_old_chats(clock):
+    limiter = PerChatLimiter(interval=1.0, max_tracked=3)
+
+    async def run():
+        for chat_id in range(3):
+            await limiter.wait(chat_id)
+        clock.now += 5
+        await limiter.wait(99)
+
+    asyncio.run(run())
+
+    # Отработавшие интервал чаты забыты, свежий остался
+    assert list(limiter._last_sent) == [99]
@@ -0,0 +1,71 @@
+# tests/test_habits.py
+"""
+Упаковка ответов в habit_mask / answered_mask / numbers и обратно.
+БД не нужна.
+"""
+import numpy as np
+
+import habits
+from habits import BY_KEY, HABITS, bits, pack, resolve, unpack
+
+
+def test_pack_bool_and_number_slots():
+    habit_mask, answered_mask, numbers = pack({
+        "bedtime_before_midnight": True,   # slot 0
+        "no_gadgets_after_23": False,      # slot 1
+        "reading": True,                   # slot 5
+        "sleep_hours": 7,                  # number slot 1
+    })
+
+    assert habit_mask == 0b100001
+    assert answered_mask == 0b100011
+    # Числа — float, пропуски — None, хвостовые None отрезаны
+    assert numbers == [None, 7.0]
+
+
+def test_pack_without_answers():
+    assert pack({}) == (0, 0, [])
+    # Число без ответа не занимает элементов массива
+    assert pack({"sport_hours": None}) == (0, 0, [])
+
+
+def test_unpack_reverses_pack():
+    values = {
+        "bedtime_before_midnight": False, "followed_diet": True, "meditation": False,
+        "sport_hours": 1.5, "steps": 8.0,
+    }
+
+    assert unpack(*pack(values)) == values
+
+
+def test_unpack_every_habit():
+    values = {h.key: (True if h.kind == "bool" else float(h.slot + 1)) for h in HABITS}
+
+    assert unpack(*pack(values)) == values
+
+
+def test_unpack_ignores_unanswered_bits_and_short_numbers():
+    # Бит «да» без бита ответа не считается ответом; старые строки — без numbers
+    assert unpack(0b11, 0b01, None) == {"bedtime_before_midnight": True}
+    assert unpack(0, 0, [2.0]) == {"sport_hours": 2.0}
+
+
+def test_bits_matrix():
+    matrix = bits([0b101, 0, 0b110], width=3)
+
+    assert matrix.dtype == np.int32
+    assert matrix.tolist() == [[1, 0, 1], [0, 0, 0], [0, 1, 1]]
+
+
+def test_bits_high_slot():
+    slot = habits.MAX_BOOL_SLOTS - 1
+    matrix = bits([1 << slot], width=habits.MAX_BOOL_SLOTS)
+
+    assert matrix[0, slot] == 1 and matrix.sum() == 1
+
+
+def test_resolve_keeps_registry_order():
+    assert resolve(None) == habits.DEFAULT_HABITS
+    assert resolve(["sport_hours", "bedtime_before_midnight", "removed_habit"]) == (
+        BY_KEY["bedtime_before_midnight"], BY_KEY["sport_hours"],
+    )
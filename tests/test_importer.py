@@ -0,0 +1,86 @@
+# tests/test_importer.py
+"""
+Загрузка файла в формате старой выгрузки /export_excel (до реестра привычек).
+БД не нужна: проверяется разбор и dry-run загрузка.
+"""
+import asyncio
+import datetime
+
+from openpyxl import Workbook
+
+from importer import import_file, parse_batch, parse_header, read_rows, ImportReport
+
+# Заголовок и строки — как их писала старая выгрузка
+BASELINE_HEADER = [
+    "ID",
+    "Дата",
+    "Лёг до 00:00",
+    "Не использовал гаджеты после 23:00",
+    "Питался по рациону",
+    "Часы спорта",
+    "Дата записи (UTC)",
+]
+BASELINE_ROWS = [
+    [1, "2024-03-01", "Да", "Нет", "Да", "1.5", "2024-03-01 21:10:00"],
+    [2, "2024-03-02", "Нет", "Да", "Нет", "0.0", "2024-03-02 22:05:00"],
+    [3, "2024-03-03", "Да", "Да", "Да", "None", "2024-03-03 23:30:00"],
+]
+
+
+def write_baseline_xlsx(path):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Habit Logs"
+    ws.append(BASELINE_HEADER)
+    for row in BASELINE_ROWS:
+        ws.append(row)
+    wb.save(path)
+
+
+def test_baseline_header_is_recognized(tmp_path):
+    path = tmp_path / "export.xlsx"
+    write_baseline_xlsx(path)
+    rows = list(read_rows(str(path)))
+
+    date_index, columns, unknown = parse_header(rows[0])
+
+    assert date_index == 1
+    assert [habit.key for _, habit in columns] == [
+        "bedtime_before_midnight", "no_gadgets_after_23", "followed_diet", "sport_hours",
+    ]
+    assert unknown == []
+
+
+def test_baseline_rows_are_parsed(tmp_path):
+    path = tmp_path / "export.xlsx"
+    write_baseline_xlsx(path)
+    rows = list(read_rows(str(path)))
+    report = ImportReport()
+
+    entries = parse_batch(rows[1:], 2, parse_header(rows[0]), datetime.date(2024, 12, 31), report)
+
+    assert report.rows == 3 and report.skipped == 0
+    assert entries == [
+        (datetime.date(2024, 3, 1), {
+            "bedtime_before_midnight": True, "no_gadgets_after_23": False,
+            "followed_diet": True, "sport_hours": 1.5,
+        }),
+        (datetime.date(2024, 3, 2), {
+            "bedtime_before_midnight": False, "no_gadgets_after_23": True,
+            "followed_diet": False, "sport_hours": 0.0,
+        }),
+        # Пустые часы спорта старая выгрузка писала как «None» — ответа не было
+        (datetime.date(2024, 3, 3), {
+            "bedtime_before_midnight": True, "no_gadgets_after_23": True, "followed_diet": True,
+        }),
+    ]
+
+
+def test_baseline_file_dry_run(tmp_path):
+    path = tmp_path / "export.xlsx"
+    write_baseline_xlsx(path)
+
+    report = asyncio.run(import_file(1, str(path), dry_run=True))
+
+    assert (report.rows, report.imported, report.skipped) == (3, 3, 0)
+    assert report.unknown_columns == []
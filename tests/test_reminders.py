@@ -0,0 +1,101 @@
+# tests/test_reminders.py
+"""
+Расчёт next_reminder_at по часовым поясам, в том числе на переходах на летнее
+и зимнее время, и разнесение времени напоминаний новых пользователей. БД не нужна.
+"""
+import datetime
+import random
+
+import pytest
+
+import reminders
+from reminders import default_reminder_time, next_reminder_at, parse_timezone
+
+dt = datetime.datetime
+EIGHT = datetime.time(8, 0)
+
+
+@pytest.mark.parametrize("timezone, after, expected", [
+    # Без летнего времени
+    ("Europe/Moscow", dt(2024, 6, 1, 4, 0), dt(2024, 6, 1, 5, 0)),
+    ("Asia/Kolkata", dt(2024, 6, 1, 4, 0), dt(2024, 6, 2, 2, 30)),
+    # Местная дата уже следующая: в Окленде 11 января, 01:00
+    ("Pacific/Auckland", dt(2024, 1, 10, 12, 0), dt(2024, 1, 10, 19, 0)),
+    # Берлин: переход на летнее время 31 марта — 08:00 наступает на час раньше по UTC
+    ("Europe/Berlin", dt(2024, 3, 30, 8, 0), dt(2024, 3, 31, 6, 0)),
+    # Берлин: переход на зимнее время 27 октября — на час позже
+    ("Europe/Berlin", dt(2024, 10, 26, 7, 0), dt(2024, 10, 27, 7, 0)),
+    # Нью-Йорк: переход 10 марта
+    ("America/New_York", dt(2024, 3, 9, 14, 0), dt(2024, 3, 10, 12, 0)),
+    ("America/New_York", dt(2024, 11, 2, 13, 0), dt(2024, 11, 3, 13, 0)),
+])
+def test_next_reminder_at(timezone, after, expected):
+    assert next_reminder_at(timezone, EIGHT, after=after) == expected
+
+
+def test_strictly_after():
+    moment = dt(2024, 6, 1, 5, 0)  # 08:00 по Москве
+
+    assert next_reminder_at("Europe/Moscow", EIGHT, after=moment) == dt(2024, 6, 2, 5, 0)
+    assert next_reminder_at("Europe/Moscow", EIGHT, after=moment - datetime.timedelta(seconds=1)) == moment
+
+
+def test_nonexistent_local_time():
+    # 02:30 31 марта в Берлине не существует (02:00 -> 03:00): напоминание всё равно будет,
+    # в тот же день и не раньше, чем через сутки после предыдущего
+    before = next_reminder_at("Europe/Berlin", datetime.time(2, 30), after=dt(2024, 3, 29, 12, 0))
+    moment = next_reminder_at("Europe/Berlin", datetime.time(2, 30), after=before)
+
+    assert before == dt(2024, 3, 30, 1, 30)
+    assert moment.date() == datetime.date(2024, 3, 31)
+    assert datetime.timedelta(hours=23) <= moment - before <= datetime.timedelta(hours=25)
+
+
+def test_ambiguous_local_time_fires_once():
+    # 02:30 27 октября в Берлине бывает дважды — напоминание одно, по первому
+    first = next_reminder_at("Europe/Berlin", datetime.time(2, 30), after=dt(2024, 10, 26, 12, 0))
+    following = next_reminder_at("Europe/Berlin", datetime.time(2, 30), after=first)
+
+    assert first == dt(2024, 10, 27, 0, 30)
+    assert following == dt(2024, 10, 28, 1, 30)
+
+
+def test_daily_sequence_across_dst():
+    # Цепочка сдвигов, как у планировщика: каждый день ровно в 08:00 по местному времени
+    moment = dt(2024, 3, 25, 0, 0)
+    for _ in range(14):
+        moment = next_reminder_at("Europe/Berlin", EIGHT, after=moment)
+        local = moment.replace(tzinfo=datetime.timezone.utc).astimezone(parse_timezone("Europe/Berlin"))
+        assert (local.hour, local.minute) == (8, 0)
+    assert moment.date() == datetime.date(2024, 4, 7)
+
+
+def test_parse_timezone():
+    assert parse_timezone("Asia/Almaty") is not None
+    assert parse_timezone("Mars/Olympus") is None
+    assert parse_timezone("../etc/passwd") is None
+
+
+def test_default_reminder_time_spread(monkeypatch):
+    monkeypatch.setattr(reminders, "REMINDER_DEFAULT_SPREAD", 120)
+    random.seed(1)
+    times = {default_reminder_time() for _ in range(2000)}
+
+    assert min(times) == datetime.time(8, 0)
+    assert max(times) == datetime.time(9, 59)
+    assert len(times) == 120
+
+
+def test_default_reminder_time_wraps_midnight(monkeypatch):
+    monkeypatch.setattr(reminders, "DEFAULT_REMINDER_TIME", datetime.time(23, 30))
+    monkeypatch.setattr(reminders, "REMINDER_DEFAULT_SPREAD", 60)
+    random.seed(2)
+    times = {default_reminder_time() for _ in range(1000)}
+
+    assert times == {datetime.time(23, 30 + i) for i in range(30)} | {datetime.time(0, i) for i in range(30)}
+
+
+def test_default_reminder_time_without_spread(monkeypatch):
+    monkeypatch.setattr(reminders, "REMINDER_DEFAULT_SPREAD", 0)
+
+    assert default_reminder_time() == reminders.DEFAULT_REMINDER_TIME
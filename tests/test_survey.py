@@ -0,0 +1,75 @@
+# tests/test_survey.py
+"""
+callback_data компактного опроса (/log): кодирование, разбор и отказ на
+повреждённых или чужих данных. БД не нужна.
+"""
+import datetime
+
+import pytest
+
+from habits import BY_KEY, DEFAULT_HABITS, HABITS, resolve
+from survey import SURVEY_DAYS, compact_keyboard, compact_values, decode_callback, encode_callback
+
+YESTERDAY = datetime.date.today() - datetime.timedelta(days=1)
+BOOL_ONLY = resolve(["bedtime_before_midnight", "followed_diet", "water"])
+
+
+def test_roundtrip():
+    # Набор по умолчанию: три булевы привычки и спорт
+    data = encode_callback(YESTERDAY, DEFAULT_HABITS, 0b101, [3])
+
+    assert data.startswith(f"sv:{YESTERDAY:%Y%m%d}:")
+    assert data.endswith(":5:3")
+    assert decode_callback(data, DEFAULT_HABITS) == (YESTERDAY, 0b101, [3], False)
+
+
+def test_roundtrip_unanswered_numbers():
+    habits = resolve(["reading", "sport_hours", "sleep_hours", "steps"])
+    data = encode_callback(YESTERDAY, habits, 1, [None, 4, None])
+
+    assert decode_callback(data, habits) == (YESTERDAY, 1, [None, 4, None], False)
+
+
+def test_save_button_for_bool_only_set():
+    data = encode_callback(YESTERDAY, BOOL_ONLY, 0b110, [], save=True)
+
+    assert decode_callback(data, BOOL_ONLY) == (YESTERDAY, 0b110, [], True)
+
+
+def test_compact_values():
+    values = compact_values(DEFAULT_HABITS, 0b011, [1])
+
+    assert values == {
+        "bedtime_before_midnight": True, "no_gadgets_after_23": True,
+        "followed_diet": False, "sport_hours": 0.5,
+    }
+
+
+@pytest.mark.parametrize("data", [
+    # Кнопка из сообщения для другого набора привычек
+    encode_callback(YESTERDAY, BOOL_ONLY, 0, [], save=True),
+    # Дата вне окна SURVEY_DAYS и в будущем
+    encode_callback(datetime.date.today() - datetime.timedelta(days=SURVEY_DAYS), DEFAULT_HABITS, 0, [0]),
+    encode_callback(datetime.date.today() + datetime.timedelta(days=1), DEFAULT_HABITS, 0, [0]),
+    # Маска шире числа булевых вопросов, индекс вне вариантов, лишние значения
+    encode_callback(YESTERDAY, DEFAULT_HABITS, 0b1000, [0]),
+    encode_callback(YESTERDAY, DEFAULT_HABITS, 0, [len(BY_KEY["sport_hours"].choices)]),
+    encode_callback(YESTERDAY, DEFAULT_HABITS, 0, [0, 0]),
+    # «Сохранить» при неотвеченном числовом вопросе
+    encode_callback(YESTERDAY, DEFAULT_HABITS, 0, [], save=True),
+    "sv:garbage",
+    f"xx:{YESTERDAY:%Y%m%d}:00:0:0",
+])
+def test_rejects_invalid_data(data):
+    with pytest.raises(ValueError):
+        decode_callback(data, DEFAULT_HABITS)
+
+
+def test_callback_data_fits_telegram_limit():
+    # Все привычки реестра, все варианты выбраны
+    keyboard = compact_keyboard(YESTERDAY, HABITS, mask=0b101, indexes=[0, 0, 0])
+
+    for row in keyboard.inline_keyboard:
+        for button in row:
+            assert len(button.callback_data.encode()) <= 64
+            decode_callback(button.callback_data, HABITS)
@@ -0,0 +1,101 @@
+# tests/test_teams.py
+"""
+Рейтинг команды: порядок при равных очках и собственное место участника.
+Нужен PostgreSQL из переменных DB_*; без него тесты пропускаются.
+"""
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import delete, text
+
+import teams
+from database import dispose_engines, get_async_session, Team, TeamMember, TeamScore
+
+DAY = datetime.date(2024, 3, 6)
+START = teams.period_start("week", DAY)
+INVITE = "pytest-lb"
+# Вне диапазона настоящих telegram_id
+BASE = -9_000_000
+
+# user_id: (done, answered, sport_hours)
+SCORES = {
+    BASE + 1: (3, 4, 0.0),   # 0.75
+    BASE + 2: (6, 8, 1.0),   # 0.75, но больше выполнено
+    BASE + 3: (3, 4, 2.0),   # как BASE + 1 — выше по user_id
+    BASE + 4: (4, 4, 0.5),   # 1.0
+    BASE + 5: (1, 4, 0.0),   # 0.25
+}
+NO_POINTS = BASE + 6
+
+
+async def _run(check):
+    try:
+        async with get_async_session() as session:
+            await session.execute(text("SELECT 1"))
+    except Exception as e:
+        await dispose_engines()
+        pytest.skip(f"PostgreSQL недоступен: {e}")
+    try:
+        async with get_async_session() as session:
+            team = Team(name="pytest", invite_code=INVITE, owner_id=BASE + 1)
+            session.add(team)
+            await session.flush()
+            for user_id in (*SCORES, NO_POINTS):
+                session.add(TeamMember(user_id=user_id, team_id=team.id))
+            for user_id, (done, answered, sport_hours) in SCORES.items():
+                session.add(TeamScore(
+                    team_id=team.id, period="week", period_start=START, user_id=user_id,
+                    done=done, answered=answered, sport_hours=sport_hours,
+                ))
+            await session.commit()
+        await check()
+    finally:
+        async with get_async_session() as session:
+            await session.execute(delete(TeamScore).where(TeamScore.user_id.between(BASE, BASE + 100)))
+            await session.execute(delete(TeamMember).where(TeamMember.user_id.between(BASE, BASE + 100)))
+            await session.execute(delete(Team).where(Team.invite_code == INVITE))
+            await session.commit()
+        await dispose_engines()
+
+
+def test_ties_break_by_done_then_user_id():
+    async def check():
+        board = await teams.get_leaderboard(BASE + 1, "week", "rate", day=DAY)
+        assert [row[1] for row in board["top"]] == [BASE + 4, BASE + 2, BASE + 1, BASE + 3, BASE + 5]
+        assert [row[0] for row in board["top"]] == [1, 2, 3, 4, 5]
+        assert board["me"] == board["top"][2]
+
+    asyncio.run(_run(check))
+
+
+def test_own_place_below_top():
+    async def check():
+        board = await teams.get_leaderboard(BASE + 3, "week", "rate", day=DAY, limit=2)
+        assert [row[1] for row in board["top"]] == [BASE + 4, BASE + 2]
+        assert board["me"] == (4, BASE + 3, None, 3, 4, 2.0)
+
+        board = await teams.get_leaderboard(BASE + 1, "week", "sport", day=DAY, limit=2)
+        assert [row[1] for row in board["top"]] == [BASE + 3, BASE + 2]
+        assert board["me"][:2] == (4, BASE + 1)
+
+    asyncio.run(_run(check))
+
+
+def test_member_without_points_is_last():
+    async def check():
+        board = await teams.get_leaderboard(NO_POINTS, "week", "rate", day=DAY)
+        assert board["me"] == (len(SCORES) + 1, NO_POINTS, None, 0, 0, 0.0)
+        assert "пока без очков" in teams.format_leaderboard(board, "week", "rate")
+
+    asyncio.run(_run(check))
+
+
+def test_place_beyond_rank_limit(monkeypatch):
+    monkeypatch.setattr(teams, "LEADERBOARD_RANK_LIMIT", 3)
+
+    async def check():
+        board = await teams.get_leaderboard(BASE + 5, "week", "rate", day=DAY, limit=1)
+        assert board["me"][0] == "3+"
+
+    asyncio.run(_run(check))
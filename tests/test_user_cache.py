@@ -0,0 +1,101 @@
+# tests/test_user_cache.py
+"""
+Фильтр Блума и путь /start для известных пользователей: попадание в кэш не
+ходит в БД, промах и ответ фильтра регистрируют пользователя. Регистрация
+подменяется записью вызовов — БД не нужна.
+"""
+import asyncio
+import math
+
+from user_cache import BloomFilter, KnownUserCache
+
+
+def test_bloom_has_no_false_negatives():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    keys = range(10**9, 10**9 + 10_000)
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+
+
+def test_bloom_false_positive_rate():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    for key in range(10_000):
+        bloom.add(key)
+
+    false_positives = sum(key in bloom for key in range(10**6, 10**6 + 20_000))
+
+    # При заполнении до capacity доля ложных срабатываний — около error_rate
+    assert false_positives / 20_000 < 0.02
+
+
+def test_bloom_sizing():
+    bloom = BloomFilter(capacity=1_000_000, error_rate=0.001)
+
+    # ~14.4 бита и ~10 хэш-функций на элемент для 0.1 %
+    assert bloom.size == int(-1_000_000 * math.log(0.001) / math.log(2) ** 2)
+    assert bloom.hashes == 10
+    assert len(bloom._bits) == (bloom.size + 7) // 8
+
+
+def test_empty_bloom():
+    bloom = BloomFilter(capacity=100, error_rate=0.01)
+
+    assert not any(key in bloom for key in range(1000))
+
+
+def recording_cache(**kwargs):
+    cache = KnownUserCache(maxsize=10, **kwargs)
+    cache.registered = []
+
+    async def register(telegram_id, username=None):
+        cache.registered.append(telegram_id)
+
+    cache.batcher.register = register
+    return cache
+
+
+def test_cache_hit_skips_registration():
+    cache = recording_cache()
+
+    async def run():
+        await cache.ensure_registered(1)
+        await cache.ensure_registered(1)
+
+    asyncio.run(run())
+
+    assert cache.registered == [1]
+    assert 1 in cache._cache
+
+
+def test_discarded_user_is_registered_again():
+    # Рассылка пометила пользователя недоступным — следующий /start снова его активирует
+    cache = recording_cache()
+
+    async def run():
+        await cache.ensure_registered(1)
+        cache.discard(1)
+        await cache.ensure_registered(1)
+
+    asyncio.run(run())
+
+    assert cache.registered == [1, 1]
+
+
+def test_bloom_hit_registers_in_background():
+    cache = recording_cache(bloom=True, bloom_capacity=1000, bloom_error_rate=0.01)
+    cache._bloom.add(7)  # есть в фильтре, но вытеснен из LRU
+
+    async def run():
+        await cache.ensure_registered(7)
+        queued = cache.registered[:]
+        await asyncio.gather(*cache._background)
+        return queued
+
+    queued = asyncio.run(run())
+
+    # /start не ждёт регистрацию, но она происходит
+    assert queued == []
+    assert cache.registered == [7]
+    assert cache.bloom_hits == 1 and 7 in cache._cache
@@ -0,0 +1,224 @@
+# user_cache.py
+"""
+Кэш известных (зарегистрированных) пользователей и пакетная регистрация.
+
+/start не ходит в БД для уже известных пользователей: их telegram_id держатся
+в ограниченном LRU-кэше, который прогревается активными пользователями при
+старте бота. Новые пользователи регистрируются через RegistrationBatcher —
+регистрации, пришедшие в течение короткого окна, сливаются в один
+INSERT ... ON CONFLICT, который заодно снова активирует пользователей, ранее
+заблокировавших бота. Кэш держит только активных: рассылка, пометив
+пользователя недоступным, убирает его из кэша (см. broadcast_log.py), и
+следующий /start идёт через upsert. Рассылка пользователю и его /start
+обрабатываются одной репликой (см. fsm_storage.chat_owner).
+
+Необязательный фильтр Блума (USER_CACHE_BLOOM=true) помнит всех пользователей
+при малом расходе памяти. Положительный ответ фильтра может быть ложным, а
+удалить из него нельзя, поэтому для таких пользователей регистрация всё равно
+ставится в очередь, но /start её не ждёт.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import LRUCache
+from database import get_async_session, fetch_user_batch, User
+from metrics import set_query_source
+from reminders import default_reminder_time, next_reminder_at, DEFAULT_TIMEZONE
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "200000"))
+USER_CACHE_BLOOM = os.getenv("USER_CACHE_BLOOM", "false").lower() in ("1", "true", "yes")
+USER_CACHE_BLOOM_CAPACITY = int(os.getenv("USER_CACHE_BLOOM_CAPACITY", "2000000"))
+USER_CACHE_BLOOM_ERROR_RATE = float(os.getenv("USER_CACHE_BLOOM_ERROR_RATE", "0.001"))
+# Окно, в течение которого регистрации копятся в одну пачку
+REGISTRATION_WINDOW = float(os.getenv("REGISTRATION_WINDOW", "0.05"))
+REGISTRATION_BATCH = int(os.getenv("REGISTRATION_BATCH", "500"))
+WARMUP_BATCH_SIZE = 10_000
+
+
+class BloomFilter:
+    """
+    Фильтр Блума по целым ключам: «точно нет» или «вероятно есть».
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Двойное хэширование: k позиций из двух независимых половин одного дайджеста
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RegistrationBatcher:
+    """
+    Собирает регистрации за короткое окно и вставляет их одним запросом.
+    register() возвращает, когда пачка с пользователем записана в БД.
+    """
+
+    def __init__(self, window=REGISTRATION_WINDOW, max_batch=REGISTRATION_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # telegram_id -> (username, [futures])
+        self._full = asyncio.Event()
+        self._flusher = None
+        self.batches = 0
+        self.registered = 0  # новые и снова активированные
+
+    async def register(self, telegram_id, username=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = self._pending.setdefault(telegram_id, (username, []))
+        entry[1].append(future)
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_after_window())
+        await future
+
+    async def _flush_after_window(self):
+        set_query_source("user_registration")
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+        self._full.clear()
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            # Новым пользователям — утреннее напоминание по Москве, время разнесено по окну
+            rows = []
+            for telegram_id, (username, _) in batch.items():
+                reminder_time = default_reminder_time()
+                rows.append({
+                    "telegram_id": telegram_id, "username": username, "reminder_time": reminder_time,
+                    "next_reminder_at": next_reminder_at(DEFAULT_TIMEZONE, reminder_time),
+                })
+            async with get_async_session() as session:
+                stmt = insert(User).values(rows)
+                # Уже известных не трогаем; заблокировавшие бота и вернувшиеся (/start) снова активны
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[User.telegram_id], set_={"is_active": True}, where=User.is_active.is_(False),
+                )
+                result = await session.execute(stmt)
+                await session.commit()
+        except Exception as e:
+            for _, futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        self.batches += 1
+        self.registered += result.rowcount
+        for _, futures in batch.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+
+class KnownUserCache:
+    """
+    Известные пользователи: LRU-кэш + (необязательно) фильтр Блума.
+    """
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, bloom=USER_CACHE_BLOOM,
+                 bloom_capacity=USER_CACHE_BLOOM_CAPACITY,
+                 bloom_error_rate=USER_CACHE_BLOOM_ERROR_RATE):
+        self._cache = LRUCache(maxsize)
+        self._bloom = BloomFilter(bloom_capacity, bloom_error_rate) if bloom else None
+        self.batcher = RegistrationBatcher()
+        self.bloom_hits = 0
+        self._background = set()
+
+    def add(self, telegram_id):
+        self._cache.set(telegram_id, True)
+        if self._bloom is not None:
+            self._bloom.add(telegram_id)
+
+    def discard(self, telegram_id):
+        # Пользователь стал неактивным. Фильтр Блума удалять не умеет — вытесняем только из LRU
+        self._cache.pop(telegram_id)
+
+    async def ensure_registered(self, telegram_id, username=None):
+        """
+        Регистрирует пользователя, если он ещё не известен, и снова активирует
+        заблокировавшего бота. Известные пользователи обслуживаются без обращения к БД.
+        """
+        if telegram_id in self._cache:
+            return
+        if self._bloom is not None and telegram_id in self._bloom:
+            # Вероятно, уже зарегистрирован (или неактивен): дозаписываем в фоне
+            self.bloom_hits += 1
+            task = asyncio.create_task(self._register(telegram_id, username))
+            self._background.add(task)
+            task.add_done_callback(self._background_done)
+            return
+        await self._register(telegram_id, username)
+
+    async def _register(self, telegram_id, username):
+        await self.batcher.register(telegram_id, username)
+        self.add(telegram_id)
+
+    def _background_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Ошибка фоновой задачи кэша пользователей: {task.exception()}")
+
+    def start_warm_up(self):
+        """
+        Прогрев в фоновой задаче — старт бота его не ждёт.
+        """
+        task = asyncio.create_task(self.warm_up())
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    async def warm_up(self, batch_size=WARMUP_BATCH_SIZE):
+        """
+        Загружает telegram_id существующих пользователей (keyset-пагинацией).
+        В LRU попадают не больше maxsize последних, в фильтр Блума — все.
+        """
+        last_id, loaded = 0, 0
+        while True:
+            batch = await fetch_user_batch(after_id=last_id, limit=batch_size)
+            if not batch:
+                break
+            for _, telegram_id in batch:
+                self.add(telegram_id)
+            loaded += len(batch)
+            last_id = batch[-1][0]
+        # Прогрев не считаем в статистике кэша
+        self._cache.hits = self._cache.misses = self._cache.evictions = 0
+        logging.info(f"Кэш пользователей прогрет: {loaded} пользователей")
+
+    def as_dict(self):
+        return {
+            "size": len(self._cache),
+            "capacity": self._cache.maxsize,
+            "hits": self._cache.hits,
+            "misses": self._cache.misses,
+            "evictions": self._cache.evictions,
+            "bloom_enabled": self._bloom is not None,
+            "bloom_hits": self.bloom_hits,
+            "registration_batches": self.batcher.batches,
+            "registered": self.batcher.registered,
+        }
@@ -0,0 +1,291 @@
+# webhook.py
+"""
+Режим webhook — альтернатива long polling.
+
+aiohttp-сервер принимает апдейты от Telegram и кладёт их в ограниченную очередь,
+пул воркеров передаёт их диспетчеру. Если очередь заполнена дольше
+UPDATE_ENQUEUE_TIMEOUT, сервер отвечает 503 и Telegram повторит доставку позже —
+апдейты не теряются и не пропускаются. Апдейты одного чата обрабатываются строго
+по порядку.
+
+При нескольких репликах (BOT_REPLICAS > 1) Telegram доставляет апдейт любой из
+них, а обрабатывает его только реплика, за которой закреплён чат
+(fsm_storage.chat_owner): остальные пересылают апдейт ей по адресу из
+WEBHOOK_PEERS и возвращают Telegram её ответ. Так состояние FSM чата меняет
+один процесс, и его кэш не расходится с БД. Если владелец недоступен, Telegram
+получает 503 и повторит доставку.
+
+Метрики очереди (глубина, задержки) и разделы, добавленные через register_stats,
+отдаются в JSON на WEBHOOK_STATS_PATH.
+"""
+import asyncio
+import logging
+import os
+import signal
+import statistics
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from fsm_storage import chat_owner, BOT_REPLICAS, BOT_REPLICA_INDEX
+from metrics import UPDATE_QUEUE_DEPTH, UPDATE_QUEUE_WAIT
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_STATS_PATH = os.getenv("WEBHOOK_STATS_PATH", "/webhook/stats")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "50"))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "5"))
+# Внутренние адреса webhook всех реплик по порядку BOT_REPLICA_INDEX, через запятую
+# (например, http://bot-0:8080/webhook,http://bot-1:8080/webhook)
+WEBHOOK_PEERS = [url.strip() for url in os.getenv("WEBHOOK_PEERS", "").split(",") if url.strip()]
+# Пересланный апдейт помечается, чтобы при расхождении настроек реплик он не ходил по кругу
+FORWARDED_HEADER = "X-Bot-Forwarded-From"
+
+LATENCY_WINDOW = 10_000
+
+# Дополнительные метрики для WEBHOOK_STATS_PATH: имя -> функция, возвращающая dict
+_stats_providers = {}
+
+
+def register_stats(name, provider):
+    """
+    Добавляет раздел в JSON метрик webhook-сервера (например, статистику кэшей).
+    """
+    _stats_providers[name] = provider
+
+
+def update_chat_id(data):
+    """
+    chat_id из «сырого» апдейта (message, callback_query, ...) — для упорядочивания по чатам.
+    """
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        if "chat" in value:
+            return value["chat"]["id"]
+        if "message" in value and "chat" in value["message"]:
+            return value["message"]["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def _percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+class UpdateQueueMetrics:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.forwarded = 0
+        self.queue_wait = deque(maxlen=window)
+        self.processing = deque(maxlen=window)
+
+    def as_dict(self, queue):
+        waits = list(self.queue_wait)
+        processing = list(self.processing)
+        return {
+            "queue_depth": queue.qsize(),
+            "queue_capacity": queue.maxsize,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "forwarded": self.forwarded,
+            "queue_wait_ms": {f"p{q}": round(_percentile(waits, q) * 1000, 2) for q in (50, 95, 99)},
+            "processing_ms": {f"p{q}": round(_percentile(processing, q) * 1000, 2) for q in (50, 95, 99)},
+        }
+
+
+class WebhookServer:
+    """
+    HTTP-приём апдейтов + ограниченная очередь + пул воркеров.
+    """
+
+    def __init__(self, dp,
+                 path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET,
+                 queue_size=UPDATE_QUEUE_SIZE,
+                 workers=UPDATE_WORKERS,
+                 enqueue_timeout=UPDATE_ENQUEUE_TIMEOUT,
+                 peers=WEBHOOK_PEERS):
+        if BOT_REPLICAS > 1 and len(peers) != BOT_REPLICAS:
+            raise ValueError(f"WEBHOOK_PEERS: нужно {BOT_REPLICAS} адресов реплик, задано {len(peers)}")
+        self.dp = dp
+        self.peers = peers
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        UPDATE_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.metrics = UpdateQueueMetrics()
+        self._chat_locks = {}
+        self._worker_tasks = []
+        self._runner = None
+        self._client = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get(WEBHOOK_STATS_PATH, self.handle_stats)
+        return app
+
+    async def handle_update(self, request):
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+
+        data = await request.json()
+        self.metrics.received += 1
+        chat_id = update_chat_id(data)
+        if chat_id is not None and chat_owner(chat_id) != BOT_REPLICA_INDEX:
+            if FORWARDED_HEADER not in request.headers:
+                return await self._forward(chat_owner(chat_id), data)
+            logging.warning(
+                f"Апдейт чата {chat_id} переслан не владельцу (реплика {BOT_REPLICA_INDEX}): "
+                f"проверьте BOT_REPLICAS и WEBHOOK_PEERS на всех репликах"
+            )
+        try:
+            await asyncio.wait_for(self.queue.put((time.monotonic(), data)), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            # Очередь переполнена: отказываем, Telegram повторит доставку
+            self.metrics.rejected += 1
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    async def _forward(self, owner, data):
+        """
+        Передаёт апдейт реплике-владельцу чата; её ответ (или 503) уходит Telegram.
+        """
+        headers = {FORWARDED_HEADER: str(BOT_REPLICA_INDEX)}
+        if self.secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret
+        try:
+            async with self._client.post(self.peers[owner], json=data, headers=headers) as response:
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Реплика {owner} недоступна, апдейт {data.get('update_id')} не принят: {e}")
+            status = 503
+        if status == 200:
+            self.metrics.forwarded += 1
+        else:
+            self.metrics.rejected += 1
+        return web.Response(status=status)
+
+    async def handle_stats(self, request):
+        stats = self.metrics.as_dict(self.queue)
+        for name, provider in _stats_providers.items():
+            stats[name] = provider()
+        return web.json_response(stats)
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            enqueued_at, data = await self.queue.get()
+            try:
+                await self._process(enqueued_at, data)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, enqueued_at, data):
+        chat_id = update_chat_id(data)
+        # [lock, число ожидающих] — запись удаляется, когда чат никто не ждёт
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                started = time.monotonic()
+                self.metrics.queue_wait.append(started - enqueued_at)
+                UPDATE_QUEUE_WAIT.observe(started - enqueued_at)
+                try:
+                    # Отдельная задача = отдельная копия contextvars: aiogram кэширует
+                    # в них текущее состояние FSM, и оно не должно протекать между апдейтами.
+                    # updates_handler.notify (как в polling) — чтобы срабатывали middleware апдейтов
+                    await asyncio.create_task(self.dp.updates_handler.notify(types.Update(**data)))
+                    self.metrics.processed += 1
+                except Exception as e:
+                    self.metrics.failed += 1
+                    logging.error(f"Ошибка обработки апдейта {data.get('update_id')}: {e}")
+                self.metrics.processing.append(time.monotonic() - started)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+
+    async def start(self, host=WEBAPP_HOST, port=WEBAPP_PORT):
+        if BOT_REPLICAS > 1:
+            # Ожидание очереди у владельца плюс запас на сеть
+            timeout = aiohttp.ClientTimeout(total=self.enqueue_timeout + 5)
+            self._client = aiohttp.ClientSession(timeout=timeout)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook-сервер слушает {host}:{port}{self.path}")
+
+    async def stop(self):
+        """
+        Перестаём принимать апдейты и дорабатываем уже принятые.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._client is not None:
+            await self._client.close()
+        await self.queue.join()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+
+
+def start_webhook(dp, on_startup=None, on_shutdown=None):
+    """
+    Точка входа режима webhook (аналог executor.start_polling).
+    """
+    loop = asyncio.get_event_loop()
+    server = WebhookServer(dp)
+
+    async def run():
+        if on_startup is not None:
+            await on_startup(dp)
+        await server.start()
+        if WEBHOOK_HOST:
+            # drop_pending_updates=False: накопившиеся за время рестарта апдейты будут доставлены
+            await dp.bot.set_webhook(
+                WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH,
+                drop_pending_updates=False,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                secret_token=WEBHOOK_SECRET or None,
+            )
+        else:
+            logging.warning("WEBHOOK_HOST не задан — webhook в Telegram не регистрируется")
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+
+        logging.info("Останавливаем webhook-сервер, дорабатываем очередь...")
+        await server.stop()
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    loop.run_until_complete(run())
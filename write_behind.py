@@ -0,0 +1,124 @@
+# write_behind.py
+"""
+Пакетная запись DailyLog (write-behind).
+
+Завершённые опросы не коммитятся по одному: записи попадают в ограниченную
+очередь, фоновая задача собирает их в пачку (до LOG_WRITE_BATCH записей или
+LOG_WRITE_INTERVAL секунд) и сохраняет одной транзакцией через save_daily_logs.
+submit() возвращает управление только после коммита пачки, поэтому
+пользователь получает «сохранено», когда данные уже в БД.
+
+Если очередь заполнена, submit() ждёт — память ограничена LOG_WRITE_QUEUE.
+При остановке бота close() дописывает всё, что уже в очереди.
+"""
+import asyncio
+import logging
+import os
+
+from database import get_async_session
+from logbook import save_daily_logs
+from metrics import set_query_source
+
+LOG_WRITE_BATCH = int(os.getenv("LOG_WRITE_BATCH", "500"))
+LOG_WRITE_INTERVAL = float(os.getenv("LOG_WRITE_INTERVAL", "0.05"))
+LOG_WRITE_QUEUE = int(os.getenv("LOG_WRITE_QUEUE", "10000"))
+
+
+class DailyLogWriter:
+    """
+    Очередь записей DailyLog с пакетным сохранением в фоне.
+    """
+
+    def __init__(self, batch_size=LOG_WRITE_BATCH, interval=LOG_WRITE_INTERVAL, queue_size=LOG_WRITE_QUEUE):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._worker = None
+        self._closed = False
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+    async def submit(self, user_id, date_of_entry, values, username=None):
+        """
+        Ставит запись в очередь и ждёт коммита её пачки.
+        Возвращает True, если запись новая, и False, если обновлена существующая.
+        """
+        if self._closed:
+            raise RuntimeError("Запись DailyLog остановлена")
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        entry = {"user_id": user_id, "date_of_entry": date_of_entry, "values": values, "username": username}
+        await self.queue.put((entry, future))
+        return await future
+
+    async def _run(self):
+        set_query_source("log_writer")
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await self.queue.get()
+            if item is None:
+                # Сигнал остановки: всё, что было в очереди до него, уже записано
+                return
+            batch = [item]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch):
+        try:
+            created = await self._save([entry for entry, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                self.failed += 1
+                logging.error(f"Ошибка записи DailyLog: {e}")
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # Пачка не записалась — пишем по одной, чтобы одна плохая запись не подвела остальных
+            logging.warning(f"Ошибка пакетной записи DailyLog ({len(batch)} шт.), пишем по одной: {e}")
+            for item in batch:
+                await self._write([item])
+            return
+        self.batches += 1
+        self.written += len(batch)
+        for (_, future), is_new in zip(batch, created):
+            if not future.done():
+                future.set_result(is_new)
+
+    async def _save(self, entries):
+        async with get_async_session() as session:
+            created = await save_daily_logs(session, entries)
+            await session.commit()
+        return created
+
+    async def close(self):
+        """
+        Перестаёт принимать записи и дописывает очередь.
+        """
+        self._closed = True
+        if self._worker is None:
+            return
+        await self.queue.put(None)
+        await self._worker
+        self._worker = None
+
+    def as_dict(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+        }
+